@@ -6,38 +6,58 @@ Features: 4K support, 2GB+ upload via Pyrogram, GDrive integration, No VPS stora
 import os
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from datetime import datetime, timedelta, date
+from typing import Optional, Dict, List, AsyncIterator, Callable
 import re
 import json
 from pathlib import Path
 import shutil
 import tempfile
+import threading
+import socket
+import sys
+import hashlib
+import math
+import zlib
+import time
+import traceback
+import signal
+from collections import deque
+from contextvars import ContextVar
+from contextlib import asynccontextmanager, contextmanager, aclosing, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
+from aiogram.dispatcher.flags import get_flag
 from aiogram.filters import Command, CommandStart
 from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.methods import TelegramMethod
 
 # Pyrogram for large file uploads (2GB+)
-from pyrogram import Client as PyrogramClient
+from pyrogram import Client as PyrogramClient, raw
 from pyrogram.types import Message as PyrogramMessage
+from pyrogram.errors import FloodWait
 
 import yt_dlp
+from yt_dlp.dependencies import mutagen
 import redis.asyncio as redis
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import select, func
+from sqlalchemy import select, func, inspect, text, update, event, case, make_url
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
 import aiofiles
 
 # Google Drive imports
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+import aiohttp
+from aiohttp import web
 import pickle
 
 # Configuration
@@ -46,19 +66,111 @@ API_ID = int(os.getenv("API_ID"))  # Get from my.telegram.org
 API_HASH = os.getenv("API_HASH")   # Get from my.telegram.org
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 DB_URL = os.getenv("DB_URL", "sqlite+aiosqlite:///bot.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))  # Connections kept open per process (Postgres/MySQL)
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))  # Extra connections allowed under bursts
+DB_POOL_TIMEOUT = 30  # Seconds to wait for a free connection before failing
+DB_POOL_RECYCLE = 1800  # Reconnect connections older than this (server/proxy idle timeouts)
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # NORMAL is durable with WAL except on power loss
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))  # Wait for another process's write lock
 MAX_FILE_MB = 4000  # 4GB with Pyrogram (Telegram supports up to 4GB)
 TELEGRAM_UPLOAD_LIMIT_MB = 4000  # 4GB via Client API
 MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "5"))
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))  # yt-dlp threads off the event loop
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", "32"))  # Sockets shared by all running downloads
+DOWNLOAD_MAX_FRAGMENTS = int(os.getenv("DOWNLOAD_MAX_FRAGMENTS", "16"))  # Most parallel fragments for one job
+DOWNLOAD_RATE_LIMIT_MB = float(os.getenv("DOWNLOAD_RATE_LIMIT_MB", "0"))  # Per-job cap in MB/s; 0 = unlimited
+HTTP_CHUNK_MIN_MB = 1
+HTTP_CHUNK_MAX_MB = 10  # YouTube throttles range requests larger than this
+HTTP_CHUNK_SECONDS = 4  # Size chunks to take about this long at the job's measured speed
+
+def _available_cpus() -> int:
+    """CPUs this process may really use: the cgroup quota (docker cpus:) if set, else its affinity"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+POSTPROCESS_THREADS = int(os.getenv("POSTPROCESS_THREADS", "1"))  # ffmpeg threads per merge/conversion
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", str(max(1, _available_cpus() // POSTPROCESS_THREADS))))
+MAX_ACTIVE_PER_USER = int(os.getenv("MAX_ACTIVE_PER_USER", "2"))
+MAX_QUEUED_PER_USER = int(os.getenv("MAX_QUEUED_PER_USER", "3"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "100"))
+PLAYLIST_MAX_ITEMS = int(os.getenv("PLAYLIST_MAX_ITEMS", "50"))
+PLAYLIST_PARALLEL = int(os.getenv("PLAYLIST_PARALLEL", str(MAX_ACTIVE_PER_USER)))  # Items of one playlist at once
+QUEUE_BACKEND = os.getenv("QUEUE_BACKEND", "local")  # local | redis (run worker.py)
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = 1.0
+JOB_RESUME_HOURS = int(os.getenv("JOB_RESUME_HOURS", "24"))  # Older unfinished jobs are failed instead of resumed
+JOB_FLUSH_INTERVAL = 2  # Seconds between batched job/event writes
+JOB_CHECKPOINT_SECONDS = 15  # Progress is recorded for a job at most this often (state changes always are)
+JOB_FLUSH_BATCH = int(os.getenv("JOB_FLUSH_BATCH", "200"))  # ...or sooner once this many changes are waiting
+STATS_ROLLUP_INTERVAL = int(os.getenv("STATS_ROLLUP_INTERVAL", "300"))  # Seconds between daily_stats refreshes
+JOB_RESULT_TTL = 3600
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 86400)))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "10000"))
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", str(3 * 3600)))  # Below YouTube's ~6h URL expiry
+METADATA_WAIT_SECONDS = 10  # How long the quality menu waits for the prefetch before falling back
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "false").lower() == "true"
+STREAM_BUFFER_MB = int(os.getenv("STREAM_BUFFER_MB", "16"))
+TG_PART_SIZE = 512 * 1024  # MTProto upload part size
+TG_SMALL_FILE_LIMIT = 10 * 1024 * 1024  # Above this Telegram needs saveBigFilePart
+PYROGRAM_SESSIONS = int(os.getenv("PYROGRAM_SESSIONS", "2"))  # MTProto connections uploads are spread over
+TG_PARALLEL_PARTS = int(os.getenv("TG_PARALLEL_PARTS", "4"))  # Parts in flight per streamed upload
+TG_FLOOD_RETRIES = 3
+PROGRESS_EDITS_PER_SECOND = float(os.getenv("PROGRESS_EDITS_PER_SECOND", "20"))  # All status edits, bot-wide
+PROGRESS_MIN_INTERVAL = 3  # Seconds between edits of one message
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))  # Redis copy of a user row
+USER_CACHE_LOCAL_TTL = 30  # In-process copy; short so other processes' changes show up
+USER_FLUSH_INTERVAL = 10  # Seconds between batched last_active/username writes
 RATE_LIMIT_PER_USER_PER_DAY = int(os.getenv("RATE_LIMIT_PER_USER_PER_DAY", "50"))
+RATE_LIMIT_POLICY = os.getenv("RATE_LIMIT_POLICY", "sliding")  # sliding (24h window) | bucket (steady refill)
+RATE_LIMIT_WINDOW = 86400
+# Per-tier daily limits, "tier:limit,..."; 0 is unlimited. Users without a tier get RATE_LIMIT_PER_USER_PER_DAY
+RATE_LIMIT_TIERS = {
+    tier: int(limit)
+    for tier, limit in (item.split(":") for item in os.getenv("RATE_LIMIT_TIERS", "admin:0").split(",") if item)
+}
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public base URL, e.g. https://bot.example.com; unset = long polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Parallel deliveries from Telegram
+MAX_UPDATES_IN_FLIGHT = int(os.getenv("MAX_UPDATES_IN_FLIGHT", "200"))  # Per replica; beyond it updates get 503
+ENABLE_METRICS = os.getenv("ENABLE_METRICS", "false").lower() == "true"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "8000"))
+METRICS_SAMPLE_INTERVAL = 1.0  # Event-loop lag probe and gauge refresh
+LOOP_BLOCK_SECONDS = float(os.getenv("LOOP_BLOCK_SECONDS", "0.5"))  # Stalls this long are logged with the blocking stack
+SLOW_HANDLER_SECONDS = float(os.getenv("SLOW_HANDLER_SECONDS", "2"))  # Handlers slower than this are logged
+PROFILE_SECONDS = 30  # Length of a profile started from /admin
+PROFILE_INTERVAL = 0.005  # Sampling period of the profiler
 ADMIN_USER_IDS = [int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x]
 STORAGE_BACKEND = "gdrive"
 GDRIVE_CLIENT_ID = os.getenv("GDRIVE_CLIENT_ID")
 GDRIVE_CLIENT_SECRET = os.getenv("GDRIVE_CLIENT_SECRET")
 GDRIVE_FOLDER_NAME = "YTDL"
+GDRIVE_UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files"
+GDRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+GDRIVE_CHUNK_ALIGN = 256 * 1024  # Drive chunk sizes must be multiples of 256 KiB
+GDRIVE_CHUNK_MB = int(os.getenv("GDRIVE_CHUNK_MB", "8"))
+GDRIVE_MAX_CHUNK_MB = int(os.getenv("GDRIVE_MAX_CHUNK_MB", "64"))
+GDRIVE_MAX_PARALLEL_UPLOADS = int(os.getenv("GDRIVE_MAX_PARALLEL_UPLOADS", "4"))
+GDRIVE_MAX_RETRIES = 5
+GDRIVE_SESSION_TTL = 7 * 86400  # Drive keeps resumable sessions for about a week
 
 # Use temp directory that auto-cleans
 TMP_DIR = Path(tempfile.gettempdir()) / "yt_bot"
 TMP_DIR.mkdir(exist_ok=True)
+TEMP_QUOTA_MB = int(os.getenv("TEMP_QUOTA_MB", "0"))  # Space downloads may reserve in TMP_DIR; 0 = whatever the disk has
+TEMP_MIN_FREE_MB = int(os.getenv("TEMP_MIN_FREE_MB", "1024"))  # Never reserve into this last bit of the disk
+TEMP_RESERVE_TIMEOUT = int(os.getenv("TEMP_RESERVE_TIMEOUT", "600"))  # How long a job waits for space before failing
+TEMP_DEFAULT_RESERVE_MB = 512  # Reservation when the size can't be estimated
+TEMP_ORPHAN_HOURS = 6  # Startup sweep age for leftovers of a crashed process (stream URLs expire by then anyway)
 
 # Google Drive Scopes
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
@@ -74,6 +186,228 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Metrics: always collected (/admin reads them), served over HTTP when ENABLE_METRICS=true
+QUEUE_DEPTH = Gauge("ytdl_queue_depth", "Downloads waiting for a slot")
+ACTIVE_JOBS = Gauge("ytdl_active_jobs", "Downloads currently running")
+DOWNLOAD_CONNECTIONS_USED = Gauge("ytdl_download_connections", "Sockets allotted to running downloads")
+TEMP_RESERVED = Gauge("ytdl_temp_reserved_bytes", "Temp disk space reserved by running downloads")
+LOOP_LAG = Gauge("ytdl_event_loop_lag_seconds", "How late the event loop woke up the last probe")
+PHASE_SECONDS = Histogram(
+    "ytdl_phase_seconds", "Duration of a pipeline phase", ["phase"],
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+PHASE_BYTES = Counter("ytdl_phase_bytes_total", "Bytes moved by a pipeline phase", ["phase"])
+PHASE_THROUGHPUT = Histogram(
+    "ytdl_phase_bytes_per_second", "Throughput of a pipeline phase", ["phase"],
+    buckets=(64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6)
+)
+CACHE_REQUESTS = Counter("ytdl_cache_requests_total", "Cache lookups", ["cache", "result"])
+DELIVERIES = Counter("ytdl_deliveries_total", "Finished requests", ["storage", "status"])
+UPDATES_IN_FLIGHT = Gauge("ytdl_webhook_updates_in_flight", "Webhook updates being handled")
+UPDATES_REJECTED = Counter("ytdl_webhook_updates_rejected_total", "Webhook updates refused for backpressure")
+REDIS_LATENCY = Histogram(
+    "ytdl_redis_command_seconds", "Redis command latency", ["command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+)
+DB_LATENCY = Histogram(
+    "ytdl_db_query_seconds", "Database statement latency",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+)
+HANDLER_SECONDS = Histogram(
+    "ytdl_handler_seconds", "Telegram update handler duration", ["handler"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 60)
+)
+LOOP_BLOCKS = Counter("ytdl_event_loop_blocks_total", "Event-loop stalls longer than LOOP_BLOCK_SECONDS")
+
+@contextmanager
+def track_phase(phase: str):
+    """Time a successful pipeline phase; set record['bytes'] to also count throughput"""
+    record = {'bytes': 0}
+    started = time.perf_counter()
+    yield record
+    elapsed = time.perf_counter() - started
+    PHASE_SECONDS.labels(phase).observe(elapsed)
+    if record['bytes']:
+        PHASE_BYTES.labels(phase).inc(record['bytes'])
+        if elapsed > 0:
+            PHASE_THROUGHPUT.labels(phase).observe(record['bytes'] / elapsed)
+
+def metric_value(name: str, labels: Optional[Dict[str, str]] = None) -> float:
+    return REGISTRY.get_sample_value(name, labels or {}) or 0
+
+def cache_hit_ratio() -> Optional[float]:
+    """Hit ratio over every cache since start, None before the first lookup"""
+    hits = misses = 0
+    for metric in CACHE_REQUESTS.collect():
+        for sample in metric.samples:
+            if sample.name.endswith("_total"):
+                if sample.labels["result"] == "hit":
+                    hits += sample.value
+                else:
+                    misses += sample.value
+    return hits / (hits + misses) if hits + misses else None
+
+# Profiling: a watchdog for blocking calls, handler timing, and a sampling profiler for /admin
+def _format_frame_stack(frame, limit: int = 12) -> str:
+    return "".join(traceback.format_stack(frame, limit=limit))
+
+def _format_await_chain(task: asyncio.Task, limit: int = 12) -> str:
+    """Where a suspended task is waiting: its coroutine and every coroutine it is awaiting"""
+    lines = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        lines.append(f'  File "{frame.f_code.co_filename}", line {frame.f_lineno}, in {frame.f_code.co_name}\n')
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return "".join(lines[-limit:])
+
+class LoopWatchdog:
+    """Thread that logs the event loop's stack whenever the loop stops turning for threshold seconds"""
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._beat = 0.0
+        self._loop = None
+        self._loop_thread: Optional[int] = None
+        self._stop = threading.Event()
+    
+    def start(self, loop: asyncio.AbstractEventLoop):
+        if self._loop is not None or self.threshold <= 0:
+            return
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        loop.call_soon(self._tick)
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+    
+    def stop(self):
+        self._stop.set()
+        self._loop = None
+    
+    def _tick(self):
+        # One cheap callback per half threshold is all the loop pays
+        self._beat = time.monotonic()
+        if self._loop is not None and not self._stop.is_set():
+            self._loop.call_later(self.threshold / 2, self._tick)
+    
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or beat == reported:
+                continue
+            reported = beat  # one report per stall
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            LOOP_BLOCKS.inc()
+            logger.warning(
+                f"Event loop blocked for {stalled:.2f}s in:\n{_format_frame_stack(frame)}"
+            )
+
+loop_watchdog = LoopWatchdog(LOOP_BLOCK_SECONDS)
+
+class SlowHandlerMiddleware(BaseMiddleware):
+    """Times every handler; slow ones are logged with where they were waiting.
+    
+    Handlers flagged long_running (the ones that run a whole download) are timed but not logged.
+    """
+    
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+    
+    async def __call__(self, handler, event, data):
+        callback = getattr(data.get("handler"), "callback", None)
+        name = getattr(callback, "__name__", type(event).__name__)
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        samples: List[str] = []
+        
+        def sample():
+            # Where the handler is awaiting; a handler blocking the loop is caught by the watchdog instead
+            samples.append(_format_await_chain(task))
+            if len(samples) < 3:
+                timers[0] = loop.call_later(self.threshold, sample)
+        
+        timers = [loop.call_later(self.threshold, sample)]
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            timers[0].cancel()
+            elapsed = time.perf_counter() - started
+            HANDLER_SECONDS.labels(name).observe(elapsed)
+            if elapsed >= self.threshold and not get_flag(data, "long_running"):
+                logger.warning(f"Slow handler {name}: {elapsed:.2f}s\n" + "\n".join(samples))
+
+# Webhook mode: releases the in-flight slot of the update being handled (see BoundedRequestHandler)
+webhook_slot: ContextVar[Optional[Callable]] = ContextVar("webhook_slot", default=None)
+
+class LongRunningMiddleware(BaseMiddleware):
+    """A handler flagged long_running stops counting as webhook load: downloads have their own limits"""
+    
+    async def __call__(self, handler, event, data):
+        release = webhook_slot.get()
+        if release and get_flag(data, "long_running"):
+            release()
+        return await handler(event, data)
+
+class SamplingProfiler:
+    """On-demand sampler of the event loop's stack; costs nothing while not running.
+    
+    Samples come from a SIGALRM timer handled on the loop's (main) thread, so they land on
+    the code that is really running instead of wherever the GIL happens to be released.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.running = False
+    
+    async def profile(self, seconds: float) -> Dict[str, int]:
+        """Collapsed stacks (flamegraph.pl format) -> sample count for the event loop"""
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError("The profiler needs the event loop on the main thread")
+        
+        stacks: Dict[str, int] = {}
+        
+        def on_sample(signum, frame):
+            names = []
+            while frame is not None:
+                names.append(f"{Path(frame.f_code.co_filename).name}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            key = ";".join(reversed(names))
+            stacks[key] = stacks.get(key, 0) + 1
+        
+        self.running = True
+        previous = signal.signal(signal.SIGALRM, on_sample)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+            self.running = False
+        return stacks
+    
+    @staticmethod
+    def summary(stacks: Dict[str, int], top: int = 10) -> List[tuple]:
+        """(function, share of busy samples), by self time; samples idling in select() are left out"""
+        busy: Dict[str, int] = {}
+        for stack, count in stacks.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            if leaf.startswith("selectors.py:"):
+                continue
+            busy[leaf] = busy.get(leaf, 0) + count
+        total = sum(busy.values())
+        ranked = sorted(busy.items(), key=lambda item: item[1], reverse=True)[:top]
+        return [(leaf, count / total) for leaf, count in ranked]
+
+profiler = SamplingProfiler(PROFILE_INTERVAL)
+
 # Database Models
 class Base(DeclarativeBase):
     pass
@@ -84,27 +418,58 @@ class User(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     telegram_id: Mapped[int] = mapped_column(unique=True)
     username: Mapped[Optional[str]]
-    first_seen: Mapped[datetime]
+    first_seen: Mapped[datetime] = mapped_column(index=True)
     last_active: Mapped[datetime]
     total_downloads: Mapped[int] = mapped_column(default=0)
     language: Mapped[str] = mapped_column(default="bn")
     gdrive_token: Mapped[Optional[str]]
+    gdrive_folder_id: Mapped[Optional[str]]  # Cached id of the YTDL folder in the user's Drive
     is_admin: Mapped[bool] = mapped_column(default=False)
+    default_storage: Mapped[Optional[str]]  # "telegram" / "gdrive"; None asks every time
+    tier: Mapped[Optional[str]]  # Rate limit tier (RATE_LIMIT_TIERS); None is the free tier
 
 class Job(Base):
     __tablename__ = "jobs"
     
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int]
+    user_id: Mapped[int]  # Telegram id
     url: Mapped[str]
     format: Mapped[str]
     quality: Mapped[str]
-    status: Mapped[str]
+    status: Mapped[str]  # queued -> downloading -> postprocessing -> uploading -> done / failed
     created_at: Mapped[datetime]
-    completed_at: Mapped[Optional[datetime]]
+    completed_at: Mapped[Optional[datetime]] = mapped_column(index=True)
     file_size: Mapped[Optional[int]]
     error_message: Mapped[Optional[str]]
     gdrive_link: Mapped[Optional[str]]
+    storage: Mapped[Optional[str]]  # "telegram" / "gdrive"
+    chat_id: Mapped[Optional[int]]
+    message_id: Mapped[Optional[int]]  # Status message, re-attached when the job is resumed
+    work_dir: Mapped[Optional[str]]  # Job directory in TMP_DIR holding yt-dlp's .part files
+    progress: Mapped[Optional[int]]  # Last download percent checkpoint
+    updated_at: Mapped[Optional[datetime]]
+
+class JobEvent(Base):
+    __tablename__ = "job_events"
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    job_id: Mapped[int] = mapped_column(index=True)
+    status: Mapped[str]  # State the job entered
+    at: Mapped[datetime]
+    detail: Mapped[Optional[str]]
+
+class DailyStats(Base):
+    """Per-day aggregates, refreshed by rollup_stats() so /admin and /stats never scan jobs or users"""
+    __tablename__ = "daily_stats"
+    
+    day: Mapped[date] = mapped_column(primary_key=True)
+    downloads: Mapped[int] = mapped_column(default=0)
+    failed: Mapped[int] = mapped_column(default=0)
+    bytes: Mapped[int] = mapped_column(default=0)
+    active_users: Mapped[int] = mapped_column(default=0)
+    new_users: Mapped[int] = mapped_column(default=0)
+    total_users: Mapped[int] = mapped_column(default=0)
+    updated_at: Mapped[datetime]
 
 # FSM States
 class DownloadStates(StatesGroup):
@@ -118,14 +483,119 @@ class GDriveAuthStates(StatesGroup):
     waiting_for_code = State()
 
 # Initialize
-engine = create_async_engine(DB_URL, echo=False)
+IS_SQLITE = make_url(DB_URL).get_backend_name() == "sqlite"
+
+def _engine_options() -> dict:
+    """Pool settings for server databases; SQLite connections are local and never go stale"""
+    if IS_SQLITE:
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,  # a connection dropped by the server is replaced instead of failing a query
+    }
+
+engine = create_async_engine(DB_URL, echo=False, **_engine_options())
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
-redis_client = redis.from_url(REDIS_URL)
+if IS_SQLITE:
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        """WAL lets reads run alongside the writer; busy_timeout waits out other processes' writes"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+class DatabaseWriter:
+    """Runs write transactions; on SQLite all of them go through one task, in order.
+    
+    SQLite has a single write lock, so concurrent writers only take turns failing
+    with "database is locked". Queueing them in-process keeps the lock uncontended;
+    server databases run writes concurrently.
+    """
+    
+    def __init__(self, serialize: bool):
+        self.serialize = serialize
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    async def run(self, work):
+        """Call work(session) in its own transaction, commit, and return its result"""
+        if not self.serialize:
+            return await self._execute(work)
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or not self._task or self._task.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._drain())
+        future = loop.create_future()
+        self._queue.put_nowait((work, future))
+        return await future
+    
+    async def _execute(self, work):
+        async with async_session() as session:
+            result = await work(session)
+            await session.commit()
+            return result
+    
+    async def _drain(self):
+        while True:
+            work, future = await self._queue.get()
+            if future.cancelled():
+                continue
+            try:
+                result = await self._execute(work)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+db_writer = DatabaseWriter(serialize=IS_SQLITE)
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    DB_LATENCY.observe(time.perf_counter() - conn.info["query_start"].pop())
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _on_cursor_error(exception_context):
+    # A failed statement never reaches after_cursor_execute: drop its start time so later ones pair up
+    conn = exception_context.connection
+    if conn is not None and exception_context.execution_context is not None and conn.info.get("query_start"):
+        conn.info["query_start"].pop()
+
+def instrument_redis(client):
+    """Time every command sent through client (pipelines count as one EXEC)"""
+    execute = client.execute_command
+    
+    async def timed(*args, **options):
+        started = time.perf_counter()
+        try:
+            return await execute(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(str(args[0]).split()[0].upper()).observe(time.perf_counter() - started)
+    
+    client.execute_command = timed
+    return client
+
+redis_client = instrument_redis(redis.from_url(REDIS_URL))
 storage = RedisStorage(redis_client)
 
 bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher(storage=storage)
+dp.message.middleware(SlowHandlerMiddleware(SLOW_HANDLER_SECONDS))
+dp.callback_query.middleware(SlowHandlerMiddleware(SLOW_HANDLER_SECONDS))
+dp.callback_query.middleware(LongRunningMiddleware())
 
 # Initialize Pyrogram Client for large uploads
 app = PyrogramClient(
@@ -147,6 +617,7 @@ TRANSLATIONS = {
 /help - সাহায্য
 /status - পরিসংখ্যান
 /gdrive - Google Drive সংযুক্ত করুন
+/storage - Default storage রিসেট করুন
 /admin - Admin panel (শুধু admin)
 
 🎯 কিভাবে ব্যবহার করবেন:
@@ -160,6 +631,7 @@ TRANSLATIONS = {
 ✅ 4GB পর্যন্ত upload (Client API)
 ✅ Google Drive backup
 ✅ Fast download
+✅ Playlist / channel URL (একসাথে সব ভিডিও)
 ✅ সর্বোচ্চ গতি
 """,
         "rate_limited": "⚠️ দৈনিক {limit}টি ডাউনলোডের সীমা পূর্ণ!",
@@ -169,12 +641,15 @@ TRANSLATIONS = {
         "select_storage": "💾 Storage অপশন:",
         "downloading": "⏬ ডাউনলোড হচ্ছে... {progress}%",
         "processing": "⚙️ প্রসেসিং...",
+        "queued": "⏳ Queue তে অপেক্ষা করছে... অবস্থান: {position}",
+        "queue_full": "⚠️ সার্ভার ব্যস্ত! কিছুক্ষণ পর আবার চেষ্টা করুন।",
+        "resuming": "🔄 বট রিস্টার্ট হয়েছিল, আগের ডাউনলোড যেখানে থেমেছিল সেখান থেকে চলছে...",
+        "storage_full": "⚠️ সার্ভারে এখন জায়গা নেই! কিছুক্ষণ পর আবার চেষ্টা করুন অথবা ছোট quality বেছে নিন।",
         "uploading": "⏫ আপলোড হচ্ছে... {progress}%",
         "uploading_telegram": "📱 Telegram এ আপলোড হচ্ছে... {progress}%",
         "uploading_gdrive": "☁️ Google Drive এ আপলোড হচ্ছে...",
         "completed": "✅ ডাউনলোড সম্পন্ন!",
         "failed": "❌ ডাউনলোড ব্যর্থ: {error}",
-        "file_info": "📦 File: {size}MB\n\n💾 Storage option চুজ করুন:",
         "gdrive_link": "☁️ আপনার ফাইল প্রস্তুত!\n\n🔗 Link: {url}\n\n📏 Size: {size}MB\n⏰ Valid for 7 days",
         "status": """
 📊 আপনার পরিসংখ্যান
@@ -206,8 +681,12 @@ TRANSLATIONS = {
 
 📊 Statistics:
 • Total Users: {users}
-• Today Downloads: {downloads}
+• আজ: {today_done} ডাউনলোড, {today_failed} ব্যর্থ, {today_new} নতুন user
+• Downloads (since start): {downloads}
 • Active Now: {active}
+• Queued: {queued}
+• Cache Hit Ratio: {cache_hits}
+• Event Loop Lag: {loop_lag}ms
 
 🎛️ Commands:
 /broadcast - সবাইকে message পাঠান
@@ -215,9 +694,21 @@ TRANSLATIONS = {
 /users - User list
 """,
         "not_admin": "⛔ শুধুমাত্র admin access!",
+        "stats_header": "📊 গত {days} দিন:\n",
+        "stats_row": "{day}: ✅ {done} ❌ {failed} 💾 {size_mb}MB 👥 {active} (+{new})",
+        "stats_empty": "📊 এখনো কোনো statistics নেই।",
+        "profile_started": "🔬 {seconds} সেকেন্ড ধরে event loop profile হচ্ছে...",
+        "profile_busy": "🔬 একটি profile ইতিমধ্যে চলছে।",
+        "profile_result": "🔬 Event loop এ সবচেয়ে বেশি সময় (busy samples):\n\n{top}\n\n📎 পুরো stack নিচের ফাইলে (flamegraph.pl / speedscope)।",
         "telegram_direct": "📱 Telegram এ পাঠান (4GB পর্যন্ত)",
         "save_gdrive": "☁️ Google Drive এ সেভ করুন",
+        "always_telegram": "📱 সবসময় Telegram",
+        "always_gdrive": "☁️ সবসময় Google Drive",
+        "storage_reset": "✅ Default storage মুছে ফেলা হয়েছে। পরের ডাউনলোডে আবার জিজ্ঞেস করা হবে।",
         "gdrive_not_connected": "⚠️ Google Drive সংযুক্ত নেই!\n\n/gdrive command দিয়ে সংযুক্ত করুন।",
+        "playlist_progress": "📃 Playlist: {done}/{total} সম্পন্ন, {failed} ব্যর্থ",
+        "playlist_done": "✅ Playlist শেষ! {done}/{total} সম্পন্ন, {failed} ব্যর্থ",
+        "playlist_limited": "⚠️ দৈনিক সীমা পূর্ণ, বাকি ভিডিও বাদ দেওয়া হয়েছে।",
     }
 }
 
@@ -226,14 +717,119 @@ def get_text(user_lang: str, key: str, **kwargs) -> str:
     text = TRANSLATIONS["bn"].get(key, key)
     return text.format(**kwargs)
 
+def _add_missing_columns(conn):
+    """create_all never alters existing tables: add new nullable columns and indexes in place"""
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                logger.info(f"Added column {table.name}.{column.name}")
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
 async def init_db():
     """Initialize database"""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+
+class UserCache:
+    """Read-through cache of user rows: process memory, then Redis, then the database.
+    
+    Activity (last_active, username) is not written per update: touch() records it
+    and flush() writes everything collected since the last flush in one transaction.
+    """
+    
+    KEY = "user:"
+    FIELDS = ("id", "telegram_id", "username", "first_seen", "last_active", "total_downloads",
+              "language", "gdrive_token", "gdrive_folder_id", "is_admin", "default_storage", "tier")
+    
+    def __init__(self, ttl: int, local_ttl: int):
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self._local: Dict[int, tuple] = {}
+        self._dirty: Dict[int, Dict] = {}
+    
+    def _serialize(self, user: User) -> str:
+        data = {field: getattr(user, field) for field in self.FIELDS}
+        data["first_seen"] = user.first_seen.isoformat()
+        data["last_active"] = user.last_active.isoformat()
+        return json.dumps(data)
+    
+    def _deserialize(self, raw_user) -> User:
+        data = json.loads(raw_user)
+        data["first_seen"] = datetime.fromisoformat(data["first_seen"])
+        data["last_active"] = datetime.fromisoformat(data["last_active"])
+        return User(**data)
+    
+    async def get(self, telegram_id: int) -> Optional[User]:
+        now = asyncio.get_running_loop().time()
+        local = self._local.get(telegram_id)
+        if local and local[0] > now:
+            CACHE_REQUESTS.labels("user", "hit").inc()
+            return local[1]
+        if local:
+            del self._local[telegram_id]
+        
+        raw_user = await redis_client.get(f"{self.KEY}{telegram_id}")
+        CACHE_REQUESTS.labels("user", "miss" if raw_user is None else "hit").inc()
+        if raw_user is None:
+            return None
+        user = self._deserialize(raw_user)
+        self._local[telegram_id] = (now + self.local_ttl, user)
+        return user
+    
+    async def put(self, user: User):
+        self._local[user.telegram_id] = (asyncio.get_running_loop().time() + self.local_ttl, user)
+        await redis_client.set(f"{self.KEY}{user.telegram_id}", self._serialize(user), ex=self.ttl)
+    
+    async def invalidate(self, telegram_id: int):
+        self._local.pop(telegram_id, None)
+        await redis_client.delete(f"{self.KEY}{telegram_id}")
+    
+    def touch(self, user: User, username: Optional[str] = None):
+        """Mark activity for the next flush"""
+        user.last_active = datetime.now()
+        row = self._dirty.setdefault(user.id, {"id": user.id})
+        row["last_active"] = user.last_active
+        if username and username != user.username:
+            user.username = username
+            row["username"] = username
+    
+    def prune(self):
+        """Forget expired in-process copies, so memory follows recent users rather than all users ever seen"""
+        now = asyncio.get_running_loop().time()
+        self._local = {key: entry for key, entry in self._local.items() if entry[0] > now}
+    
+    async def flush(self):
+        """Write collected activity as one batched UPDATE by primary key"""
+        self.prune()
+        if not self._dirty:
+            return
+        rows, self._dirty = list(self._dirty.values()), {}
+        try:
+            await db_writer.run(lambda session: session.execute(update(User), rows))
+        except Exception as e:
+            logger.error(f"User activity flush error: {e}")
+            # Keep the rows for the next flush; activity recorded meanwhile is newer and wins
+            for row in rows:
+                self._dirty[row["id"]] = {**row, **self._dirty.get(row["id"], {})}
+
+user_cache = UserCache(USER_CACHE_TTL, USER_CACHE_LOCAL_TTL)
 
 async def get_or_create_user(telegram_id: int, username: Optional[str] = None) -> User:
-    """Get or create user"""
-    async with async_session() as session:
+    """Get or create user; cached, so most calls never reach the database"""
+    user = await user_cache.get(telegram_id)
+    if user:
+        user_cache.touch(user, username)
+        return user
+    
+    async def load(session):
         result = await session.execute(
             select(User).where(User.telegram_id == telegram_id)
         )
@@ -254,44 +850,322 @@ async def get_or_create_user(telegram_id: int, username: Optional[str] = None) -
             if username:
                 user.username = username
         
-        await session.commit()
+        await session.flush()
         await session.refresh(user)
         return user
+    
+    user = await db_writer.run(load)
+    await user_cache.put(user)
+    return user
+
+async def update_user(telegram_id: int, **values):
+    """Write user fields and drop the cached copy so the next read sees them"""
+    await db_writer.run(
+        lambda session: session.execute(update(User).where(User.telegram_id == telegram_id).values(**values))
+    )
+    await user_cache.invalidate(telegram_id)
+
+async def flush_user_activity():
+    """Periodic write-behind of user activity"""
+    while True:
+        await asyncio.sleep(USER_FLUSH_INTERVAL)
+        await user_cache.flush()
 
-async def check_rate_limit(user_id: int) -> bool:
-    """Check if user is within rate limit"""
-    key = f"rate_limit:{user_id}:{datetime.now().date()}"
-    count = await redis_client.get(key)
+# Sliding window: a sorted set of hit timestamps, trimmed to the window on every call
+_SLIDING_WINDOW_LUA = """
+local now, window, limit, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local used = redis.call('ZCARD', KEYS[1])
+local allowed = limit <= 0 or used + math.max(cost, 1) <= limit
+if allowed and cost > 0 then
+    for i = 1, cost do
+        redis.call('ZADD', KEYS[1], now, ARGV[5] .. ':' .. i)
+    end
+    used = used + cost
+end
+redis.call('PEXPIRE', KEYS[1], window)
+return {allowed and 1 or 0, used}
+"""
+
+# Token bucket: limit tokens refilled evenly over the window, so bursts are allowed up to the limit
+_TOKEN_BUCKET_LUA = """
+local now, window, limit, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+if limit <= 0 then
+    return {1, 0}
+end
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or limit
+local ts = tonumber(state[2]) or now
+tokens = math.min(limit, tokens + (now - ts) * limit / window)
+local allowed = tokens >= math.max(cost, 1)
+if allowed and cost > 0 then
+    tokens = tokens - cost
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], window)
+return {allowed and 1 or 0, math.ceil(limit - tokens)}
+"""
+
+class RateLimiter:
+    """Per-user download limits: check, consume and count in one atomic round trip"""
+    KEY = "rate_limit:"
     
-    if count is None:
-        await redis_client.setex(key, 86400, 1)
-        return True
+    def __init__(self, client, policy: str, window: int, default_limit: int, tiers: Dict[str, int]):
+        self.client = client
+        self.policy = policy
+        self.window_ms = window * 1000
+        self.limits = {"free": default_limit, **tiers}
+        script = _TOKEN_BUCKET_LUA if policy == "bucket" else _SLIDING_WINDOW_LUA
+        self._script = client.register_script(script)
     
-    count = int(count)
-    if count >= RATE_LIMIT_PER_USER_PER_DAY:
-        return False
+    def limit_for(self, tier: str) -> int:
+        return self.limits.get(tier, self.limits["free"])
     
-    await redis_client.incr(key)
-    return True
+    async def hit(self, user_id: int, tier: str = "free", cost: int = 1) -> tuple:
+        """Consume cost (0 only peeks); returns (allowed, used in the current window)"""
+        now = int(datetime.now().timestamp() * 1000)
+        allowed, used = await self._script(
+            keys=[f"{self.KEY}{self.policy}:{user_id}"],
+            args=[now, self.window_ms, self.limit_for(tier), cost, f"{now}-{os.urandom(4).hex()}"]
+        )
+        return bool(allowed), int(used)
+
+rate_limiter = RateLimiter(
+    redis_client, RATE_LIMIT_POLICY, RATE_LIMIT_WINDOW, RATE_LIMIT_PER_USER_PER_DAY, RATE_LIMIT_TIERS
+)
+
+def user_tier(user: User) -> str:
+    """Rate limit tier of a user"""
+    if user.is_admin:
+        return "admin"
+    return user.tier or "free"
+
+async def check_rate_limit(user_id: int, tier: str = "free") -> bool:
+    """Check if user is within rate limit, counting this download if so"""
+    allowed, _ = await rate_limiter.hit(user_id, tier)
+    return allowed
+
+async def get_today_downloads(user_id: int, tier: str = "free") -> int:
+    """Get the download count in the current rate limit window"""
+    _, used = await rate_limiter.hit(user_id, tier, cost=0)
+    return used
 
-async def get_today_downloads(user_id: int) -> int:
-    """Get today's download count"""
-    key = f"rate_limit:{user_id}:{datetime.now().date()}"
-    count = await redis_client.get(key)
-    return int(count) if count else 0
+YOUTUBE_REGEX = re.compile(r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})')
 
 def is_valid_youtube_url(url: str) -> bool:
     """Validate YouTube URL"""
-    youtube_regex = r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
-    return bool(re.match(youtube_regex, url))
+    return bool(YOUTUBE_REGEX.match(url))
+
+PLAYLIST_REGEX = re.compile(
+    r'(https?://)?(www\.|m\.)?youtube\.com/'
+    r'(playlist\?list=[\w-]+|(@[\w.-]+|channel/[\w-]+|c/[\w.-]+|user/[\w.-]+)(/(videos|shorts|streams))?/?$)'
+)
+
+def is_playlist_url(url: str) -> bool:
+    """Playlist or channel URL (a watch URL with &list= is still one video)"""
+    return bool(PLAYLIST_REGEX.match(url))
+
+def extract_video_id(url: str) -> Optional[str]:
+    """Canonical 11-character YouTube video ID"""
+    match = YOUTUBE_REGEX.match(url)
+    return match.group(6) if match else None
+
+class ResultCache:
+    """Finished uploads keyed by video ID + format + quality, with TTL and LRU eviction.
+    
+    Telegram file_ids work for every chat; Drive files live in one user's Drive,
+    so their fields are stored per user (see drive_fields).
+    """
+    LRU = "result:lru"
+    
+    def __init__(self, client, ttl: int, max_entries: int):
+        self.client = client
+        self.ttl = ttl
+        self.max_entries = max_entries
+    
+    def _key(self, video_id: str, format_type: str, quality: str) -> str:
+        return f"result:{video_id}:{format_type}:{quality}"
+    
+    async def get(self, video_id: Optional[str], format_type: str, quality: str) -> Dict[str, str]:
+        """Cached telegram_file_id / size_mb / per-user Drive fields, or {}"""
+        if not video_id:
+            return {}
+        key = self._key(video_id, format_type, quality)
+        try:
+            data = await self.client.hgetall(key)
+            CACHE_REQUESTS.labels("result", "hit" if data else "miss").inc()
+            if data:
+                await self.client.zadd(self.LRU, {key: datetime.now().timestamp()})
+            return {k.decode(): v.decode() for k, v in data.items()}
+        except Exception as e:
+            logger.error(f"Result cache read error: {e}")
+            return {}
+    
+    async def put(self, video_id: Optional[str], format_type: str, quality: str, **fields):
+        if not video_id:
+            return
+        key = self._key(video_id, format_type, quality)
+        fields = {k: str(v) for k, v in fields.items() if v is not None}
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping=fields)
+                pipe.expire(key, self.ttl)
+                pipe.zadd(self.LRU, {key: datetime.now().timestamp()})
+                pipe.zcard(self.LRU)
+                *_, size = await pipe.execute()
+            
+            if size > self.max_entries:
+                evicted = await self.client.zpopmin(self.LRU, size - self.max_entries)
+                if evicted:
+                    await self.client.delete(*(k for k, _ in evicted))
+        except Exception as e:
+            logger.error(f"Result cache write error: {e}")
+
+    @staticmethod
+    def drive_fields(telegram_id: int) -> tuple:
+        """Field names for the Drive file id and link of one user's copy"""
+        return f"gdrive_file_id:{telegram_id}", f"gdrive_link:{telegram_id}"
+
+result_cache = ResultCache(redis_client, RESULT_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES)
+
+class MetadataCache:
+    """Unprocessed yt-dlp info dicts by video ID, compressed, expiring before their URLs do"""
+    
+    def __init__(self, client, ttl: int):
+        self.client = client
+        self.ttl = ttl
+    
+    async def get(self, video_id: Optional[str]) -> Optional[dict]:
+        if not video_id:
+            return None
+        try:
+            data = await self.client.get(f"meta:{video_id}")
+            CACHE_REQUESTS.labels("metadata", "hit" if data else "miss").inc()
+            return json.loads(zlib.decompress(data)) if data else None
+        except Exception as e:
+            logger.error(f"Metadata cache read error: {e}")
+            return None
+    
+    async def put(self, video_id: Optional[str], info: dict):
+        if not video_id:
+            return
+        try:
+            data = zlib.compress(json.dumps(info).encode())
+            await self.client.set(f"meta:{video_id}", data, ex=self.ttl)
+        except Exception as e:
+            logger.error(f"Metadata cache write error: {e}")
+
+metadata_cache = MetadataCache(redis_client, METADATA_CACHE_TTL)
+
+class ProgressHub:
+    """Coalesces status edits: latest text per message, flushed at a bot-wide rate"""
+    def __init__(self, rate: float = PROGRESS_EDITS_PER_SECOND, min_interval: float = PROGRESS_MIN_INTERVAL):
+        self.interval = 1 / rate
+        self.min_interval = min_interval
+        self._pending: Dict[int, tuple] = {}  # id(message) -> (message, text), oldest first
+        self._sent: Dict[int, list] = {}  # id(message) -> [message, text, sent_at, closed]
+        self._editing: Optional[tuple] = None  # (key, future) of the edit in flight
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+    
+    def post(self, message, text: str):
+        """Queue text for message; safe to call from any thread, only the latest text is kept"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if self._loop:
+                self._loop.call_soon_threadsafe(self._post, message, text)
+            return
+        if loop is not self._loop or not self._task or self._task.done():
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._flush())
+        self._post(message, text)
+    
+    def _post(self, message, text: str):
+        key = id(message)
+        sent = self._sent.get(key)
+        if sent and sent[3]:
+            return
+        if isinstance(message, StatusFanout):
+            # Only real messages take a rate slot: queue each requester's edit directly
+            for target in list(message.messages):
+                self._post(target, text)
+            return
+        if sent and sent[1] == text:
+            self._pending.pop(key, None)
+            return
+        self._pending[key] = (message, text)
+        self._wakeup.set()
+    
+    def drop(self, message):
+        """Forget pending edits for message and ignore later ones"""
+        key = id(message)
+        self._pending.pop(key, None)
+        self._sent[key] = [message, None, time.monotonic(), True]
+    
+    async def close(self, message):
+        """drop(), then wait out an edit already in flight; call before a message's final edit"""
+        self.drop(message)
+        key = id(message)
+        if self._editing and self._editing[0] == key:
+            await asyncio.wait([self._editing[1]])
+    
+    def _next(self, now: float):
+        """Oldest pending message allowed an edit now, or how long until one is"""
+        wait = None
+        for key in self._pending:
+            sent = self._sent.get(key)
+            ready_at = sent[2] + self.min_interval if sent else now
+            if ready_at <= now:
+                return key, 0
+            wait = ready_at - now if wait is None else min(wait, ready_at - now)
+        return None, wait
+    
+    def _prune(self, now: float):
+        for key, sent in list(self._sent.items()):
+            if key not in self._pending and now - sent[2] > 600:
+                del self._sent[key]
+    
+    async def _flush(self):
+        while True:
+            now = time.monotonic()
+            key, wait = self._next(now)
+            if key is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            message, text = self._pending.pop(key)
+            self._sent[key] = [message, text, now, False]
+            self._editing = (key, asyncio.ensure_future(message.edit_text(text)))
+            try:
+                await self._editing[1]
+            except TelegramRetryAfter as e:
+                logger.warning(f"Progress edits flood-limited for {e.retry_after}s")
+                self._sent[key][1] = None
+                self._pending.setdefault(key, (message, text))
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.debug(f"Progress edit skipped: {e}")
+            finally:
+                self._editing = None
+            
+            if len(self._sent) > 1000:
+                self._prune(now)
+            await asyncio.sleep(self.interval)
+
+progress_hub = ProgressHub()
 
 class DownloadProgress:
-    """Track download progress"""
+    """Track download progress (called on the event loop by download_video)"""
     def __init__(self, message: types.Message, user_lang: str):
         self.message = message
         self.user_lang = user_lang
-        self.last_update = 0
-        self.last_percent = 0
     
     def __call__(self, d):
         if d['status'] == 'downloading':
@@ -302,239 +1176,1698 @@ class DownloadProgress:
                 except:
                     percent = 0
                 
-                current_time = asyncio.get_event_loop().time()
-                
-                if (abs(percent - self.last_percent) >= 5 or 
-                    current_time - self.last_update > 3):
-                    self.last_update = current_time
-                    self.last_percent = percent
-                    asyncio.create_task(
-                        self.message.edit_text(
-                            get_text(self.user_lang, "downloading", 
-                                   progress=f"{percent:.0f}")
-                        )
-                    )
+                progress_hub.post(
+                    self.message,
+                    get_text(self.user_lang, "downloading", progress=f"{percent:.0f}")
+                )
+                checkpoint_job(progress=int(percent))
             except Exception as e:
                 logger.error(f"Progress update error: {e}")
 
-async def get_gdrive_service(user: User):
-    """Get Google Drive service for user"""
-    if not user.gdrive_token:
-        return None
+class DownloadHandle:
+    """Async handle for a job running in the download pool: await, cancel, progress"""
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._future: Optional[asyncio.Future] = None
+        self._cancelled = threading.Event()
+        self._latest: Optional[dict] = None
+        self._changed = asyncio.Event()
     
-    try:
-        creds = pickle.loads(user.gdrive_token.encode('latin1'))
+    def hook(self, d: dict):
+        """yt-dlp progress hook, runs in the worker thread"""
+        if self._cancelled.is_set():
+            raise yt_dlp.utils.DownloadCancelled()
+        self._loop.call_soon_threadsafe(self._publish, d)
+    
+    def _publish(self, d: Optional[dict]):
+        # Only the latest state is kept, so a slow consumer never builds a backlog
+        if d is not None:
+            self._latest = d
+        self._changed.set()
+    
+    def _attach(self, future):
+        self._future = asyncio.wrap_future(future, loop=self._loop)
+        self._future.add_done_callback(lambda _: self._publish(None))
+    
+    def done(self) -> bool:
+        return self._future.done()
+    
+    def cancel(self):
+        """Cancel the job; a running download aborts at its next progress hook"""
+        self._cancelled.set()
+        self._future.cancel()
+    
+    async def progress(self):
+        """Yield progress dicts until the job finishes"""
+        while True:
+            if self._latest is None:
+                if self._future.done():
+                    return
+                await self._changed.wait()
+                self._changed.clear()
+                continue
+            d, self._latest = self._latest, None
+            yield d
+    
+    def __await__(self):
+        return self._future.__await__()
+
+class DownloadExecutor:
+    """Bounded thread pool that runs blocking yt-dlp jobs off the event loop"""
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ytdl")
+        self._handles: set = set()
+    
+    @property
+    def active(self) -> int:
+        return sum(1 for handle in self._handles if not handle.done())
+    
+    def submit(self, fn, *args) -> DownloadHandle:
+        """Run fn(*args, progress_hook) in the pool and return its handle"""
+        handle = DownloadHandle(asyncio.get_running_loop())
+        handle._attach(self._pool.submit(fn, *args, handle.hook))
+        self._handles.add(handle)
+        handle._future.add_done_callback(lambda _: self._handles.discard(handle))
+        return handle
+    
+    def shutdown(self):
+        """Cancel queued and running jobs and release the pool"""
+        for handle in list(self._handles):
+            handle.cancel()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+download_executor = DownloadExecutor(DOWNLOAD_WORKERS)
+
+class Transfer:
+    """Bandwidth state of one running download; params is its live YoutubeDL.params"""
+    def __init__(self, params: dict):
+        self.params = params
+        self.fragmented = False  # current format comes in fragments (DASH/HLS) rather than one HTTP stream
+        self.fragments = 1  # connections allotted
+        self.speed: Optional[float] = None  # smoothed bytes/s
+
+class BandwidthManager:
+    """Splits a connection budget across running downloads and tunes each from its throughput.
+    
+    yt-dlp reads concurrent_fragment_downloads, http_chunk_size and ratelimit from the
+    params dict it shares with its downloaders, so values written there apply to the
+    job's next format (and, for ratelimit on plain HTTP, immediately).
+    """
+    
+    def __init__(self, budget: int, max_fragments: int, rate_limit: float):
+        self.budget = budget
+        self.max_fragments = max_fragments
+        self.rate_limit = rate_limit  # bytes/s per job, 0 = unlimited
+        self._transfers: List[Transfer] = []
+        self._lock = threading.Lock()  # called from the download threads
+        self._rebalanced = 0.0
+    
+    def open(self, params: dict) -> Transfer:
+        transfer = Transfer(params)
+        with self._lock:
+            self._transfers.append(transfer)
+            self._rebalance()
+        return transfer
+    
+    def close(self, transfer: Transfer):
+        with self._lock:
+            if transfer in self._transfers:
+                self._transfers.remove(transfer)
+            self._rebalance()
+    
+    def start_format(self, transfer: Transfer, info: dict):
+        """Called right before yt-dlp creates the downloader for a format"""
+        protocol = info.get('protocol') or ''
+        with self._lock:
+            transfer.fragmented = bool(info.get('fragments')) or 'm3u8_native' in protocol or 'dash' in protocol
+            self._rebalance()
+    
+    def sample(self, transfer: Transfer, d: dict):
+        """Feed a yt-dlp progress dict; rebalances every couple of seconds"""
+        speed = d.get('speed')
+        if d.get('status') != 'downloading' or not speed:
+            return
+        with self._lock:
+            transfer.speed = speed if transfer.speed is None else 0.7 * transfer.speed + 0.3 * speed
+            if time.monotonic() - self._rebalanced >= 2:
+                self._rebalance()
+    
+    def _demand(self, transfer: Transfer) -> int:
+        """Connections a transfer can use: 1 for a plain HTTP stream, enough to reach the cap otherwise"""
+        if not transfer.fragmented:
+            return 1
+        if self.rate_limit and transfer.speed:
+            per_connection = transfer.speed / transfer.fragments
+            return max(1, min(self.max_fragments, math.ceil(self.rate_limit / per_connection)))
+        return self.max_fragments
+    
+    def _rebalance(self):
+        """Water-fill the budget: small demands are met in full, the rest share what is left evenly"""
+        self._rebalanced = time.monotonic()
+        transfers = sorted(self._transfers, key=self._demand)
+        remaining = self.budget
+        for i, transfer in enumerate(transfers):
+            share = max(1, remaining // (len(transfers) - i))
+            transfer.fragments = min(self._demand(transfer), share)
+            remaining -= transfer.fragments
+            self._apply(transfer)
+        DOWNLOAD_CONNECTIONS_USED.set(sum(transfer.fragments for transfer in transfers))
+    
+    def _apply(self, transfer: Transfer):
+        params = transfer.params
+        params['concurrent_fragment_downloads'] = transfer.fragments
         
-        if creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-            async with async_session() as session:
-                result = await session.execute(
-                    select(User).where(User.telegram_id == user.telegram_id)
-                )
-                db_user = result.scalar_one()
-                db_user.gdrive_token = pickle.dumps(creds).decode('latin1')
-                await session.commit()
+        chunk_mb = HTTP_CHUNK_MAX_MB
+        if transfer.speed:
+            chunk_mb = int(transfer.speed * HTTP_CHUNK_SECONDS / (1024 * 1024))
+        params['http_chunk_size'] = max(HTTP_CHUNK_MIN_MB, min(HTTP_CHUNK_MAX_MB, chunk_mb)) * 1024 * 1024
         
-        return build('drive', 'v3', credentials=creds)
-    except Exception as e:
-        logger.error(f"GDrive service error: {e}")
+        # Each fragment connection is throttled on its own, so a fragmented job's cap is split across them
+        if self.rate_limit:
+            params['ratelimit'] = self.rate_limit / (transfer.fragments if transfer.fragmented else 1)
+
+bandwidth_manager = BandwidthManager(DOWNLOAD_CONNECTIONS, DOWNLOAD_MAX_FRAGMENTS, DOWNLOAD_RATE_LIMIT_MB * 1024 * 1024)
+# ffmpeg runs here, never on a download thread: at most POSTPROCESS_WORKERS x POSTPROCESS_THREADS busy cores
+postprocess_pool = ThreadPoolExecutor(max_workers=POSTPROCESS_WORKERS, thread_name_prefix="ffmpeg")
+
+class DriveError(Exception):
+    """Google Drive API request failed"""
+    
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+def _range_end(header: Optional[str]) -> int:
+    """Last byte Drive has stored, from a 308 Range header ("bytes=0-N"); -1 if none"""
+    if not header:
+        return -1
+    return int(header.rsplit("-", 1)[1])
+
+class DriveUploader:
+    """Resumable Drive uploads over one pooled aiohttp session.
+    
+    Chunks of one upload are sequential (Drive requires it), but uploads of
+    different users run side by side up to max_parallel. Session URIs are kept
+    in Redis under resume_key so a restarted bot continues from the last
+    acknowledged byte instead of from zero.
+    """
+    
+    SESSION_PREFIX = "gdrive:session:"
+    
+    def __init__(self, max_parallel: int, chunk_mb: int, max_chunk_mb: int,
+                 upload_url: str = GDRIVE_UPLOAD_URL, files_url: str = GDRIVE_FILES_URL):
+        self.upload_url = upload_url
+        self.files_url = files_url
+        self.chunk_start = max(GDRIVE_CHUNK_ALIGN, chunk_mb * 1024 * 1024 // GDRIVE_CHUNK_ALIGN * GDRIVE_CHUNK_ALIGN)
+        self.chunk_max = max(self.chunk_start, max_chunk_mb * 1024 * 1024)
+        self.max_parallel = max_parallel
+        self._slots = asyncio.Semaphore(max_parallel)
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_parallel * 2, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+            )
+        return self._session
+    
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+    
+    async def _request(self, method: str, url: str, token_provider, **kwargs):
+        """Send an authorized request, refreshing the token once on 401"""
+        for force in (False, True):
+            headers = dict(kwargs.pop("headers", None) or {})
+            headers["Authorization"] = f"Bearer {await token_provider(force)}"
+            resp = await self.session.request(method, url, headers=headers, **kwargs)
+            if resp.status != 401 or force:
+                return resp
+            resp.release()
+            kwargs["headers"] = {k: v for k, v in headers.items() if k != "Authorization"}
+    
+    async def _json(self, method: str, url: str, token_provider, **kwargs) -> dict:
+        async with await self._request(method, url, token_provider, **kwargs) as resp:
+            if resp.status >= 400:
+                raise DriveError(f"{method} {url}: {resp.status} {await resp.text()}", resp.status)
+            return await resp.json()
+    
+    async def find_or_create_folder(self, token_provider, name: str) -> str:
+        """Folder id for name in the user's Drive, creating it on first use"""
+        found = await self._json("GET", self.files_url, token_provider, params={
+            "q": f"name='{name}' and mimeType='application/vnd.google-apps.folder' and trashed=false",
+            "spaces": "drive",
+            "fields": "files(id, name)"
+        })
+        if found.get("files"):
+            return found["files"][0]["id"]
+        folder = await self._json("POST", self.files_url, token_provider, params={"fields": "id"}, json={
+            "name": name,
+            "mimeType": "application/vnd.google-apps.folder"
+        })
+        return folder["id"]
+    
+    async def share(self, token_provider, file_id: str):
+        """Make a file readable by anyone with the link"""
+        await self._json("POST", f"{self.files_url}/{file_id}/permissions", token_provider,
+                         json={"type": "anyone", "role": "reader"})
+    
+    async def _start(self, token_provider, folder_id: str, name: str,
+                     total_size: Optional[int]) -> str:
+        headers = {"X-Upload-Content-Type": "application/octet-stream"}
+        if total_size is not None:
+            headers["X-Upload-Content-Length"] = str(total_size)
+        async with await self._request(
+            "POST", self.upload_url, token_provider, headers=headers,
+            params={"uploadType": "resumable", "fields": "id, webViewLink, size"},
+            json={"name": name, "parents": [folder_id]}
+        ) as resp:
+            if resp.status != 200:
+                raise DriveError(f"Resumable session refused: {resp.status} {await resp.text()}", resp.status)
+            return resp.headers["Location"]
+    
+    async def _put(self, session_uri: str, token_provider, data: bytes, content_range: str):
+        """PUT one chunk; returns (status, acked offset or finished file dict)"""
+        async with await self._request(
+            "PUT", session_uri, token_provider, data=data,
+            headers={"Content-Range": content_range}
+        ) as resp:
+            if resp.status in (200, 201):
+                return resp.status, await resp.json()
+            if resp.status == 308:
+                return resp.status, _range_end(resp.headers.get("Range")) + 1
+            return resp.status, await resp.text()
+    
+    async def _status(self, session_uri: str, token_provider, total_size: Optional[int]):
+        """Ask Drive how far an interrupted session got"""
+        total = str(total_size) if total_size is not None else "*"
+        return await self._put(session_uri, token_provider, b"", f"bytes */{total}")
+    
+    async def upload(self, token_provider, folder_id: str, name: str, source,
+                     total_size: Optional[int] = None, resume_key: Optional[str] = None,
+                     on_progress=None) -> dict:
+        """Upload from source (anything with async read(n); seek(n) too if resumable).
+        
+        total_size may be None for streams; the length is then declared with the
+        last chunk. Returns the Drive file resource (id, webViewLink, size).
+        """
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            key = f"{self.SESSION_PREFIX}{resume_key}" if resume_key else None
+            session_uri = None
+            offset = 0
+            
+            if key and (stored := await redis_client.get(key)):
+                session_uri = stored.decode() if isinstance(stored, bytes) else stored
+                status, result = await self._status(session_uri, token_provider, total_size)
+                if status in (200, 201):
+                    await redis_client.delete(key)
+                    return result
+                if status == 308:
+                    offset = result
+                    await source.seek(offset)
+                    logger.info(f"Resuming Drive upload {name} at {offset / (1024*1024):.1f}MB")
+                else:
+                    session_uri = None
+            
+            if not session_uri:
+                session_uri = await self._start(token_provider, folder_id, name, total_size)
+                if key:
+                    await redis_client.set(key, session_uri, ex=GDRIVE_SESSION_TTL)
+            
+            chunk_size = self.chunk_start
+            carry = b""
+            failures = 0
+            
+            while True:
+                # A chunk shrunk after a failure may still owe more carried bytes than it holds: send those first
+                size = max(chunk_size, len(carry))
+                data = carry
+                if size > len(carry):
+                    data += await source.read(size - len(carry))
+                last = len(data) < size or (
+                    total_size is not None and offset + len(data) >= total_size
+                )
+                total = str(offset + len(data)) if last else (
+                    str(total_size) if total_size is not None else "*"
+                )
+                content_range = f"bytes {offset}-{offset + len(data) - 1}/{total}" if data else f"bytes */{total}"
+                
+                started = loop.time()
+                try:
+                    status, result = await self._put(session_uri, token_provider, data, content_range)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status, result = 0, str(e)
+                elapsed = loop.time() - started
+                
+                if status in (200, 201):
+                    if key:
+                        await redis_client.delete(key)
+                    if on_progress:
+                        on_progress(offset + len(data))
+                    return result
+                
+                if status != 308:
+                    # Transient (5xx, 429, dropped connection): back off, then resync with Drive
+                    if status and status < 500 and status != 429:
+                        raise DriveError(f"Chunk upload failed: {status} {result}")
+                    failures += 1
+                    if failures > GDRIVE_MAX_RETRIES:
+                        raise DriveError(f"Chunk upload failed after {failures} attempts: {status} {result}")
+                    await asyncio.sleep(min(2 ** failures, 30))
+                    chunk_size = max(GDRIVE_CHUNK_ALIGN, chunk_size // 2 // GDRIVE_CHUNK_ALIGN * GDRIVE_CHUNK_ALIGN)
+                    status, result = await self._status(session_uri, token_provider, None)
+                    if status in (200, 201):
+                        if key:
+                            await redis_client.delete(key)
+                        return result
+                    if status != 308:
+                        raise DriveError(f"Upload session lost: {status} {result}")
+                    # Only bytes still in hand can be resent
+                    acked = max(offset, min(result, offset + len(data)))
+                else:
+                    failures = 0
+                    acked = result
+                    # Adapt: fast chunks grow, slow ones shrink, always 256 KiB aligned
+                    if elapsed < 2 and chunk_size * 2 <= self.chunk_max:
+                        chunk_size *= 2
+                    elif elapsed > 10 and chunk_size > self.chunk_start:
+                        chunk_size //= 2
+                
+                carry = data[acked - offset:]
+                offset = acked
+                if on_progress:
+                    on_progress(offset)
+
+drive_uploader = DriveUploader(GDRIVE_MAX_PARALLEL_UPLOADS, GDRIVE_CHUNK_MB, GDRIVE_MAX_CHUNK_MB)
+
+# Per-user token providers, keyed by the pickled credentials they were built from
+_gdrive_tokens: Dict[int, tuple] = {}
+
+async def get_gdrive_token_provider(user: User):
+    """Access-token coroutine for the user's Drive, refreshing off the event loop"""
+    if not user.gdrive_token:
         return None
+    
+    cached = _gdrive_tokens.get(user.telegram_id)
+    if cached and cached[0] == user.gdrive_token:
+        return cached[1]
+    
+    creds = pickle.loads(user.gdrive_token.encode('latin1'))
+    lock = asyncio.Lock()
+    
+    async def token(force: bool = False) -> str:
+        async with lock:
+            if (force or creds.expired or not creds.token) and creds.refresh_token:
+                await asyncio.to_thread(creds.refresh, Request())
+                pickled = pickle.dumps(creds).decode('latin1')
+                _gdrive_tokens[user.telegram_id] = (pickled, token)
+                await update_user(user.telegram_id, gdrive_token=pickled)
+            return creds.token
+    
+    _gdrive_tokens[user.telegram_id] = (user.gdrive_token, token)
+    return token
 
-async def get_or_create_gdrive_folder(service) -> str:
-    """Get or create YTDL folder in Google Drive"""
+async def get_or_create_gdrive_folder(user: User, token_provider, refresh: bool = False) -> Optional[str]:
+    """Get or create YTDL folder in Google Drive; the id is stored so lookups happen once"""
+    if user.gdrive_folder_id and not refresh:
+        return user.gdrive_folder_id
+    
     try:
-        results = service.files().list(
-            q=f"name='{GDRIVE_FOLDER_NAME}' and mimeType='application/vnd.google-apps.folder' and trashed=false",
-            spaces='drive',
-            fields='files(id, name)'
-        ).execute()
-        
-        folders = results.get('files', [])
-        
-        if folders:
-            return folders[0]['id']
-        
-        file_metadata = {
-            'name': GDRIVE_FOLDER_NAME,
-            'mimeType': 'application/vnd.google-apps.folder'
-        }
-        folder = service.files().create(
-            body=file_metadata,
-            fields='id'
-        ).execute()
-        
-        return folder.get('id')
+        folder_id = await drive_uploader.find_or_create_folder(token_provider, GDRIVE_FOLDER_NAME)
+        
+        await update_user(user.telegram_id, gdrive_folder_id=folder_id)
+        user.gdrive_folder_id = folder_id
+        return folder_id
     except Exception as e:
         logger.error(f"GDrive folder error: {e}")
         return None
 
-async def upload_to_gdrive(file_path: Path, user: User, status_msg: types.Message) -> Optional[str]:
-    """Upload file to Google Drive"""
+async def upload_to_gdrive(file_path: Path, user: User, status_msg: types.Message,
+                           source=None) -> Optional[Dict]:
+    """Upload file (or a stream passed as source) to Google Drive, returning its id and webViewLink"""
     try:
-        service = await get_gdrive_service(user)
-        if not service:
-            return None
-        
-        folder_id = await get_or_create_gdrive_folder(service)
-        if not folder_id:
+        token_provider = await get_gdrive_token_provider(user)
+        if not token_provider:
             return None
         
-        await status_msg.edit_text(get_text(user.language, "uploading_gdrive"))
+        progress_hub.post(status_msg, get_text(user.language, "uploading_gdrive"))
         
-        file_metadata = {
-            'name': file_path.name,
-            'parents': [folder_id]
-        }
-        
-        media = MediaFileUpload(
-            str(file_path),
-            resumable=True,
-            chunksize=10*1024*1024
-        )
-        
-        file = service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id, webViewLink'
-        ).execute()
-        
-        permission = {
-            'type': 'anyone',
-            'role': 'reader'
-        }
-        service.permissions().create(
-            fileId=file.get('id'),
-            body=permission
-        ).execute()
+        for refresh in (False, True):
+            folder_id = await get_or_create_gdrive_folder(user, token_provider, refresh)
+            if not folder_id:
+                return None
+            
+            try:
+                with track_phase("upload_gdrive") as phase:
+                    if source is not None:
+                        file = await drive_uploader.upload(token_provider, folder_id, file_path.name, source)
+                    else:
+                        size = file_path.stat().st_size
+                        async with aiofiles.open(file_path, 'rb') as f:
+                            file = await drive_uploader.upload(
+                                token_provider, folder_id, file_path.name, f, total_size=size,
+                                resume_key=f"{user.telegram_id}:{file_path.name}:{size}"
+                            )
+                    phase['bytes'] = int(file.get('size') or 0)
+                break
+            except DriveError as e:
+                # Stored folder was deleted from Drive: look it up (or recreate it) once more
+                if e.status != 404 or refresh:
+                    raise
+                logger.info(f"GDrive folder {folder_id} missing for {user.telegram_id}, looking it up again")
         
-        return file.get('webViewLink')
+        await drive_uploader.share(token_provider, file['id'])
+        return file
     
     except Exception as e:
         logger.error(f"GDrive upload error: {e}")
         return None
 
+class ClientPool:
+    """Pyrogram sessions shared by all uploads: least loaded first, flood-waited ones skipped"""
+    
+    def __init__(self, clients: List[PyrogramClient]):
+        self.clients = list(clients)
+        self._load = [0] * len(self.clients)
+        self._resume_at = [0.0] * len(self.clients)
+    
+    async def start(self):
+        for client in self.clients:
+            await client.start()
+    
+    async def stop(self):
+        for client in self.clients:
+            if client.is_connected:
+                await client.stop()
+    
+    def flood_wait(self, client: PyrogramClient, seconds: float):
+        """Keep new uploads off a session until Telegram lets it send again"""
+        i = self.clients.index(client)
+        self._resume_at[i] = max(self._resume_at[i], asyncio.get_running_loop().time() + seconds)
+        logger.warning(f"Pyrogram session {i} flood-waited for {seconds}s")
+    
+    @asynccontextmanager
+    async def lease(self):
+        """Borrow the least loaded session that is not flood-waited"""
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            ready = [i for i, t in enumerate(self._resume_at) if t <= now]
+            if ready:
+                break
+            await asyncio.sleep(min(self._resume_at) - now)
+        
+        i = min(ready, key=lambda k: self._load[k])
+        self._load[i] += 1
+        try:
+            yield self.clients[i]
+        finally:
+            self._load[i] -= 1
+    
+    async def call(self, fn):
+        """Run fn(client) on a pooled session, moving to another one on FloodWait"""
+        for attempt in range(TG_FLOOD_RETRIES):
+            async with self.lease() as client:
+                try:
+                    return await fn(client)
+                except FloodWait as e:
+                    self.flood_wait(client, e.value)
+                    if attempt == TG_FLOOD_RETRIES - 1:
+                        raise
+
+telegram_pool = ClientPool([app] + [
+    PyrogramClient(
+        f"yt_bot_session_{i}",
+        api_id=API_ID,
+        api_hash=API_HASH,
+        bot_token=TELEGRAM_TOKEN
+    )
+    for i in range(1, PYROGRAM_SESSIONS)
+])
+
 async def upload_large_file_pyrogram(file_path: Path, chat_id: int, caption: str, 
                                      status_msg: types.Message, user_lang: str, 
-                                     is_audio: bool = False) -> bool:
-    """Upload large files using Pyrogram (up to 4GB)"""
+                                     is_audio: bool = False) -> Optional[str]:
+    """Upload large files using Pyrogram (up to 4GB), returning the Telegram file_id"""
     try:
         logger.info(f"Starting Pyrogram upload: {file_path.name} ({file_path.stat().st_size / (1024*1024):.1f}MB)")
         
         # Progress callback
-        last_update = [0]
         async def progress(current, total):
-            try:
-                percent = (current / total) * 100
-                current_time = asyncio.get_event_loop().time()
-                
-                if current_time - last_update[0] > 3:  # Update every 3 seconds
-                    last_update[0] = current_time
-                    await status_msg.edit_text(
-                        get_text(user_lang, "uploading_telegram", progress=f"{percent:.0f}")
-                    )
-            except Exception as e:
-                logger.error(f"Progress callback error: {e}")
+            percent = (current / total) * 100
+            progress_hub.post(status_msg, get_text(user_lang, "uploading_telegram", progress=f"{percent:.0f}"))
         
-        # Upload based on file type
-        if is_audio:
-            await app.send_audio(
-                chat_id=chat_id,
-                audio=str(file_path),
-                caption=caption,
-                progress=progress
-            )
-        else:
-            await app.send_video(
-                chat_id=chat_id,
-                video=str(file_path),
-                caption=caption,
-                supports_streaming=True,
-                progress=progress
-            )
+        # Upload based on file type; Pyrogram already sends big-file parts in parallel per session
+        with track_phase("upload_telegram") as phase:
+            if is_audio:
+                sent = await telegram_pool.call(lambda client: client.send_audio(
+                    chat_id=chat_id,
+                    audio=str(file_path),
+                    caption=caption,
+                    progress=progress
+                ))
+            else:
+                sent = await telegram_pool.call(lambda client: client.send_video(
+                    chat_id=chat_id,
+                    video=str(file_path),
+                    caption=caption,
+                    supports_streaming=True,
+                    progress=progress
+                ))
+            phase['bytes'] = file_path.stat().st_size
         
         logger.info(f"Pyrogram upload completed: {file_path.name}")
-        return True
+        media = sent.audio or sent.video or sent.document
+        return media.file_id
         
     except Exception as e:
         logger.error(f"Pyrogram upload error: {e}")
-        return False
+        return None
 
-async def download_video(url: str, format_type: str, quality: str, message: types.Message, user: User) -> Optional[Path]:
-    """Download video/audio with maximum speed"""
+async def send_cached_file(file_id: str, chat_id: int, caption: str, is_audio: bool = False) -> Optional[str]:
+    """Resend a file Telegram already has, without downloading or uploading"""
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_template = str(TMP_DIR / f"{user.telegram_id}_{timestamp}_%(title)s.%(ext)s")
-        
-        ydl_opts = {
-            'outtmpl': output_template,
-            'progress_hooks': [DownloadProgress(message, user.language)],
-            'quiet': True,
-            'no_warnings': True,
-            'concurrent_fragment_downloads': 10,
-            'retries': 10,
-            'fragment_retries': 10,
-            'http_chunk_size': 10485760,
-        }
-        
-        if format_type == "audio":
-            ydl_opts.update({
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '320',
-                }],
-                'writethumbnail': True,
-                'postprocessor_args': ['-threads', '0'],
-            })
+        if is_audio:
+            await telegram_pool.call(lambda client: client.send_audio(
+                chat_id=chat_id, audio=file_id, caption=caption
+            ))
         else:
-            if quality == "best":
-                ydl_opts['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-            elif quality == "2160p":
-                ydl_opts['format'] = 'bestvideo[height<=2160][ext=mp4]+bestaudio[ext=m4a]/best[height<=2160]'
-            elif quality == "1440p":
-                ydl_opts['format'] = 'bestvideo[height<=1440][ext=mp4]+bestaudio[ext=m4a]/best[height<=1440]'
-            elif quality == "1080p":
-                ydl_opts['format'] = 'bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080]'
-            elif quality == "720p":
-                ydl_opts['format'] = 'bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720]'
-            else:
-                height = quality.replace('p', '')
-                ydl_opts['format'] = f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/best[height<={height}]'
-            
-            ydl_opts['merge_output_format'] = 'mp4'
-            ydl_opts['postprocessor_args'] = ['-threads', '0']
+            await telegram_pool.call(lambda client: client.send_video(
+                chat_id=chat_id, video=file_id, caption=caption, supports_streaming=True
+            ))
+        return file_id
+    except Exception as e:
+        logger.error(f"Cached resend error: {e}")
+        return None
+
+class QueueFullError(Exception):
+    """Raised when the scheduler refuses a new job"""
+
+class _Ticket:
+    """A job waiting for a download slot"""
+    def __init__(self, user_id: int, on_position=None):
+        self.user_id = user_id
+        self.on_position = on_position
+        self.position = 0
+        self.future = asyncio.get_running_loop().create_future()
+
+class DownloadScheduler:
+    """Global download cap with round-robin fairness between users"""
+    def __init__(self, max_active: int, max_active_per_user: int,
+                 max_queued_per_user: int, max_queue_size: int):
+        self.max_active = max_active
+        self.max_active_per_user = max_active_per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.max_queue_size = max_queue_size
+        self.active_count = 0
+        self._active: Dict[int, int] = {}
+        # Insertion order is the round-robin order; a served user moves to the back
+        self._waiting: Dict[int, deque] = {}
+    
+    @property
+    def queued_count(self) -> int:
+        return sum(len(q) for q in self._waiting.values())
+    
+    async def acquire(self, user_id: int, on_position=None):
+        """Wait for a download slot; on_position(n) is called when the queue position changes"""
+        queue = self._waiting.get(user_id, ())
+        if len(queue) >= self.max_queued_per_user or self.queued_count >= self.max_queue_size:
+            raise QueueFullError(f"queue full for user {user_id}")
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            
-            base_name = ydl.prepare_filename(info)
-            if format_type == "audio":
-                file_path = Path(base_name).with_suffix('.mp3')
+        ticket = _Ticket(user_id, on_position)
+        self._waiting.setdefault(user_id, deque()).append(ticket)
+        self._dispatch()
+        
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self.release(user_id)
             else:
-                file_path = Path(base_name)
+                self._remove(ticket)
+            raise
+    
+    def release(self, user_id: int):
+        """Return a slot and hand it to the next user in turn"""
+        self.active_count -= 1
+        self._active[user_id] -= 1
+        if not self._active[user_id]:
+            del self._active[user_id]
+        self._dispatch()
+    
+    @asynccontextmanager
+    async def slot(self, user_id: int, on_position=None):
+        await self.acquire(user_id, on_position)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+    
+    def _remove(self, ticket: _Ticket):
+        queue = self._waiting.get(ticket.user_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._waiting[ticket.user_id]
+        self._dispatch()
+    
+    def _dispatch(self):
+        while self.active_count < self.max_active:
+            user_id = next(
+                (uid for uid in self._waiting
+                 if self._active.get(uid, 0) < self.max_active_per_user),
+                None
+            )
+            if user_id is None:
+                break
             
-            if file_path.exists():
-                return file_path
+            queue = self._waiting.pop(user_id)
+            ticket = queue.popleft()
+            if queue:
+                self._waiting[user_id] = queue
+            if ticket.future.done():
+                continue
             
-            for file in TMP_DIR.glob(f"{user.telegram_id}_{timestamp}_*"):
-                return file
+            self.active_count += 1
+            self._active[user_id] = self._active.get(user_id, 0) + 1
+            ticket.future.set_result(None)
+        
+        self._notify_positions()
+    
+    def _notify_positions(self):
+        # Positions follow the round-robin order: one ticket per user per round
+        queues = list(self._waiting.values())
+        order = []
+        for i in range(max((len(q) for q in queues), default=0)):
+            order.extend(q[i] for q in queues if i < len(q))
         
+        for position, ticket in enumerate(order, 1):
+            if ticket.position != position:
+                ticket.position = position
+                if ticket.on_position:
+                    try:
+                        ticket.on_position(position)
+                    except Exception as e:
+                        logger.error(f"Queue position callback error: {e}")
+
+download_scheduler = DownloadScheduler(
+    MAX_CONCURRENT_DOWNLOADS, MAX_ACTIVE_PER_USER, MAX_QUEUED_PER_USER, MAX_QUEUE_SIZE
+)
+
+def _extract_info(url: str, progress_hook) -> dict:
+    """Resolve metadata and formats without selecting or downloading, executed inside the download pool"""
+    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'noplaylist': True}) as ydl:
+        info = ydl.extract_info(url, download=False, process=False)
+        return ydl.sanitize_info(info)
+
+_metadata_tasks: Dict[str, asyncio.Task] = {}
+
+async def _fetch_metadata(url: str, video_id: str) -> Optional[dict]:
+    try:
+        info = await download_executor.submit(_extract_info, url)
+        await metadata_cache.put(video_id, info)
+        return info
+    except Exception as e:
+        logger.error(f"Metadata fetch error: {e}")
+        return None
+    finally:
+        _metadata_tasks.pop(video_id, None)
+
+def prefetch_metadata(url: str) -> Optional[asyncio.Task]:
+    """Start resolving metadata in the background; concurrent requests share one extraction"""
+    video_id = extract_video_id(url)
+    if not video_id:
+        return None
+    if video_id not in _metadata_tasks:
+        _metadata_tasks[video_id] = asyncio.create_task(_fetch_metadata(url, video_id))
+    return _metadata_tasks[video_id]
+
+async def get_metadata(url: str, timeout: Optional[float] = None) -> Optional[dict]:
+    """Cached info dict for url, joining (or starting) the prefetch; None on failure or timeout"""
+    info = await metadata_cache.get(extract_video_id(url))
+    if info:
+        return info
+    task = prefetch_metadata(url)
+    if not task:
         return None
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+    except asyncio.TimeoutError:
+        return None
+
+def _estimate_size(fmt: dict, duration: float) -> int:
+    return int(fmt.get('filesize') or fmt.get('filesize_approx') or (fmt.get('tbr') or 0) * 125 * duration)
+
+def _best_audio_size(info: dict) -> int:
+    duration = info.get('duration') or 0
+    return max((
+        _estimate_size(f, duration) for f in info.get('formats') or []
+        if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+    ), default=0)
+
+def quality_options(info: dict, limit: int = 6) -> List[tuple]:
+    """(height, estimated bytes) for the heights build_ydl_opts can really deliver, best first.
+    
+    A height is an mp4 video stream merged with the best m4a audio; progressive
+    formats (the selector's fallback) only count below the lowest such stream.
+    """
+    duration = info.get('duration') or 0
+    formats = info.get('formats') or []
+    m4a = [f for f in formats
+           if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none') and f.get('ext') == 'm4a']
+    audio_size = max((_estimate_size(f, duration) for f in m4a), default=0)
+    
+    sizes: Dict[int, int] = {}
+    for f in formats:
+        height = f.get('height')
+        if m4a and height and f.get('ext') == 'mp4' and f.get('vcodec') not in (None, 'none') \
+                and f.get('acodec') == 'none':
+            sizes[height] = max(sizes.get(height, 0), _estimate_size(f, duration) + audio_size)
+    
+    lowest = min(sizes, default=None)
+    for f in formats:
+        height = f.get('height')
+        if height and f.get('vcodec') not in (None, 'none') and f.get('acodec') not in (None, 'none') \
+                and (lowest is None or height < lowest):
+            sizes[height] = max(sizes.get(height, 0), _estimate_size(f, duration))
     
+    return [(height, sizes[height]) for height in sorted(sizes, reverse=True)[:limit]]
+
+QUALITY_LABELS = {2160: "4K (2160p)", 1440: "2K (1440p)", 1080: "1080p Full HD", 720: "720p HD"}
+
+def build_quality_keyboard(format_type: str, info: Optional[dict]) -> InlineKeyboardMarkup:
+    """Quality menu from the formats a video actually has, with size estimates when known"""
+    def label(text: str, size: int) -> str:
+        return f"{text} (~{size / (1024 * 1024):.0f}MB)" if size else text
+    
+    if format_type != "video":
+        duration = (info or {}).get('duration') or 0
+        original_size = _best_audio_size(info or {})
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=label("🎵 Original (m4a/opus, no re-encode)", original_size),
+                                  callback_data="quality_original")],
+            [InlineKeyboardButton(text=label("🎵 MP3 (320kbps)", int(duration) * 320 * 125),
+                                  callback_data="quality_best")],
+        ])
+    
+    options = quality_options(info) if info else []
+    if not options:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔥 Best (4K)", callback_data="quality_best")],
+            [InlineKeyboardButton(text="4K (2160p)", callback_data="quality_2160p")],
+            [InlineKeyboardButton(text="2K (1440p)", callback_data="quality_1440p")],
+            [InlineKeyboardButton(text="1080p Full HD", callback_data="quality_1080p")],
+            [InlineKeyboardButton(text="720p HD", callback_data="quality_720p")],
+            [InlineKeyboardButton(text="480p", callback_data="quality_480p")],
+        ])
+    
+    best_height, best_size = options[0]
+    rows = [[InlineKeyboardButton(text=label(f"🔥 Best ({best_height}p)", best_size), callback_data="quality_best")]]
+    for height, size in options:
+        rows.append([InlineKeyboardButton(
+            text=label(QUALITY_LABELS.get(height, f"{height}p"), size),
+            callback_data=f"quality_{height}p"
+        )])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def expected_download_size(info: Optional[dict], format_type: str, quality: str) -> int:
+    """Peak bytes a download needs in TMP_DIR: the source streams plus the merged/converted output"""
+    size = 0
+    if info and format_type == "audio":
+        size = _best_audio_size(info)
+        if quality != "original":
+            size += int(info.get('duration') or 0) * 320 * 125
+    elif info:
+        options = quality_options(info, limit=len(info.get('formats') or []))
+        if quality != "best":
+            height = int(quality.rstrip('p'))
+            options = [o for o in options if o[0] <= height] or options[-1:]
+        if options:
+            size = options[0][1] * 2  # separate streams and the merged file exist together
+    return size or TEMP_DEFAULT_RESERVE_MB * 1024 * 1024
+
+def build_ydl_opts(format_type: str, quality: str, output_template: str) -> dict:
+    """Build yt-dlp options for the requested format and quality"""
+    ydl_opts = {
+        'outtmpl': output_template,
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': True,
+        'concurrent_fragment_downloads': DOWNLOAD_MAX_FRAGMENTS,  # per job values come from bandwidth_manager
+        'retries': 10,
+        'fragment_retries': 10,
+        'http_chunk_size': HTTP_CHUNK_MAX_MB * 1024 * 1024,
+    }
+    
+    if format_type == "audio":
+        if quality == "original":
+            # Passthrough: the source stream is only remuxed ('best' copies the codec) and tagged.
+            # Cover art in opus needs mutagen; without it take the m4a stream, which ffmpeg can tag.
+            ydl_opts['format'] = 'bestaudio/best' if mutagen else 'bestaudio[ext=m4a]/bestaudio/best'
+            extract = {'key': 'FFmpegExtractAudio', 'preferredcodec': 'best'}
+        else:
+            ydl_opts['format'] = 'bestaudio/best'
+            extract = {'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '320'}
+        ydl_opts.update({
+            'postprocessors': [
+                extract,
+                {'key': 'FFmpegMetadata'},
+                {'key': 'EmbedThumbnail'},
+            ],
+            'writethumbnail': True,
+        })
+    else:
+        if quality == "best":
+            ydl_opts['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+        elif quality == "2160p":
+            ydl_opts['format'] = 'bestvideo[height<=2160][ext=mp4]+bestaudio[ext=m4a]/best[height<=2160]'
+        elif quality == "1440p":
+            ydl_opts['format'] = 'bestvideo[height<=1440][ext=mp4]+bestaudio[ext=m4a]/best[height<=1440]'
+        elif quality == "1080p":
+            ydl_opts['format'] = 'bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080]'
+        elif quality == "720p":
+            ydl_opts['format'] = 'bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720]'
+        else:
+            height = quality.replace('p', '')
+            ydl_opts['format'] = f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/best[height<={height}]'
+        
+        # Merging is a stream copy; mkv only when the picked codecs cannot go into mp4 without re-encoding
+        ydl_opts['merge_output_format'] = 'mp4/mkv'
+    
+    ydl_opts['postprocessor_args'] = {'default': ['-threads', str(POSTPROCESS_THREADS)]}
+    return ydl_opts
+
+def _run_ytdlp(url: str, ydl_opts: dict, info: Optional[dict], progress_hook) -> tuple:
+    """Blocking yt-dlp download in the download pool; returns (staged postprocessing, base filename)"""
+    merge_started = {}
+    staged = []
+    
+    def postprocessor_hook(d: dict):
+        if d['postprocessor'] != 'Merger':
+            return
+        if d['status'] == 'started':
+            merge_started['t'] = time.perf_counter()
+        elif d['status'] == 'finished' and 't' in merge_started:
+            PHASE_SECONDS.labels("merge").observe(time.perf_counter() - merge_started.pop('t'))
+    
+    with yt_dlp.YoutubeDL(dict(ydl_opts, postprocessor_hooks=[postprocessor_hook])) as ydl:
+        transfer = bandwidth_manager.open(ydl.params)
+        
+        def hook(d: dict):
+            bandwidth_manager.sample(transfer, d)
+            progress_hook(d)
+        
+        ydl.add_progress_hook(hook)
+        run_download = ydl.dl
+        
+        def dl(name, info, *args, **kwargs):
+            bandwidth_manager.start_format(transfer, info)
+            return run_download(name, info, *args, **kwargs)
+        
+        ydl.dl = dl
+        run_postprocessors = ydl.post_process
+        
+        def stage(filename, info, files_to_move=None):
+            info['filepath'] = filename
+            staged.append(lambda: run_postprocessors(filename, info, files_to_move))
+            return info
+        
+        ydl.post_process = stage
+        
+        try:
+            if info:
+                # Prefetched metadata: select formats and download without extracting again
+                try:
+                    info = ydl.process_ie_result(info, download=True)
+                except yt_dlp.utils.DownloadCancelled:
+                    raise
+                except yt_dlp.utils.DownloadError as e:
+                    logger.info(f"Prefetched info unusable ({e}), extracting again")
+                    staged.clear()
+                    info = ydl.extract_info(url, download=True)
+            else:
+                info = ydl.extract_info(url, download=True)
+        finally:
+            bandwidth_manager.close(transfer)
+        
+        return staged, ydl.prepare_filename(info)
+
+def _postprocess(staged: list, base_name: str, format_type: str, job_dir: Path) -> Optional[Path]:
+    """Blocking ffmpeg stage for a finished download, executed inside the postprocess pool"""
+    file_path = Path(base_name)
+    if format_type == "audio":
+        file_path = file_path.with_suffix('.mp3')
+    
+    for run in staged:
+        info = run()
+        if info.get('filepath'):
+            file_path = Path(info['filepath'])
+    
+    if file_path.exists():
+        return file_path
+    
+    for file in job_dir.iterdir():
+        return file
+    
+    return None
+
+async def download_video(url: str, format_type: str, quality: str, message: types.Message, user: User,
+                         slot=None) -> Optional[Path]:
+    """Download video/audio with maximum speed into its own reserved job directory.
+    
+    slot (a download scheduler slot) is entered only once disk space is reserved,
+    so a job waiting for space does not hold a download slot.
+    """
+    handle = None
+    job_dir = None
+    try:
+        info = await metadata_cache.get(extract_video_id(url))
+        job_dir = await temp_storage.reserve(
+            expected_download_size(info, format_type, quality),
+            reuse=getattr(current_job.get(), "resume_dir", None)
+        )
+        set_job_state("downloading", work_dir=str(job_dir))
+        output_template = str(job_dir / "%(title)s.%(ext)s")
+        ydl_opts = build_ydl_opts(format_type, quality, output_template)
+        
+        async with slot or nullcontext():
+            with track_phase("download") as phase:
+                handle = download_executor.submit(_run_ytdlp, url, ydl_opts, info)
+                progress = DownloadProgress(message, user.language)
+                async for d in handle.progress():
+                    progress(d)
+            
+                staged, base_name = await handle
+                if staged:
+                    progress_hub.post(message, get_text(user.language, "processing"))
+                    set_job_state("postprocessing")
+                file_path = await asyncio.get_running_loop().run_in_executor(
+                    postprocess_pool, _postprocess, staged, base_name, format_type, job_dir
+                )
+                if file_path:
+                    phase['bytes'] = file_path.stat().st_size
+        
+        if not file_path:
+            temp_storage.release(job_dir)
+            return None
+        temp_storage.settle(job_dir, phase['bytes'])
+        return file_path
+    
+    except asyncio.CancelledError:
+        if handle:
+            handle.cancel()
+        if current_job.get() is not None and job_dir:
+            temp_storage.detach(job_dir)  # keep the .part files for resume_jobs()
+        else:
+            temp_storage.release(job_dir)
+        raise
     except Exception as e:
         logger.error(f"Download error: {e}")
+        temp_storage.release(job_dir)
         raise
 
+# Streaming uploads (STREAM_UPLOADS=true): yt-dlp -> bounded buffer -> MTProto parts, no temp file
+class StreamBuffer:
+    """Bounded in-memory byte buffer between a producer pipe and an uploader"""
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.size = 0
+        self._chunks: deque = deque()
+        self._eof = False
+        self._error: Optional[Exception] = None
+        self._cond = asyncio.Condition()
+    
+    async def write(self, data: bytes):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.size < self.capacity)
+            self._chunks.append(data)
+            self.size += len(data)
+            self._cond.notify_all()
+    
+    async def close(self, error: Optional[Exception] = None):
+        async with self._cond:
+            self._eof = True
+            self._error = error
+            self._cond.notify_all()
+    
+    async def read(self, n: int) -> bytes:
+        """Read exactly n bytes, fewer only at EOF; b'' means the stream ended"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.size >= n or self._eof)
+            if self._error:
+                raise self._error
+            
+            parts, wanted = [], n
+            while self._chunks and wanted:
+                chunk = self._chunks.popleft()
+                if len(chunk) > wanted:
+                    chunk, rest = chunk[:wanted], chunk[wanted:]
+                    self._chunks.appendleft(rest)
+                parts.append(chunk)
+                wanted -= len(chunk)
+            
+            data = b"".join(parts)
+            self.size -= len(data)
+            self._cond.notify_all()
+            return data
+
+def _probe_stream(ydl_opts: dict, info: dict, progress_hook) -> dict:
+    """Run format selection on prefetched metadata, executed inside the download pool"""
+    with yt_dlp.YoutubeDL(dict(ydl_opts, quiet=True)) as ydl:
+        return ydl.process_ie_result(info, download=False)
+
+async def probe_streamable(url: str, format_type: str, quality: str) -> Optional[dict]:
+    """Metadata for a selection that yields one file (no merge), else None"""
+    info = await get_metadata(url)
+    if not info:
+        return None
+    ydl_opts = build_ydl_opts(format_type, quality, "-")
+    info = await download_executor.submit(_probe_stream, ydl_opts, info)
+    if info.get('requested_formats'):
+        return None
+    
+    transcode = format_type == "audio" and quality != "original"
+    ext = "mp3" if transcode else info.get('ext', 'mp4')
+    duration = int(info.get('duration') or 0)
+    size = info.get('filesize') or info.get('filesize_approx') or 0
+    if transcode:
+        size = duration * 320 * 1000 // 8  # re-encoded to 320k MP3
+    
+    return {
+        'format_id': info['format_id'],
+        'ext': ext,
+        'transcode': transcode,
+        'title': info.get('title', 'video'),
+        'duration': duration,
+        'width': info.get('width') or 0,
+        'height': info.get('height') or 0,
+        'size': size,
+    }
+
+AUDIO_MIME_TYPES = {'mp3': "audio/mpeg", 'm4a': "audio/mp4", 'opus': "audio/ogg", 'webm': "audio/webm"}
+
+async def _spawn_stream(url: str, format_type: str, meta: dict) -> list:
+    """Start yt-dlp writing to stdout, piped through ffmpeg for MP3 audio"""
+    source_cmd = [sys.executable, "-m", "yt_dlp", "-f", meta['format_id'], "-o", "-",
+                  "--quiet", "--no-warnings", url]
+    if bandwidth_manager.rate_limit:
+        source_cmd[-1:-1] = ["--limit-rate", str(int(bandwidth_manager.rate_limit))]
+    if not meta.get('transcode'):
+        return [await asyncio.create_subprocess_exec(
+            *source_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )]
+    
+    read_fd, write_fd = os.pipe()
+    try:
+        source = await asyncio.create_subprocess_exec(
+            *source_cmd, stdout=write_fd, stderr=asyncio.subprocess.DEVNULL
+        )
+        encoder = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-loglevel", "error", "-i", "pipe:0", "-vn",
+            "-c:a", "libmp3lame", "-b:a", "320k", "-f", "mp3", "pipe:1",
+            stdin=read_fd, stdout=asyncio.subprocess.PIPE
+        )
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+    return [source, encoder]
+
+async def _pump_stream(procs: list, buffer: StreamBuffer):
+    """Copy the last process' stdout into the buffer, then report exit status"""
+    error = None
+    try:
+        while True:
+            chunk = await procs[-1].stdout.read(256 * 1024)
+            if not chunk:
+                break
+            await buffer.write(chunk)
+        codes = [await proc.wait() for proc in procs]
+        if any(codes):
+            error = Exception(f"Stream source failed (exit codes {codes})")
+    except Exception as e:
+        error = e
+    await buffer.close(error)
+
+async def upload_stream_telegram(buffer: StreamBuffer, meta: dict, chat_id: int, caption: str,
+                                 is_audio: bool, on_progress=None) -> Optional[str]:
+    """Upload a stream of unknown length as MTProto parts and send it, returning the file_id"""
+    # Parts belong to the session that saved them, so one file stays on one session
+    async with telegram_pool.lease() as client:
+        return await _upload_stream_parts(client, buffer, meta, chat_id, caption, is_audio, on_progress)
+
+async def _upload_stream_parts(client: PyrogramClient, buffer: StreamBuffer, meta: dict, chat_id: int,
+                               caption: str, is_audio: bool, on_progress) -> Optional[str]:
+    file_id = client.rnd_id()
+    
+    # Read ahead up to the small-file limit: that decides saveFilePart vs saveBigFilePart
+    head = deque()
+    head_size = 0
+    while head_size <= TG_SMALL_FILE_LIMIT:
+        part = await buffer.read(TG_PART_SIZE)
+        if not part:
+            break
+        head.append(part)
+        head_size += len(part)
+    is_big = head_size > TG_SMALL_FILE_LIMIT
+    
+    async def next_part() -> bytes:
+        return head.popleft() if head else await buffer.read(TG_PART_SIZE)
+    
+    # Up to TG_PARALLEL_PARTS parts in flight; a FloodWait pauses this file and steers others away
+    in_flight = asyncio.Semaphore(TG_PARALLEL_PARTS)
+    tasks = []
+    errors = []
+    
+    async def save_part(request):
+        try:
+            while True:
+                try:
+                    return await client.invoke(request)
+                except FloodWait as e:
+                    telegram_pool.flood_wait(client, e.value)
+                    await asyncio.sleep(e.value)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            in_flight.release()
+    
+    md5 = hashlib.md5()
+    parts = uploaded = 0
+    current = await next_part()
+    if not current:
+        raise Exception("Empty stream")
+    
+    try:
+        while current:
+            following = await next_part()
+            if is_big:
+                # Total part count is unknown until the last part: -1 marks a streamed upload
+                request = raw.functions.upload.SaveBigFilePart(
+                    file_id=file_id, file_part=parts,
+                    file_total_parts=-1 if following else parts + 1, bytes=current
+                )
+            else:
+                md5.update(current)
+                request = raw.functions.upload.SaveFilePart(
+                    file_id=file_id, file_part=parts, bytes=current
+                )
+            
+            await in_flight.acquire()
+            if errors:
+                in_flight.release()
+                raise errors[0]
+            tasks.append(asyncio.create_task(save_part(request)))
+            
+            parts += 1
+            uploaded += len(current)
+            if on_progress:
+                on_progress(uploaded)
+            current = following
+        
+        await asyncio.gather(*tasks)
+        if errors:
+            raise errors[0]
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    file_name = f"{yt_dlp.utils.sanitize_filename(meta['title'])}.{meta['ext']}"
+    if is_big:
+        input_file = raw.types.InputFileBig(id=file_id, parts=parts, name=file_name)
+    else:
+        input_file = raw.types.InputFile(id=file_id, parts=parts, name=file_name, md5_checksum=md5.hexdigest())
+    
+    attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+    if is_audio:
+        attributes.append(raw.types.DocumentAttributeAudio(duration=meta['duration'], title=meta['title']))
+        mime_type = AUDIO_MIME_TYPES.get(meta['ext'], f"audio/{meta['ext']}")
+    else:
+        attributes.append(raw.types.DocumentAttributeVideo(
+            duration=meta['duration'], w=meta['width'], h=meta['height'], supports_streaming=True
+        ))
+        mime_type = f"video/{meta['ext']}"
+    
+    r = await client.invoke(raw.functions.messages.SendMedia(
+        peer=await client.resolve_peer(chat_id),
+        media=raw.types.InputMediaUploadedDocument(file=input_file, mime_type=mime_type, attributes=attributes),
+        message=caption,
+        random_id=client.rnd_id()
+    ))
+    
+    for upd in r.updates:
+        if isinstance(upd, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            sent = await PyrogramMessage._parse(
+                client, upd.message,
+                {u.id: u for u in r.users},
+                {c.id: c for c in r.chats}
+            )
+            media = sent.audio or sent.video or sent.document
+            return media.file_id
+    return None
+
+@asynccontextmanager
+async def open_stream(url: str, format_type: str, meta: dict, user: User):
+    """Run the yt-dlp (and encoder) pipe inside a download slot, yielding its buffer"""
+    buffer = StreamBuffer(STREAM_BUFFER_MB * 1024 * 1024)
+    procs = []
+    pump = None
+    try:
+        async with download_scheduler.slot(user.telegram_id):
+            procs = await _spawn_stream(url, format_type, meta)
+            pump = asyncio.create_task(_pump_stream(procs, buffer))
+            yield buffer
+    finally:
+        if pump:
+            pump.cancel()
+        for proc in procs:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+async def stream_to_telegram(url: str, format_type: str, meta: dict, chat_id: int, caption: str,
+                             status_msg: types.Message, user: User) -> Optional[str]:
+    """Download and upload at the same time; peak memory is the buffer, disk use is zero"""
+    sent = [0]
+    
+    def on_progress(uploaded: int):
+        sent[0] = uploaded
+        percent = min(99, uploaded * 100 / meta['size']) if meta['size'] else 0
+        progress_hub.post(status_msg, get_text(user.language, "uploading_telegram", progress=f"{percent:.0f}"))
+    
+    try:
+        with track_phase("stream_telegram") as phase:
+            async with open_stream(url, format_type, meta, user) as buffer:
+                file_id = await upload_stream_telegram(
+                    buffer, meta, chat_id, caption, format_type == "audio", on_progress
+                )
+            phase['bytes'] = sent[0]
+        return file_id
+    except Exception as e:
+        logger.error(f"Streaming upload error: {e}")
+        return None
+
+async def stream_to_gdrive(url: str, format_type: str, meta: dict,
+                           status_msg: types.Message, user: User) -> Optional[Dict]:
+    """Pipe a single-file format straight into a resumable Drive upload"""
+    name = Path(f"{yt_dlp.utils.sanitize_filename(meta['title'])}.{meta['ext']}")
+    try:
+        async with open_stream(url, format_type, meta, user) as buffer:
+            return await upload_to_gdrive(name, user, status_msg, source=buffer)
+    except Exception as e:
+        logger.error(f"Streaming Drive upload error: {e}")
+        return None
+
+class TempStorageFull(Exception):
+    """Raised when a download can't get temp disk space, now or within TEMP_RESERVE_TIMEOUT"""
+
+class TempStorage:
+    """Space reservations in TMP_DIR: one directory per job, deleted as a whole when it is done"""
+    def __init__(self, root: Path, quota_mb: int, min_free_mb: int, timeout: float):
+        self.root = root
+        self.quota = quota_mb * 1024 * 1024
+        self.min_free = min_free_mb * 1024 * 1024
+        self.timeout = timeout
+        self._reserved: Dict[Path, int] = {}
+        self._waiters: deque = deque()
+    
+    @property
+    def reserved(self) -> int:
+        return sum(self._reserved.values())
+    
+    def capacity(self) -> int:
+        return (self.quota or shutil.disk_usage(self.root).total) - self.min_free
+    
+    @staticmethod
+    def _written(job_dir: Path) -> int:
+        """Bytes a job has already put on disk (its files are flat in the job directory)"""
+        try:
+            with os.scandir(job_dir) as entries:
+                return sum(entry.stat().st_size for entry in entries if entry.is_file())
+        except OSError:
+            return 0
+    
+    def available(self) -> int:
+        # Free disk already shrank by what jobs wrote; the rest of their reservations is still to come
+        outstanding = sum(max(0, size - self._written(job_dir)) for job_dir, size in self._reserved.items())
+        free = shutil.disk_usage(self.root).free - self.min_free - outstanding
+        if self.quota:
+            free = min(free, self.quota - self.reserved)
+        return free
+    
+    async def reserve(self, size: int, reuse: Optional[Path] = None) -> Path:
+        """Reserve size bytes and return a new job directory (or reuse, if it still exists); waits in line while space is short"""
+        if size > self.capacity():
+            raise TempStorageFull(f"{size / (1024 * 1024):.0f}MB can never fit in temp storage")
+        
+        deadline = time.monotonic() + self.timeout
+        ticket = object()
+        self._waiters.append(ticket)
+        try:
+            # First come, first served: a big job is not starved by small ones slipping past it.
+            # Space also frees up outside this process (other workers, uploads), so re-check every second.
+            while self._waiters[0] is not ticket or size > self.available():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TempStorageFull(f"No temp space for {size / (1024 * 1024):.0f}MB")
+                await asyncio.sleep(min(1.0, remaining))
+        finally:
+            self._waiters.remove(ticket)
+        
+        if reuse and reuse.is_dir():
+            job_dir = reuse
+        else:
+            job_dir = Path(tempfile.mkdtemp(prefix="job-", dir=self.root))
+        self._reserved[job_dir] = size
+        return job_dir
+    
+    def settle(self, job_dir: Path, size: int):
+        """Replace the estimate with the real size once the download is finished"""
+        if job_dir in self._reserved:
+            self._reserved[job_dir] = size
+    
+    def detach(self, job_dir: Path):
+        """Stop accounting for a job whose files now belong to another process"""
+        self._reserved.pop(job_dir, None)
+    
+    def release(self, path: Optional[Path]):
+        """Delete a job directory (or the job directory holding path) and free its reservation"""
+        if not path:
+            return
+        job_dir = path if path in self._reserved or path.is_dir() else path.parent
+        self._reserved.pop(job_dir, None)
+        if job_dir.parent == self.root:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            logger.info(f"Cleaned up: {job_dir}")
+        elif path.exists():
+            path.unlink()
+            logger.info(f"Cleaned up: {path}")
+    
+    def sweep_orphans(self, max_age: float, keep: Optional[set] = None):
+        """Remove what a crashed process left behind; runs once at startup, not periodically"""
+        cutoff = time.time() - max_age
+        keep = keep or set()
+        for entry in self.root.iterdir():
+            try:
+                if entry.stat().st_mtime < cutoff and entry not in self._reserved and entry not in keep:
+                    if entry.is_dir():
+                        shutil.rmtree(entry, ignore_errors=True)
+                    else:
+                        entry.unlink()
+                    logger.info(f"Removed orphaned temp entry: {entry}")
+            except OSError as e:
+                logger.error(f"Orphan sweep error: {e}")
+
+temp_storage = TempStorage(TMP_DIR, TEMP_QUOTA_MB, TEMP_MIN_FREE_MB, TEMP_RESERVE_TIMEOUT)
+
+# Coalesced downloads share one file: holders per path, and the queue job behind remote files
+_file_refs: Dict[Path, int] = {}
+_remote_files: Dict[Path, str] = {}
+
+def retain_file(file_path: Path):
+    """Register one more user of a downloaded file"""
+    _file_refs[file_path] = _file_refs.get(file_path, 0) + 1
+
 async def cleanup_file(file_path: Path):
-    """Delete file from VPS immediately"""
+    """Delete file from VPS as soon as its last user is done"""
     try:
-        if file_path and file_path.exists():
-            file_path.unlink()
-            logger.info(f"Cleaned up: {file_path}")
+        if file_path in _file_refs:
+            _file_refs[file_path] -= 1
+            if _file_refs[file_path] > 0:
+                return
+            del _file_refs[file_path]
+        if file_path in _remote_files:
+            if not await job_queue.release(_remote_files.pop(file_path)):
+                return
+        
+        temp_storage.release(file_path)
     except Exception as e:
         logger.error(f"Cleanup error: {e}")
 
+# Distributed job queue (QUEUE_BACKEND=redis)
+_ENQUEUE_LUA = """
+local existing = redis.call('GET', KEYS[5])
+if existing then
+  redis.call('HINCRBY', ARGV[6] .. existing, 'holders', 1)
+  return existing
+end
+if redis.call('LLEN', KEYS[2]) >= tonumber(ARGV[3])
+   or tonumber(redis.call('GET', KEYS[4]) or '0') >= tonumber(ARGV[4]) then
+  return false
+end
+redis.call('HSET', KEYS[3], 'payload', ARGV[5], 'user_id', ARGV[1], 'state', 'queued',
+           'attempts', 0, 'holders', 1, 'inflight', KEYS[5])
+redis.call('SET', KEYS[5], ARGV[2], 'EX', ARGV[7])
+redis.call('RPUSH', KEYS[2], ARGV[2])
+if redis.call('LLEN', KEYS[2]) == 1 then
+  redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+redis.call('INCR', KEYS[4])
+return ARGV[2]
+"""
+
+_DEQUEUE_LUA = """
+local uid = redis.call('LPOP', KEYS[1])
+if not uid then return false end
+local pending = ARGV[1] .. uid
+local job_id = redis.call('LPOP', pending)
+if redis.call('LLEN', pending) > 0 then
+  redis.call('RPUSH', KEYS[1], uid)
+end
+if not job_id then return false end
+redis.call('DECR', KEYS[3])
+redis.call('ZADD', KEYS[2], ARGV[3], job_id)
+redis.call('HSET', ARGV[2] .. job_id, 'state', 'running', 'worker', ARGV[4])
+redis.call('HINCRBY', ARGV[2] .. job_id, 'attempts', 1)
+return job_id
+"""
+
+_REAP_LUA = """
+local requeued = 0
+for _, job_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])) do
+  redis.call('ZREM', KEYS[2], job_id)
+  local job = ARGV[3] .. job_id
+  if tonumber(redis.call('HGET', job, 'attempts') or '0') >= tonumber(ARGV[4]) then
+    redis.call('HSET', job, 'state', 'failed', 'error', 'worker lost')
+    redis.call('EXPIRE', job, ARGV[5])
+  else
+    local uid = redis.call('HGET', job, 'user_id')
+    local pending = ARGV[2] .. uid
+    redis.call('LPUSH', pending, job_id)
+    if redis.call('LLEN', pending) == 1 then
+      redis.call('RPUSH', KEYS[1], uid)
+    end
+    redis.call('HSET', job, 'state', 'queued')
+    redis.call('INCR', KEYS[3])
+    requeued = requeued + 1
+  end
+end
+return requeued
+"""
+
+class RedisJobQueue:
+    """Leased job queue in Redis, round-robin between users like DownloadScheduler"""
+    RING = "jobq:ring"
+    LEASES = "jobq:leases"
+    SIZE = "jobq:size"
+    SEQ = "jobq:seq"
+    PENDING = "jobq:pending:"
+    JOB = "jobq:job:"
+    INFLIGHT = "jobq:inflight:"
+    
+    def __init__(self, client):
+        self.client = client
+        self._enqueue = client.register_script(_ENQUEUE_LUA)
+        self._dequeue = client.register_script(_DEQUEUE_LUA)
+        self._reap = client.register_script(_REAP_LUA)
+    
+    def job_key(self, job_id: str) -> str:
+        return f"{self.JOB}{job_id}"
+    
+    async def enqueue(self, user_id: int, payload: dict, flight_key: str) -> str:
+        """Queue a job, or join the in-flight job with the same flight_key.
+        Raises QueueFullError on admission failure."""
+        job_id = str(await self.client.incr(self.SEQ))
+        job_id = await self._enqueue(
+            keys=[self.RING, f"{self.PENDING}{user_id}", self.job_key(job_id), self.SIZE,
+                  f"{self.INFLIGHT}{flight_key}"],
+            args=[user_id, job_id, MAX_QUEUED_PER_USER, MAX_QUEUE_SIZE, json.dumps(payload),
+                  self.JOB, JOB_RESULT_TTL]
+        )
+        if not job_id:
+            raise QueueFullError(f"queue full for user {user_id}")
+        return job_id.decode()
+    
+    async def dequeue(self, worker_id: str) -> Optional[str]:
+        """Lease the next job in round-robin order"""
+        job_id = await self._dequeue(
+            keys=[self.RING, self.LEASES, self.SIZE],
+            args=[self.PENDING, self.JOB, datetime.now().timestamp() + JOB_LEASE_SECONDS, worker_id]
+        )
+        return job_id.decode() if job_id else None
+    
+    async def heartbeat(self, job_id: str) -> bool:
+        """Extend the lease; False means it expired and the job was requeued"""
+        deadline = datetime.now().timestamp() + JOB_LEASE_SECONDS
+        return bool(await self.client.zadd(self.LEASES, {job_id: deadline}, xx=True, ch=True))
+    
+    async def finish(self, job_id: str, state: str, **fields):
+        # Dropping the in-flight lock sends later requests to the result cache or a new job
+        inflight = await self.client.hget(self.job_key(job_id), "inflight")
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zrem(self.LEASES, job_id)
+            pipe.hset(self.job_key(job_id), mapping={'state': state, **fields})
+            pipe.expire(self.job_key(job_id), JOB_RESULT_TTL)
+            if inflight:
+                pipe.delete(inflight)
+            await pipe.execute()
+    
+    async def release(self, job_id: str) -> bool:
+        """Drop one holder of a finished job's file; True when it was the last"""
+        remaining = await self.client.hincrby(self.job_key(job_id), "holders", -1)
+        if remaining <= 0:
+            await self.client.delete(self.job_key(job_id))
+            return True
+        return False
+    
+    async def complete(self, job_id: str, result: dict):
+        await self.finish(job_id, "done", result=json.dumps(result))
+    
+    async def fail(self, job_id: str, error: str):
+        await self.finish(job_id, "failed", error=error)
+    
+    async def reap(self) -> int:
+        """Requeue jobs whose worker stopped sending heartbeats"""
+        return await self._reap(
+            keys=[self.RING, self.LEASES, self.SIZE],
+            args=[datetime.now().timestamp(), self.PENDING, self.JOB, JOB_MAX_ATTEMPTS, JOB_RESULT_TTL]
+        )
+    
+    async def get(self, job_id: str) -> Dict[str, str]:
+        data = await self.client.hgetall(self.job_key(job_id))
+        return {k.decode(): v.decode() for k, v in data.items()}
+    
+    async def position(self, user_id: int, job_id: str) -> Optional[int]:
+        """Approximate round-robin queue position of a waiting job"""
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.lpos(f"{self.PENDING}{user_id}", job_id)
+            pipe.lpos(self.RING, user_id)
+            pipe.llen(self.RING)
+            index, turn, users = await pipe.execute()
+        if index is None or turn is None:
+            return None
+        return index * users + turn + 1
+
+job_queue = RedisJobQueue(redis_client)
+
+class RemoteStatus:
+    """Status message stand-in for workers: edits go to the job hash for the front end"""
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+    
+    async def edit_text(self, text: str, **kwargs):
+        await redis_client.hset(job_queue.job_key(self.job_id), "status_text", text)
+        return self
+
+async def wait_remote_job(job_id: str, status_msg: types.Message, user_lang: str) -> dict:
+    """Mirror a queued job's status into status_msg until it finishes"""
+    while True:
+        job = await job_queue.get(job_id)
+        if not job:
+            raise Exception("Job expired")
+        state = job.get("state")
+        if state == "done":
+            return json.loads(job["result"])
+        if state == "failed":
+            raise Exception(job.get("error", "Download failed"))
+        
+        text = job.get("status_text")
+        if state == "queued":
+            position = await job_queue.position(int(job["user_id"]), job_id)
+            if position:
+                text = get_text(user_lang, "queued", position=position)
+        if text:
+            progress_hub.post(status_msg, text)
+        
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+class StatusFanout:
+    """Status message stand-in that mirrors progress to every coalesced requester.
+    
+    progress_hub expands a fanout into its requesters' messages when it is posted,
+    so a viral link with many watchers still stays within PROGRESS_EDITS_PER_SECOND.
+    """
+    def __init__(self, messages: List[types.Message]):
+        self.messages = messages
+    
+    async def edit_text(self, text: str):
+        for message in list(self.messages):
+            progress_hub.post(message, text)
+        return self
+
+class SingleFlight:
+    """Runs one download per (video_id, format, quality); later requests attach to it"""
+    def __init__(self):
+        self._flights: Dict[str, tuple] = {}
+    
+    async def run(self, key: str, status_msg: types.Message, start) -> Optional[Path]:
+        """start(fanout_status) runs once per key; every caller gets its result"""
+        if key in self._flights:
+            task, watchers = self._flights[key]
+            watchers.append(status_msg)
+        else:
+            watchers = [status_msg]
+            fanout = StatusFanout(watchers)
+            task = asyncio.create_task(start(fanout))
+            self._flights[key] = (task, watchers)
+            task.add_done_callback(lambda _: self._finish(key, fanout))
+        
+        # One requester giving up must not cancel the download for the others
+        return await asyncio.shield(task)
+    
+    def _finish(self, key: str, fanout: StatusFanout):
+        self._flights.pop(key, None)
+        # Progress posted late for the shared status (e.g. from the download thread) is ignored
+        progress_hub.drop(fanout)
+
+download_flights = SingleFlight()
+
+async def _start_download(url: str, format_type: str, quality: str, status_msg, user: User,
+                          flight_key: str) -> Optional[Path]:
+    """Download through the local scheduler or the distributed queue"""
+    if QUEUE_BACKEND == "redis":
+        job_id = await job_queue.enqueue(user.telegram_id, {
+            'url': url,
+            'format': format_type,
+            'quality': quality,
+        }, flight_key)
+        result = await wait_remote_job(job_id, status_msg, user.language)
+        if not result.get('file_path'):
+            return None
+        file_path = Path(result['file_path'])
+        _remote_files[file_path] = job_id
+        return file_path
+    
+    def on_position(position: int):
+        progress_hub.post(status_msg, get_text(user.language, "queued", position=position))
+    
+    return await download_video(url, format_type, quality, status_msg, user,
+                                slot=download_scheduler.slot(user.telegram_id, on_position))
+
+async def run_download(url: str, format_type: str, quality: str, status_msg: types.Message, user: User) -> Optional[Path]:
+    """Download once per (video, format, quality) no matter how many users ask"""
+    flight_key = f"{extract_video_id(url)}:{format_type}:{quality}"
+    file_path = await download_flights.run(
+        flight_key, status_msg,
+        lambda fanout: _start_download(url, format_type, quality, fanout, user, flight_key)
+    )
+    if file_path:
+        retain_file(file_path)
+    return file_path
+
 # Command Handlers
 @dp.message(CommandStart())
 async def cmd_start(message: types.Message):
@@ -552,8 +2885,10 @@ async def cmd_help(message: types.Message):
 async def cmd_status(message: types.Message):
     """Handle /status command"""
     user = await get_or_create_user(message.from_user.id)
-    today_count = await get_today_downloads(user.telegram_id)
-    remaining = max(0, RATE_LIMIT_PER_USER_PER_DAY - today_count)
+    tier = user_tier(user)
+    today_count = await get_today_downloads(user.telegram_id, tier)
+    limit = rate_limiter.limit_for(tier)
+    remaining = max(0, limit - today_count) if limit else "∞"
     
     gdrive_status = "✅ সংযুক্ত" if user.gdrive_token else "❌ সংযুক্ত নেই"
     
@@ -609,16 +2944,14 @@ async def process_gdrive_code(message: types.Message, state: FSMContext):
     flow = data.get('flow')
     
     try:
-        flow.fetch_token(code=message.text.strip())
+        await asyncio.to_thread(flow.fetch_token, code=message.text.strip())
         creds = flow.credentials
         
-        async with async_session() as session:
-            result = await session.execute(
-                select(User).where(User.telegram_id == user.telegram_id)
-            )
-            db_user = result.scalar_one()
-            db_user.gdrive_token = pickle.dumps(creds).decode('latin1')
-            await session.commit()
+        await update_user(
+            user.telegram_id,
+            gdrive_token=pickle.dumps(creds).decode('latin1'),
+            gdrive_folder_id=None  # May be a different Drive account now
+        )
         
         await message.answer(get_text(user.language, "gdrive_connected"))
         await state.clear()
@@ -636,39 +2969,122 @@ async def cmd_admin(message: types.Message):
         await message.answer(get_text(user.language, "not_admin"))
         return
     
-    async with async_session() as session:
-        total_users = await session.scalar(select(func.count(User.id)))
+    # Counts come from today's rollup row instead of scanning users and jobs
+    today = next(iter(await get_daily_stats(1)), None)
     
+    # Same live counters the /metrics endpoint serves
+    hit_ratio = cache_hit_ratio()
     await message.answer(
         get_text(
             user.language,
             "admin_panel",
-            users=total_users,
-            downloads=0,
-            active=0
-        )
+            users=today.total_users if today else "-",
+            today_done=today.downloads if today else 0,
+            today_failed=today.failed if today else 0,
+            today_new=today.new_users if today else 0,
+            downloads=int(sum(
+                metric_value("ytdl_deliveries_total", {"storage": storage, "status": "success"})
+                for storage in ("telegram", "gdrive")
+            )),
+            active=int(metric_value("ytdl_active_jobs")),
+            queued=int(metric_value("ytdl_queue_depth")),
+            cache_hits=f"{hit_ratio * 100:.0f}%" if hit_ratio is not None else "-",
+            loop_lag=f"{metric_value('ytdl_event_loop_lag_seconds') * 1000:.0f}"
+        ),
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text=f"🔬 Profile ({PROFILE_SECONDS}s)", callback_data="admin_profile")
+        ]])
     )
 
+@dp.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    """Handle /stats command: daily rollups of the last week"""
+    user = await get_or_create_user(message.from_user.id)
+    
+    if not user.is_admin:
+        await message.answer(get_text(user.language, "not_admin"))
+        return
+    
+    rows = await get_daily_stats(7)
+    if not rows:
+        await message.answer(get_text(user.language, "stats_empty"))
+        return
+    lines = [get_text(user.language, "stats_header", days=7)]
+    for row in rows:
+        lines.append(get_text(
+            user.language,
+            "stats_row",
+            day=row.day.isoformat(),
+            done=row.downloads,
+            failed=row.failed,
+            size_mb=f"{row.bytes / (1024 * 1024):.0f}",
+            active=row.active_users,
+            new=row.new_users
+        ))
+    await message.answer("\n".join(lines))
+
+@dp.callback_query(F.data == "admin_profile", flags={"long_running": True})
+async def callback_admin_profile(callback: types.CallbackQuery):
+    """Sample the event loop for PROFILE_SECONDS and send the hottest functions plus collapsed stacks"""
+    user = await get_or_create_user(callback.from_user.id)
+    if not user.is_admin:
+        await callback.answer(get_text(user.language, "not_admin"), show_alert=True)
+        return
+    if profiler.running:
+        await callback.answer(get_text(user.language, "profile_busy"), show_alert=True)
+        return
+    
+    await callback.answer()
+    status_msg = await callback.message.answer(get_text(user.language, "profile_started", seconds=PROFILE_SECONDS))
+    try:
+        stacks = await profiler.profile(PROFILE_SECONDS)
+    except Exception as e:
+        logger.error(f"Profiler error: {e}")
+        await status_msg.edit_text(get_text(user.language, "failed", error=str(e)))
+        return
+    
+    lines = [f"{share * 100:5.1f}%  {leaf}" for leaf, share in SamplingProfiler.summary(stacks)]
+    await status_msg.edit_text(get_text(user.language, "profile_result", top="\n".join(lines) or "-"))
+    folded = "\n".join(f"{stack} {count}" for stack, count in stacks.items())
+    await callback.message.answer_document(
+        types.BufferedInputFile(folded.encode(), filename="loop-profile.folded")
+    )
+
+@dp.message(Command("storage"))
+async def cmd_storage(message: types.Message):
+    """Handle /storage command: forget the default storage"""
+    user = await get_or_create_user(message.from_user.id)
+    
+    await update_user(user.telegram_id, default_storage=None)
+    
+    await message.answer(get_text(user.language, "storage_reset"))
+
 @dp.message(F.text)
 async def handle_url(message: types.Message, state: FSMContext):
     """Handle URL message"""
     url = message.text.strip()
     
-    if not is_valid_youtube_url(url):
-        user = await get_or_create_user(message.from_user.id)
+    user = await get_or_create_user(message.from_user.id)
+    
+    if not is_valid_youtube_url(url) and not is_playlist_url(url):
         await message.answer(get_text(user.language, "invalid_url"))
         return
     
-    if not await check_rate_limit(message.from_user.id):
-        user = await get_or_create_user(message.from_user.id)
+    tier = user_tier(user)
+    playlist = is_playlist_url(url)
+    # Playlists are charged per item as they start; here only check there is room for one
+    allowed, _ = await rate_limiter.hit(message.from_user.id, tier, cost=0 if playlist else 1)
+    if not allowed:
         await message.answer(
-            get_text(user.language, "rate_limited", limit=RATE_LIMIT_PER_USER_PER_DAY)
+            get_text(user.language, "rate_limited", limit=rate_limiter.limit_for(tier))
         )
         return
     
-    await state.update_data(url=url)
+    await state.update_data(url=url, playlist=playlist)
+    if not playlist:
+        # Resolve formats while the user is still picking: the quality menu needs them
+        prefetch_metadata(url)
     
-    user = await get_or_create_user(message.from_user.id)
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text="🎬 Video", callback_data="format_video"),
@@ -688,20 +3104,11 @@ async def callback_format(callback: types.CallbackQuery, state: FSMContext):
     await state.update_data(format=format_type)
     
     user = await get_or_create_user(callback.from_user.id)
-    
-    if format_type == "video":
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔥 Best (4K)", callback_data="quality_best")],
-            [InlineKeyboardButton(text="4K (2160p)", callback_data="quality_2160p")],
-            [InlineKeyboardButton(text="2K (1440p)", callback_data="quality_1440p")],
-            [InlineKeyboardButton(text="1080p Full HD", callback_data="quality_1080p")],
-            [InlineKeyboardButton(text="720p HD", callback_data="quality_720p")],
-            [InlineKeyboardButton(text="480p", callback_data="quality_480p")],
-        ])
-    else:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🎵 Best Quality (320kbps)", callback_data="quality_best")]
-        ])
+    data = await state.get_data()
+    info = None
+    if not data.get("playlist"):
+        info = await get_metadata(data.get("url", ""), timeout=METADATA_WAIT_SECONDS)
+    keyboard = build_quality_keyboard(format_type, info)
     
     await callback.message.edit_text(
         get_text(user.language, "select_quality"),
@@ -710,167 +3117,849 @@ async def callback_format(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(DownloadStates.selecting_quality)
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("quality_"))
+@dp.callback_query(F.data.startswith("quality_"), flags={"long_running": True})
 async def callback_quality(callback: types.CallbackQuery, state: FSMContext):
-    """Handle quality selection and start download"""
+    """Handle quality selection: start right away with the default storage, or ask"""
     quality = callback.data.split("_")[1]
-    data = await state.get_data()
-    
-    url = data.get("url")
-    format_type = data.get("format")
+    await state.update_data(quality=quality)
     
     user = await get_or_create_user(callback.from_user.id)
     
-    status_msg = await callback.message.edit_text(
-        get_text(user.language, "downloading", progress="0")
-    )
-    
-    file_path = None
-    try:
-        # Download file
-        file_path = await download_video(url, format_type, quality, status_msg, user)
-        
-        if not file_path or not file_path.exists():
-            raise Exception("Download failed")
-        
-        # Check file size
-        file_size_mb = file_path.stat().st_size / (1024 * 1024)
-        
-        # Show storage options for all files
-        await state.update_data(
-            file_path=str(file_path), 
-            file_size_mb=file_size_mb,
-            format_type=format_type
+    if user.default_storage:
+        data = await state.get_data()
+        await state.clear()
+        await callback.answer()
+        status_msg = await callback.message.edit_text(
+            get_text(user.language, "downloading", progress="0")
         )
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(
+        run = deliver_playlist if data.get("playlist") else deliver
+        await run(status_msg, callback.from_user.id, user,
+                  data.get("url"), data.get("format"), quality, user.default_storage)
+        return
+    
+    # Destination is chosen before the download so the upload can start as soon as the file is ready
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(
                 text=get_text(user.language, "telegram_direct"), 
                 callback_data="storage_telegram"
-            )],
-            [InlineKeyboardButton(
+            ),
+            InlineKeyboardButton(
+                text=get_text(user.language, "always_telegram"), 
+                callback_data="storage_telegram_default"
+            ),
+        ],
+        [
+            InlineKeyboardButton(
                 text=get_text(user.language, "save_gdrive"), 
                 callback_data="storage_gdrive"
-            )],
-        ])
-        
-        await status_msg.edit_text(
-            get_text(user.language, "file_info", size=f"{file_size_mb:.1f}"),
-            reply_markup=keyboard
-        )
-        await state.set_state(DownloadStates.selecting_storage)
-        await callback.answer()
-        
-    except Exception as e:
-        logger.error(f"Download failed: {e}")
-        await status_msg.edit_text(
-            get_text(user.language, "failed", error=str(e))
-        )
-        if file_path:
-            await cleanup_file(file_path)
-        await state.clear()
-        await callback.answer()
+            ),
+            InlineKeyboardButton(
+                text=get_text(user.language, "always_gdrive"), 
+                callback_data="storage_gdrive_default"
+            ),
+        ],
+    ])
+    
+    await callback.message.edit_text(
+        get_text(user.language, "select_storage"),
+        reply_markup=keyboard
+    )
+    await state.set_state(DownloadStates.selecting_storage)
+    await callback.answer()
 
-@dp.callback_query(F.data.startswith("storage_"))
+@dp.callback_query(F.data.startswith("storage_"), flags={"long_running": True})
 async def callback_storage(callback: types.CallbackQuery, state: FSMContext):
-    """Handle storage option selection"""
-    storage_type = callback.data.split("_")[1]
+    """Handle storage option selection and start the download"""
+    parts = callback.data.split("_")
+    storage_type = parts[1]
+    remember = parts[-1] == "default"
     data = await state.get_data()
+    await state.clear()
     
-    file_path = Path(data.get("file_path"))
-    file_size_mb = data.get("file_size_mb")
-    format_type = data.get("format_type")
     user = await get_or_create_user(callback.from_user.id)
     
-    try:
-        if storage_type == "telegram":
-            # Upload to Telegram using Pyrogram (supports up to 4GB)
-            status_msg = await callback.message.edit_text(
-                get_text(user.language, "uploading_telegram", progress="0")
-            )
+    if remember:
+        await update_user(user.telegram_id, default_storage=storage_type)
+    
+    await callback.answer()
+    status_msg = await callback.message.edit_text(
+        get_text(user.language, "downloading", progress="0")
+    )
+    run = deliver_playlist if data.get("playlist") else deliver
+    await run(status_msg, callback.from_user.id, user,
+              data.get("url"), data.get("format"), data.get("quality"), storage_type)
+
+# Job records: every delivery is a Job row moving through its states, so a restart can resume it.
+# Rows and their state events are written behind, in batches, like user activity.
+JOB_ACTIVE_STATES = ("queued", "downloading", "postprocessing", "uploading")
+
+class JobRecord:
+    """Handle on a job row; id stays None until the recorder's next flush inserts it"""
+    def __init__(self, job_id: Optional[int] = None, resume_dir: Optional[Path] = None):
+        self.id = job_id
+        self.resume_dir = resume_dir  # Job directory of an interrupted run, handed back to yt-dlp
+        self.pending: Dict = {}
+        self.checkpointed_at = float("-inf")
+
+class JobRecorder:
+    """Write-behind for job rows, their state events and download counts.
+    
+    Changes are merged in memory and written in one transaction every JOB_FLUSH_INTERVAL
+    seconds, or as soon as JOB_FLUSH_BATCH of them are waiting.
+    """
+    
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self._dirty: Dict[int, JobRecord] = {}
+        self._events: List[tuple] = []
+        self._downloads: Dict[int, int] = {}
+        self._lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+    
+    def start(self, **values) -> JobRecord:
+        """A new queued job; its row is inserted with the next flush"""
+        record = JobRecord()
+        self.set_state(record, "queued", created_at=datetime.now(), **values)
+        return record
+    
+    def update(self, record: Optional[JobRecord], **values):
+        if record is None:
+            return
+        record.pending.update(values, updated_at=datetime.now())
+        self._dirty[id(record)] = record
+        self._maybe_flush()
+    
+    def set_state(self, record: Optional[JobRecord], status: str, detail: Optional[str] = None, **values):
+        if record is None:
+            return
+        self._events.append((record, status, datetime.now(), detail))
+        self.update(record, status=status, **values)
+    
+    def count_download(self, telegram_id: int):
+        self._downloads[telegram_id] = self._downloads.get(telegram_id, 0) + 1
+    
+    def _maybe_flush(self):
+        if len(self._dirty) + len(self._events) >= self.batch_size and (
+            self._flush_task is None or self._flush_task.done()
+        ):
+            self._flush_task = asyncio.create_task(self.flush())
+    
+    async def flush(self):
+        """Insert new jobs, update changed ones, add events and bump download totals in one transaction"""
+        async with self._lock:
+            if not (self._dirty or self._events or self._downloads):
+                return
+            changes = [(record, record.pending) for record in self._dirty.values()]
+            events, downloads = self._events, self._downloads
+            self._dirty, self._events, self._downloads = {}, [], {}
+            for record, _ in changes:
+                record.pending = {}
             
-            is_audio = (format_type == "audio")
-            caption = get_text(user.language, "completed")
+            inserted = [(record, Job(**values)) for record, values in changes if record.id is None]
             
-            # Use Pyrogram for upload
-            success = await upload_large_file_pyrogram(
-                file_path=file_path,
-                chat_id=callback.from_user.id,
-                caption=caption,
-                status_msg=status_msg,
-                user_lang=user.language,
-                is_audio=is_audio
-            )
+            async def write(session):
+                session.add_all([row for _, row in inserted])
+                await session.flush()  # assigns the new ids
+                job_ids = {id(record): row.id for record, row in inserted}
+                
+                updates = [dict(values, id=record.id) for record, values in changes if record.id is not None]
+                if updates:
+                    await session.execute(update(Job), updates)
+                session.add_all([
+                    JobEvent(job_id=record.id or job_ids[id(record)], status=status, at=at, detail=detail)
+                    for record, status, at, detail in events
+                ])
+                for telegram_id, count in downloads.items():
+                    await session.execute(
+                        update(User).where(User.telegram_id == telegram_id)
+                        .values(total_downloads=User.total_downloads + count)
+                    )
+                return job_ids
             
-            if success:
-                await status_msg.delete()
-            else:
-                await status_msg.edit_text("❌ Upload failed. Try Google Drive option.")
-                await callback.answer()
+            try:
+                job_ids = await db_writer.run(write)
+            except Exception as e:
+                logger.error(f"Job record flush error: {e}")
+                # Put everything back in front of what arrived meanwhile, the next flush retries it
+                for record, values in changes:
+                    record.pending = {**values, **record.pending}
+                    self._dirty[id(record)] = record
+                self._events = events + self._events
+                for telegram_id, count in downloads.items():
+                    self._downloads[telegram_id] = self._downloads.get(telegram_id, 0) + count
                 return
             
-        elif storage_type == "gdrive":
-            # Check if GDrive is connected
-            if not user.gdrive_token:
-                await callback.message.edit_text(
-                    get_text(user.language, "gdrive_not_connected")
-                )
-                await callback.answer()
-                return
+            for record, _ in inserted:
+                record.id = job_ids[id(record)]
+            for telegram_id in downloads:
+                await user_cache.invalidate(telegram_id)
+
+job_recorder = JobRecorder(JOB_FLUSH_BATCH)
+current_job: ContextVar[Optional[JobRecord]] = ContextVar("current_job", default=None)
+
+def set_job_state(status: str, **values):
+    """Move the job of the current delivery (if any) to status"""
+    job_recorder.set_state(current_job.get(), status, **values)
+
+def checkpoint_job(**values):
+    """Record progress of the current job, at most every JOB_CHECKPOINT_SECONDS"""
+    record = current_job.get()
+    if record is None:
+        return
+    now = time.monotonic()
+    if now - record.checkpointed_at < JOB_CHECKPOINT_SECONDS:
+        return
+    record.checkpointed_at = now
+    job_recorder.update(record, **values)
+
+async def flush_job_records():
+    """Periodic write-behind of job records"""
+    while True:
+        await asyncio.sleep(JOB_FLUSH_INTERVAL)
+        await job_recorder.flush()
+
+async def rollup_stats(day: date):
+    """Recompute one day's DailyStats row from that day's jobs and sign-ups (index range scans)"""
+    start = datetime.combine(day, datetime.min.time())
+    end = start + timedelta(days=1)
+    
+    async def write(session):
+        downloads, failed, size, active_users = (await session.execute(
+            select(
+                func.coalesce(func.sum(case((Job.status == "done", 1), else_=0)), 0),
+                func.coalesce(func.sum(case((Job.status == "failed", 1), else_=0)), 0),
+                func.coalesce(func.sum(case((Job.status == "done", Job.file_size), else_=0)), 0),
+                func.count(func.distinct(Job.user_id)),
+            ).where(Job.completed_at >= start, Job.completed_at < end)
+        )).one()
+        new_users = await session.scalar(
+            select(func.count(User.id)).where(User.first_seen >= start, User.first_seen < end)
+        )
+        total_users = await session.scalar(select(func.count(User.id)))
+        
+        await session.merge(DailyStats(
+            day=day,
+            downloads=downloads,
+            failed=failed,
+            bytes=size,
+            active_users=active_users,
+            new_users=new_users,
+            total_users=total_users,
+            updated_at=datetime.now()
+        ))
+    
+    await db_writer.run(write)
+
+async def run_stats_rollups():
+    """Keep today's DailyStats row fresh; close out yesterday once after midnight"""
+    last_day = None
+    while True:
+        today = date.today()
+        try:
+            await job_recorder.flush()
+            if today != last_day:
+                await rollup_stats(today - timedelta(days=1))
+            await rollup_stats(today)
+            last_day = today
+        except Exception as e:
+            logger.error(f"Stats rollup error: {e}")
+        await asyncio.sleep(STATS_ROLLUP_INTERVAL)
+
+async def get_daily_stats(days: int) -> List[DailyStats]:
+    """Rolled-up rows for the last days, newest first"""
+    async with async_session() as session:
+        result = await session.scalars(
+            select(DailyStats).where(DailyStats.day > date.today() - timedelta(days=days))
+            .order_by(DailyStats.day.desc())
+        )
+        return list(result)
+
+class ResumedStatus:
+    """Status message stand-in for a resumed job, addressed by chat and message id"""
+    def __init__(self, chat_id: int, message_id: Optional[int]):
+        self.chat_id = chat_id
+        self.message_id = message_id
+    
+    async def edit_text(self, text: str, **kwargs):
+        if self.message_id is not None:
+            try:
+                await bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+                return self
+            except TelegramBadRequest as e:
+                if "not modified" in str(e):
+                    return self
+                logger.info(f"Status message {self.message_id} gone ({e}), sending a new one")
+        sent = await bot.send_message(self.chat_id, text, **kwargs)
+        self.message_id = sent.message_id
+        return self
+    
+    async def answer(self, text: str, **kwargs):
+        return await bot.send_message(self.chat_id, text, **kwargs)
+    
+    async def delete(self):
+        if self.message_id is not None:
+            await bot.delete_message(self.chat_id, self.message_id)
+
+async def _resume_job(job: Job):
+    try:
+        user = await get_or_create_user(job.user_id)
+        status_msg = ResumedStatus(job.chat_id, job.message_id)
+        await status_msg.edit_text(get_text(user.language, "resuming"))
+        await deliver(status_msg, job.chat_id, user, job.url, job.format, job.quality,
+                      job.storage, job=JobRecord(job.id, Path(job.work_dir) if job.work_dir else None))
+    except Exception as e:
+        logger.error(f"Resuming job {job.id} failed: {e}")
+        job_recorder.set_state(JobRecord(job.id), "failed", detail=str(e),
+                               error_message=str(e), completed_at=datetime.now())
+
+async def resume_jobs() -> set:
+    """Restart jobs the last run left unfinished; returns their work dirs so the orphan sweep keeps them"""
+    cutoff = datetime.now() - timedelta(hours=JOB_RESUME_HOURS)
+    async with async_session() as session:
+        jobs = (await session.scalars(select(Job).where(Job.status.in_(JOB_ACTIVE_STATES)))).all()
+    
+    keep = set()
+    for job in jobs:
+        if job.created_at < cutoff or not job.chat_id or not job.storage:
+            job_recorder.set_state(JobRecord(job.id), "failed", error_message="Interrupted by a restart",
+                                   completed_at=datetime.now())
+            continue
+        if job.work_dir:
+            # yt-dlp continues its .part files when it gets the same directory back (see _resume_job)
+            keep.add(Path(job.work_dir))
+        asyncio.create_task(_resume_job(job))
+    
+    if jobs:
+        logger.info(f"Resuming {len(keep)} of {len(jobs)} unfinished job(s) with partial downloads")
+    return keep
+
+async def deliver(status_msg: types.Message, chat_id: int, user: User, url: str,
+                  format_type: str, quality: str, storage_type: str, job: Optional[JobRecord] = None) -> bool:
+    """Download (or reuse) and upload to the chosen destination in one go; job resumes an existing row"""
+    video_id = extract_video_id(url)
+    is_audio = (format_type == "audio")
+    caption = get_text(user.language, "completed")
+    file_path = None
+    outcome = "failed"
+    error = None
+    file_size_mb = None
+    gdrive_link = None
+    
+    if job is None:
+        message_id = getattr(status_msg, "message_id", None)
+        job = job_recorder.start(
+            user_id=user.telegram_id,
+            url=url,
+            format=format_type,
+            quality=quality,
+            storage=storage_type,
+            chat_id=chat_id,
+            message_id=message_id if isinstance(message_id, int) else None
+        )
+    job_token = current_job.set(job)
+    
+    try:
+        # Check if GDrive is connected before downloading anything
+        if storage_type == "gdrive" and not user.gdrive_token:
+            error = "Google Drive not connected"
+            await status_msg.edit_text(get_text(user.language, "gdrive_not_connected"))
+            return False
+        
+        cached = await result_cache.get(video_id, format_type, quality)
+        
+        if storage_type == "telegram":
+            if cached.get("telegram_file_id"):
+                # Already uploaded for someone else: skip the download entirely
+                file_id = await send_cached_file(cached["telegram_file_id"], chat_id, caption, is_audio)
+                file_size_mb = float(cached.get("size_mb", 0))
+            else:
+                stream_meta = None
+                if STREAM_UPLOADS:
+                    stream_meta = await probe_streamable(url, format_type, quality)
+                
+                if stream_meta:
+                    # Single-file format: upload while it downloads, nothing staged on disk
+                    file_size_mb = stream_meta['size'] / (1024 * 1024)
+                    set_job_state("uploading")
+                    file_id = await stream_to_telegram(
+                        url, format_type, stream_meta, chat_id, caption, status_msg, user
+                    )
+                else:
+                    file_path = await run_download(url, format_type, quality, status_msg, user)
+                    if not file_path or not file_path.exists():
+                        raise Exception("Download failed")
+                    file_size_mb = file_path.stat().st_size / (1024 * 1024)
+                    set_job_state("uploading", file_size=file_path.stat().st_size)
+                    
+                    # Use Pyrogram for upload (supports up to 4GB)
+                    file_id = await upload_large_file_pyrogram(
+                        file_path=file_path,
+                        chat_id=chat_id,
+                        caption=caption,
+                        status_msg=status_msg,
+                        user_lang=user.language,
+                        is_audio=is_audio
+                    )
+                
+                if file_id:
+                    await result_cache.put(
+                        video_id, format_type, quality,
+                        telegram_file_id=file_id, size_mb=f"{file_size_mb:.1f}"
+                    )
             
-            # Upload to Google Drive
-            status_msg = callback.message
-            gdrive_link = await upload_to_gdrive(file_path, user, status_msg)
+            await progress_hub.close(status_msg)
+            if not file_id:
+                error = "Telegram upload failed"
+                await status_msg.edit_text("❌ Upload failed. Try Google Drive option.")
+                return False
+            await status_msg.delete()
             
-            if gdrive_link:
-                await callback.message.answer(
-                    get_text(
-                        user.language, 
-                        "gdrive_link", 
-                        url=gdrive_link,
-                        size=f"{file_size_mb:.1f}"
-                    )
-                )
-                await status_msg.delete()
+        elif storage_type == "gdrive":
+            # Only this user's own earlier copy counts: another user's link points into their Drive
+            file_id_field, link_field = result_cache.drive_fields(user.telegram_id)
+            if cached.get(link_field):
+                gdrive_file = {'id': cached.get(file_id_field), 'webViewLink': cached[link_field]}
+                file_size_mb = float(cached.get("size_mb", 0))
             else:
-                await callback.message.edit_text(
-                    get_text(user.language, "gdrive_error")
+                stream_meta = None
+                if STREAM_UPLOADS:
+                    stream_meta = await probe_streamable(url, format_type, quality)
+                
+                if stream_meta:
+                    set_job_state("uploading")
+                    gdrive_file = await stream_to_gdrive(url, format_type, stream_meta, status_msg, user)
+                    file_size_mb = int((gdrive_file or {}).get('size') or stream_meta['size']) / (1024 * 1024)
+                else:
+                    file_path = await run_download(url, format_type, quality, status_msg, user)
+                    if not file_path or not file_path.exists():
+                        raise Exception("Download failed")
+                    file_size_mb = file_path.stat().st_size / (1024 * 1024)
+                    set_job_state("uploading", file_size=file_path.stat().st_size)
+                    
+                    # Upload to Google Drive
+                    gdrive_file = await upload_to_gdrive(file_path, user, status_msg)
+                
+                if gdrive_file:
+                    await result_cache.put(
+                        video_id, format_type, quality,
+                        size_mb=f"{file_size_mb:.1f}",
+                        **{file_id_field: gdrive_file.get('id'), link_field: gdrive_file.get('webViewLink')}
+                    )
+            
+            await progress_hub.close(status_msg)
+            if not gdrive_file:
+                error = "Drive upload failed"
+                await status_msg.edit_text(get_text(user.language, "gdrive_error"))
+                return False
+            gdrive_link = gdrive_file.get('webViewLink')
+            await status_msg.answer(
+                get_text(
+                    user.language, 
+                    "gdrive_link", 
+                    url=gdrive_file.get('webViewLink'),
+                    size=f"{file_size_mb:.1f}"
                 )
-        
-        # Update user stats
-        async with async_session() as session:
-            result = await session.execute(
-                select(User).where(User.telegram_id == user.telegram_id)
             )
-            db_user = result.scalar_one()
-            db_user.total_downloads += 1
-            await session.commit()
+            await status_msg.delete()
         
+        # Update user stats (written with the next job record flush)
+        job_recorder.count_download(user.telegram_id)
+        outcome = "success"
+        return True
+        
+    except QueueFullError:
+        outcome = "rejected"
+        error = "Queue full"
+        await progress_hub.close(status_msg)
+        await status_msg.edit_text(get_text(user.language, "queue_full"))
+        return False
+    except TempStorageFull as e:
+        outcome = "rejected"
+        error = str(e)
+        logger.warning(f"Download refused: {e}")
+        await progress_hub.close(status_msg)
+        await status_msg.edit_text(get_text(user.language, "storage_full"))
+        return False
+    except asyncio.CancelledError:
+        # Shutdown: leave the job row active and its files in place, resume_jobs() picks it up
+        outcome = "interrupted"
+        raise
     except Exception as e:
-        logger.error(f"Upload failed: {e}")
-        await callback.message.answer(
+        logger.error(f"Download failed: {e}")
+        error = str(e)
+        await progress_hub.close(status_msg)
+        await status_msg.edit_text(
             get_text(user.language, "failed", error=str(e))
         )
+        return False
     finally:
-        # Always cleanup file from VPS
-        await cleanup_file(file_path)
+        current_job.reset(job_token)
+        if outcome != "interrupted":
+            DELIVERIES.labels(storage_type, outcome).inc()
+            job_recorder.set_state(
+                job,
+                "done" if outcome == "success" else "failed",
+                detail=error,
+                completed_at=datetime.now(),
+                error_message=error,
+                file_size=int(file_size_mb * 1024 * 1024) if file_size_mb else None,
+                gdrive_link=gdrive_link
+            )
+            # Always cleanup file from VPS
+            await cleanup_file(file_path)
+
+# Playlist / channel mode: entries expand lazily, items run through deliver() a few at a time
+def _expand_playlist(url: str, max_items: int, emit, stop: threading.Event):
+    """Feed flat playlist entries to emit as yt-dlp pages through them (runs in a thread)"""
+    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'extract_flat': 'in_playlist'}) as ydl:
+        info = ydl.extract_info(url, download=False, process=False)
+        for n, entry in enumerate(info.get('entries') or []):
+            if stop.is_set() or n >= max_items:
+                break
+            emit(entry)
+
+async def iter_playlist(url: str, max_items: int) -> AsyncIterator[dict]:
+    """Playlist entries as they are found; the expander waits while the consumer is busy"""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+    stop = threading.Event()
     
-    await state.clear()
-    await callback.answer()
+    def emit(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+    
+    def expand():
+        try:
+            _expand_playlist(url, max_items, emit, stop)
+        except Exception as e:
+            emit(e)
+        finally:
+            emit(None)
+    
+    expander = loop.run_in_executor(None, expand)
+    try:
+        while (item := await queue.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        while not expander.done():
+            # Unblock a pending emit so the thread can see stop and exit
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.sleep(0.05)
+
+class PlaylistProgress:
+    """One status message for a whole playlist; edits go through the progress hub"""
+    def __init__(self, message: types.Message, user_lang: str):
+        self.message = message
+        self.user_lang = user_lang
+        self.running: Dict[int, list] = {}  # index -> [title, latest status line]
+        self.total = self.done = self.failed = 0
+        self.expanding = True
+        self.limited = False
+    
+    def add(self, title: str) -> "PlaylistItemStatus":
+        index = self.total
+        self.total += 1
+        self.running[index] = [title, ""]
+        return PlaylistItemStatus(self, index)
+    
+    async def finish(self, index: int, ok: bool):
+        self.running.pop(index, None)
+        if ok:
+            self.done += 1
+        else:
+            self.failed += 1
+        self.refresh()
+    
+    def render(self) -> str:
+        if self.expanding:
+            total = f"{self.total}+"
+        else:
+            total = str(self.total)
+        key = "playlist_progress" if self.expanding or self.running else "playlist_done"
+        lines = [get_text(self.user_lang, key, done=self.done, total=total, failed=self.failed)]
+        for title, status in self.running.values():
+            lines.append(f"• {title[:40]}: {status}")
+        if self.limited:
+            lines.append(get_text(self.user_lang, "playlist_limited"))
+        return "\n".join(lines)
+    
+    def refresh(self):
+        progress_hub.post(self.message, self.render())
+    
+    async def close(self):
+        """Final summary, edited straight away"""
+        await progress_hub.close(self.message)
+        try:
+            await self.message.edit_text(self.render())
+        except Exception as e:
+            logger.error(f"Playlist progress update error: {e}")
+
+class PlaylistItemStatus:
+    """Status message stand-in for one playlist item: edits feed the shared summary"""
+    def __init__(self, progress: PlaylistProgress, index: int):
+        self.progress = progress
+        self.index = index
+    
+    async def edit_text(self, text: str, **kwargs):
+        if self.index in self.progress.running:
+            self.progress.running[self.index][1] = text.splitlines()[0]
+        self.progress.refresh()
+        return self
+    
+    async def answer(self, text: str, **kwargs):
+        return await self.progress.message.answer(text, **kwargs)
+    
+    async def delete(self):
+        pass
+
+async def deliver_playlist(status_msg: types.Message, chat_id: int, user: User, url: str,
+                           format_type: str, quality: str, storage_type: str) -> bool:
+    """Deliver every entry of a playlist or channel, PLAYLIST_PARALLEL at a time"""
+    progress = PlaylistProgress(status_msg, user.language)
+    slots = asyncio.Semaphore(PLAYLIST_PARALLEL)
+    tasks = set()
+    tier = user_tier(user)
+    
+    async def run_item(item_status: PlaylistItemStatus, item_url: str):
+        ok = False
+        try:
+            ok = await deliver(item_status, chat_id, user, item_url, format_type, quality, storage_type)
+        finally:
+            slots.release()
+            await progress.finish(item_status.index, ok)
+    
+    try:
+        async with aclosing(iter_playlist(url, PLAYLIST_MAX_ITEMS)) as entries:
+            async for entry in entries:
+                # Waiting here also pauses the expansion: entries are only fetched when a slot frees up
+                await slots.acquire()
+                allowed, _ = await rate_limiter.hit(user.telegram_id, tier)
+                if not allowed:
+                    slots.release()
+                    progress.limited = True
+                    break
+                
+                item_url = entry.get('url') or entry['id']
+                if not item_url.startswith("http"):
+                    item_url = f"https://www.youtube.com/watch?v={entry['id']}"
+                item_status = progress.add(entry.get('title') or entry['id'])
+                task = asyncio.create_task(run_item(item_status, item_url))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    except Exception as e:
+        logger.error(f"Playlist expansion error: {e}")
+        if not progress.total:
+            await status_msg.edit_text(get_text(user.language, "failed", error=str(e)))
+            return False
+    
+    progress.expanding = False
+    progress.refresh()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await progress.close()
+    return progress.failed == 0
 
-async def cleanup_old_files():
-    """Periodic cleanup of old files"""
+async def process_remote_job(job_id: str):
+    """Run one leased job, keeping its lease alive with heartbeats"""
+    job = await job_queue.get(job_id)
+    task = None
+    
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            if not await job_queue.heartbeat(job_id):
+                logger.warning(f"Lease lost for job {job_id}, abandoning")
+                if task:
+                    task.cancel()
+                return
+    
+    beat = asyncio.create_task(heartbeat())
+    try:
+        payload = json.loads(job['payload'])
+        user = await get_or_create_user(int(job['user_id']))
+        task = asyncio.create_task(download_video(
+            payload['url'], payload['format'], payload['quality'], RemoteStatus(job_id), user
+        ))
+        file_path = await task
+        if not file_path or not file_path.exists():
+            raise Exception("Download failed")
+        # The front end uploads and deletes the file from here on
+        temp_storage.detach(file_path.parent)
+        await job_queue.complete(job_id, {'file_path': str(file_path)})
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {e}")
+        await job_queue.fail(job_id, str(e))
+    finally:
+        beat.cancel()
+
+async def reap_expired_jobs():
+    """Periodically requeue jobs from crashed workers"""
     while True:
         try:
-            cutoff_time = datetime.now().timestamp() - 600
-            for file in TMP_DIR.glob("*"):
-                if file.is_file() and file.stat().st_mtime < cutoff_time:
-                    file.unlink()
-                    logger.info(f"Cleaned up old file: {file}")
+            requeued = await job_queue.reap()
+            if requeued:
+                logger.warning(f"Requeued {requeued} job(s) with expired leases")
         except Exception as e:
-            logger.error(f"Cleanup task error: {e}")
+            logger.error(f"Reaper error: {e}")
         
-        await asyncio.sleep(300)
+        await asyncio.sleep(JOB_LEASE_SECONDS / 2)
+
+async def sample_metrics():
+    """Refresh queue gauges and measure event-loop lag"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(METRICS_SAMPLE_INTERVAL)
+        LOOP_LAG.set(max(0.0, loop.time() - started - METRICS_SAMPLE_INTERVAL))
+        
+        try:
+            if QUEUE_BACKEND == "redis":
+                QUEUE_DEPTH.set(int(await redis_client.get(job_queue.SIZE) or 0))
+                ACTIVE_JOBS.set(await redis_client.zcard(job_queue.LEASES))
+            else:
+                QUEUE_DEPTH.set(download_scheduler.queued_count)
+                ACTIVE_JOBS.set(download_scheduler.active_count)
+            TEMP_RESERVED.set(temp_storage.reserved)
+        except Exception as e:
+            logger.error(f"Metrics sampling error: {e}")
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+async def handle_health(request: web.Request) -> web.Response:
+    return web.json_response({
+        "status": "ok",
+        "queued": metric_value("ytdl_queue_depth"),
+        "active": metric_value("ytdl_active_jobs"),
+        "loop_lag": metric_value("ytdl_event_loop_lag_seconds")
+    })
+
+async def start_metrics_server() -> Optional[web.AppRunner]:
+    """Serve /metrics and /health on METRICS_PORT when ENABLE_METRICS is on"""
+    asyncio.create_task(sample_metrics())
+    loop_watchdog.start(asyncio.get_running_loop())
+    if not ENABLE_METRICS:
+        return None
+    
+    metrics_app = web.Application()
+    metrics_app.router.add_get("/metrics", handle_metrics)
+    metrics_app.router.add_get("/health", handle_health)
+    runner = web.AppRunner(metrics_app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", METRICS_PORT).start()
+    logger.info(f"Metrics on :{METRICS_PORT}/metrics")
+    return runner
+
+async def run_worker():
+    """Download worker entry point (see worker.py)"""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    logger.info(f"Starting download worker {worker_id}...")
+    
+    await init_db()
+    metrics_runner = await start_metrics_server()
+    asyncio.create_task(reap_expired_jobs())
+    
+    slots = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    try:
+        while True:
+            await slots.acquire()
+            try:
+                job_id = await job_queue.dequeue(worker_id)
+            except Exception as e:
+                logger.error(f"Dequeue error: {e}")
+                job_id = None
+            
+            if not job_id:
+                slots.release()
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            
+            logger.info(f"Worker {worker_id} leased job {job_id}")
+            task = asyncio.create_task(process_remote_job(job_id))
+            task.add_done_callback(lambda _: slots.release())
+    finally:
+        download_executor.shutdown()
+        postprocess_pool.shutdown(wait=False, cancel_futures=True)
+        loop_watchdog.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Webhook handler: answers Telegram at once and handles each update as its own task.
+    
+    Past max_in_flight running updates it answers 503, so nginx tries another
+    replica and Telegram redelivers later instead of this process piling up work.
+    An update stops counting once its handler is flagged long_running.
+    """
+    
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_in_flight: int, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._tasks: set = set()
+        UPDATES_IN_FLIGHT.set_function(lambda: self.in_flight)
+    
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        if self.in_flight >= self.max_in_flight:
+            UPDATES_REJECTED.inc()
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        
+        update = await request.json(loads=bot.session.json_loads)
+        self.in_flight += 1
+        task = asyncio.create_task(self._process(bot, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+    
+    async def _process(self, bot: Bot, update: dict):
+        released = False
+        
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.in_flight -= 1
+        
+        webhook_slot.set(release)
+        try:
+            result = await self.dispatcher.feed_raw_update(bot=bot, update=update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot=bot, result=result)
+        finally:
+            release()
+
+async def run_webhook():
+    """Receive updates on WEBHOOK_PATH (behind nginx) until cancelled"""
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    
+    webhook_app = web.Application()
+    BoundedRequestHandler(
+        dp, bot, MAX_UPDATES_IN_FLIGHT, secret_token=WEBHOOK_SECRET
+    ).register(webhook_app, path=WEBHOOK_PATH)
+    webhook_app.router.add_get("/health", handle_health)
+    setup_application(webhook_app, dp, bot=bot)
+    
+    runner = web.AppRunner(webhook_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT, backlog=1024).start()
+    logger.info(f"Webhook listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 async def main():
     """Main function"""
@@ -883,19 +3972,36 @@ async def main():
     # Initialize database
     await init_db()
     
-    # Start Pyrogram client
-    await app.start()
-    logger.info("Pyrogram client started")
+    # Start Pyrogram clients
+    await telegram_pool.start()
+    logger.info(f"Pyrogram clients started ({len(telegram_pool.clients)} sessions)")
     
-    # Start cleanup task
-    asyncio.create_task(cleanup_old_files())
+    # Unfinished jobs of the last run continue; other leftovers are removed, live jobs clean up after themselves
+    resumed_dirs = await resume_jobs()
+    temp_storage.sweep_orphans(TEMP_ORPHAN_HOURS * 3600, keep=resumed_dirs)
+    asyncio.create_task(flush_user_activity())
+    asyncio.create_task(flush_job_records())
+    asyncio.create_task(run_stats_rollups())
+    metrics_runner = await start_metrics_server()
     
-    # Start polling
+    # Start polling, or the webhook server when WEBHOOK_URL is set
     try:
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()  # getUpdates is refused while a webhook is set
+            await dp.start_polling(bot)
     finally:
+        download_executor.shutdown()
+        postprocess_pool.shutdown(wait=False, cancel_futures=True)
+        await user_cache.flush()
+        await job_recorder.flush()
+        await drive_uploader.close()
         await bot.session.close()
-        await app.stop()
+        await telegram_pool.stop()
+        loop_watchdog.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     try:
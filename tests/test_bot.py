@@ -50,6 +50,56 @@ class TestUserManagement:
         assert user2.first_seen == original_first_seen
 
 
+class TestUserCache:
+    """Test the read-through user cache"""
+    
+    @pytest.mark.asyncio
+    async def test_cached_reads_and_batched_activity(self):
+        """Test repeat lookups skip the database and activity is flushed in one batch"""
+        from bot import user_cache, async_session, User
+        from sqlalchemy import select
+        
+        await get_or_create_user(333333, "before")
+        with patch('bot.async_session') as mock_session:
+            user = await get_or_create_user(333333, "after")
+            mock_session.assert_not_called()
+        assert user.username == "after"
+        
+        await user_cache.flush()
+        async with async_session() as session:
+            result = await session.execute(select(User).where(User.telegram_id == 333333))
+            db_user = result.scalar_one()
+            assert db_user.username == "after"
+            assert db_user.last_active == user.last_active
+    
+    @pytest.mark.asyncio
+    async def test_update_invalidates_cache(self):
+        """Test writes through update_user are visible on the next read"""
+        from bot import update_user
+        
+        await get_or_create_user(333334)
+        await update_user(333334, default_storage="telegram")
+        
+        user = await get_or_create_user(333334)
+        assert user.default_storage == "telegram"
+    
+    @pytest.mark.asyncio
+    async def test_expired_entries_pruned_and_failed_flush_kept(self):
+        """Test local copies don't pile up and activity survives a failed write"""
+        from bot import UserCache
+        
+        cache = UserCache(ttl=60, local_ttl=0)
+        user = await get_or_create_user(333335)
+        await cache.put(user)
+        
+        cache.touch(user, "renamed")
+        with patch('bot.db_writer.run', AsyncMock(side_effect=Exception("database is locked"))):
+            await cache.flush()
+        
+        assert cache._local == {}
+        assert cache._dirty[user.id]["username"] == "renamed"
+
+
 class TestRateLimiting:
     """Test rate limiting functionality"""
     
@@ -83,6 +133,20 @@ class TestRateLimiting:
         
         count = await get_today_downloads(user_id)
         assert count == 5
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_hits_never_exceed_limit(self):
+        """Test the limiter is atomic under concurrent clicks, for both policies"""
+        from bot import RateLimiter, redis_client
+        
+        for policy in ("sliding", "bucket"):
+            limiter = RateLimiter(redis_client, policy, 86400, 3, {"premium": 5})
+            results = await asyncio.gather(*[limiter.hit(666000, "free") for _ in range(10)])
+            assert sum(allowed for allowed, _ in results) == 3
+            assert await limiter.hit(666000, "free", cost=0) == (False, 3)
+            
+            results = await asyncio.gather(*[limiter.hit(666001, "premium") for _ in range(10)])
+            assert sum(allowed for allowed, _ in results) == 5
 
 
 class TestURLValidation:
@@ -113,6 +177,14 @@ class TestURLValidation:
         
         for url in invalid_urls:
             assert not is_valid_youtube_url(url), f"Should fail for: {url}"
+    
+    def test_extract_video_id(self):
+        """Test canonical video ID extraction"""
+        from bot import extract_video_id
+        
+        assert extract_video_id("https://youtu.be/dQw4w9WgXcQ") == "dQw4w9WgXcQ"
+        assert extract_video_id("https://youtube.com/watch?v=dQw4w9WgXcQ&t=10s") == "dQw4w9WgXcQ"
+        assert extract_video_id("https://example.com") is None
 
 
 class TestTranslations:
@@ -214,6 +286,849 @@ class TestDownloadFunctionality:
                     test_file.unlink()
 
 
+class TestDownloadExecutor:
+    """Test the off-loop download pool"""
+    
+    @pytest.mark.asyncio
+    async def test_handle_streams_progress_and_result(self):
+        """Test awaiting a job and reading its progress stream"""
+        from bot import DownloadExecutor
+        
+        def job(progress_hook):
+            progress_hook({'status': 'downloading', '_percent_str': '50%'})
+            return "done"
+        
+        executor = DownloadExecutor(2)
+        try:
+            handle = executor.submit(job)
+            events = [d async for d in handle.progress()]
+            
+            assert await handle == "done"
+            assert events[-1]['_percent_str'] == '50%'
+            assert executor.active == 0
+        finally:
+            executor.shutdown()
+    
+    @pytest.mark.asyncio
+    async def test_cancel_running_job(self):
+        """Test cancelling a job that is already running"""
+        import threading
+        import yt_dlp
+        from bot import DownloadExecutor
+        
+        started = threading.Event()
+        
+        def job(progress_hook):
+            started.set()
+            while True:
+                progress_hook({'status': 'downloading'})
+        
+        executor = DownloadExecutor(1)
+        try:
+            handle = executor.submit(job)
+            await asyncio.get_running_loop().run_in_executor(None, started.wait)
+            handle.cancel()
+            
+            with pytest.raises((asyncio.CancelledError, yt_dlp.utils.DownloadCancelled)):
+                await handle
+        finally:
+            executor.shutdown()
+
+
+class TestPostprocessStage:
+    """Test ffmpeg work is split off the download threads"""
+    
+    def test_postprocessing_deferred_to_pool(self, tmp_path):
+        """Test the download only stages postprocessing, the pool stage runs it"""
+        from bot import _run_ytdlp, _postprocess
+        
+        merged = tmp_path / "video.mp4"
+        
+        def run_pps(filename, info, files_to_move=None):
+            merged.touch()
+            return dict(info, filepath=str(merged))
+        
+        with patch('yt_dlp.YoutubeDL') as mock_ydl:
+            ydl = mock_ydl.return_value.__enter__.return_value
+            ydl.params = {}
+            ydl.post_process = Mock(side_effect=run_pps)
+            
+            def extract_info(url, download):
+                info = {'title': 'Video', 'ext': 'mp4'}
+                return ydl.post_process(str(tmp_path / "video.f137.mp4"), info)
+            
+            ydl.extract_info.side_effect = extract_info
+            ydl.prepare_filename.return_value = str(merged)
+            
+            staged, base_name = _run_ytdlp("https://youtube.com/watch?v=test", {}, None, Mock())
+            assert len(staged) == 1
+            assert not merged.exists()
+            
+            assert _postprocess(staged, base_name, "video", tmp_path) == merged
+
+
+class TestBandwidthManager:
+    """Test the download connection budget and per-job tuning"""
+    
+    def test_budget_split_across_jobs(self):
+        """Test plain HTTP jobs take one socket and fragmented jobs share the rest"""
+        from bot import BandwidthManager
+        
+        manager = BandwidthManager(budget=8, max_fragments=6, rate_limit=0)
+        plain, first, second = ({} for _ in range(3))
+        transfers = [manager.open(params) for params in (plain, first, second)]
+        
+        manager.start_format(transfers[1], {'protocol': 'http_dash_segments'})
+        manager.start_format(transfers[2], {'protocol': 'm3u8_native'})
+        assert plain['concurrent_fragment_downloads'] == 1
+        assert sorted([first['concurrent_fragment_downloads'], second['concurrent_fragment_downloads']]) == [3, 4]
+        
+        manager.close(transfers[2])
+        assert first['concurrent_fragment_downloads'] == 6
+    
+    def test_tuned_from_throughput(self):
+        """Test a capped job keeps only the connections it needs and chunks follow its speed"""
+        from bot import BandwidthManager
+        
+        mb = 1024 * 1024
+        manager = BandwidthManager(budget=32, max_fragments=6, rate_limit=4 * mb)
+        fast, slow = {}, {}
+        fast_transfer, slow_transfer = manager.open(fast), manager.open(slow)
+        manager.start_format(fast_transfer, {'fragments': [{}]})
+        assert fast['ratelimit'] == 4 * mb / 6
+        
+        manager.sample(fast_transfer, {'status': 'downloading', 'speed': 12 * mb})  # 2MB/s per connection
+        manager._rebalanced = 0
+        manager.sample(slow_transfer, {'status': 'downloading', 'speed': mb / 2})
+        assert fast['concurrent_fragment_downloads'] == 2 and fast['ratelimit'] == 2 * mb
+        assert fast['http_chunk_size'] == 10 * mb
+        assert slow['http_chunk_size'] == 2 * mb and slow['ratelimit'] == 4 * mb
+
+
+class TestDownloadScheduler:
+    """Test the fair download scheduler"""
+    
+    @pytest.mark.asyncio
+    async def test_round_robin_between_users(self):
+        """Test a heavy user cannot starve a light one"""
+        from bot import DownloadScheduler
+        
+        scheduler = DownloadScheduler(1, 1, 10, 100)
+        await scheduler.acquire(1)
+        
+        order = []
+        async def job(user_id):
+            async with scheduler.slot(user_id):
+                order.append(user_id)
+        
+        tasks = [asyncio.create_task(job(1)) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(job(2)))
+        await asyncio.sleep(0)
+        
+        scheduler.release(1)
+        await asyncio.gather(*tasks)
+        
+        assert order[:2] == [1, 2]
+        assert scheduler.active_count == 0
+    
+    @pytest.mark.asyncio
+    async def test_queue_position_and_admission(self):
+        """Test queue position feedback and per-user admission control"""
+        from bot import DownloadScheduler, QueueFullError
+        
+        scheduler = DownloadScheduler(1, 1, 1, 100)
+        await scheduler.acquire(1)
+        
+        positions = []
+        waiter = asyncio.create_task(scheduler.acquire(2, positions.append))
+        await asyncio.sleep(0)
+        
+        assert positions == [1]
+        with pytest.raises(QueueFullError):
+            await scheduler.acquire(2)
+        
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.queued_count == 0
+
+
+class TestRedisJobQueue:
+    """Test the distributed job queue (needs Redis, like the rate limit tests)"""
+    
+    @pytest.mark.asyncio
+    async def test_round_robin_lease_and_requeue(self):
+        """Test fair dequeue order and requeue of an expired lease"""
+        from bot import job_queue, redis_client
+        
+        keys = await redis_client.keys("jobq:*")
+        if keys:
+            await redis_client.delete(*keys)
+        
+        first = await job_queue.enqueue(1, {'url': 'a'}, "a:video:720p")
+        await job_queue.enqueue(1, {'url': 'b'}, "b:video:720p")
+        other = await job_queue.enqueue(2, {'url': 'c'}, "c:video:720p")
+        
+        # Same video requested again while queued: coalesced into the first job
+        assert await job_queue.enqueue(3, {'url': 'a'}, "a:video:720p") == first
+        
+        assert await job_queue.dequeue("w1") == first
+        assert await job_queue.dequeue("w1") == other
+        
+        # Simulate a crashed worker
+        await redis_client.zadd(job_queue.LEASES, {first: 0})
+        assert await job_queue.reap() == 1
+        assert (await job_queue.get(first))['state'] == "queued"
+
+
+class TestResultCache:
+    """Test the upload result cache (needs Redis)"""
+    
+    @pytest.mark.asyncio
+    async def test_put_get_and_lru_eviction(self):
+        """Test cache hits and eviction of the least recently used entry"""
+        from bot import ResultCache, redis_client
+        
+        await redis_client.delete(ResultCache.LRU)
+        cache = ResultCache(redis_client, ttl=60, max_entries=2)
+        
+        await cache.put("aaaaaaaaaaa", "video", "720p", telegram_file_id="f1", size_mb="1.0")
+        await cache.put("bbbbbbbbbbb", "video", "720p", telegram_file_id="f2")
+        assert (await cache.get("aaaaaaaaaaa", "video", "720p"))["telegram_file_id"] == "f1"
+        
+        file_id_field, link_field = ResultCache.drive_fields(1)
+        await cache.put("ccccccccccc", "audio", "best", **{file_id_field: "d1", link_field: "https://drive"})
+        
+        assert await cache.get("bbbbbbbbbbb", "video", "720p") == {}
+        assert await cache.get("aaaaaaaaaaa", "video", "1080p") == {}
+        cached = await cache.get("ccccccccccc", "audio", "best")
+        assert cached[link_field] == "https://drive"
+        assert ResultCache.drive_fields(2)[1] not in cached
+
+    
+    @pytest.mark.asyncio
+    async def test_drive_copy_not_shared_between_users(self):
+        """Test another user's cached Drive link is not reused: this user gets their own upload"""
+        from bot import deliver, ResultCache, User
+        
+        user = User(id=1, telegram_id=222221, language="bn", gdrive_token=b"token", total_downloads=0)
+        other_fields = ResultCache.drive_fields(222222)
+        status_msg = AsyncMock()
+        file_path = Path("/tmp/drive_cache_test.mp4")
+        file_path.write_bytes(b"x")
+        
+        with patch('bot.result_cache.get', AsyncMock(return_value={other_fields[1]: "https://other", "size_mb": "1"})), \
+             patch('bot.result_cache.put', new_callable=AsyncMock), \
+             patch('bot.run_download', AsyncMock(return_value=file_path)), \
+             patch('bot.upload_to_gdrive', AsyncMock(return_value={'id': 'mine', 'webViewLink': "https://mine"})) as upload:
+            assert await deliver(status_msg, 1, user, "https://youtu.be/eeeeeeeeeee", "video", "720p", "gdrive")
+        
+        upload.assert_awaited_once()
+        assert "https://mine" in status_msg.answer.call_args[0][0]
+
+class TestMetadataPrefetch:
+    """Test the metadata stage and the quality menu built from it"""
+    
+    @pytest.mark.asyncio
+    async def test_quality_menu_from_real_formats(self):
+        """Test only heights the mp4+m4a selector can deliver are offered, with their sizes"""
+        from bot import build_quality_keyboard
+        
+        info = {'duration': 100, 'formats': [
+            {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a', 'filesize': 2 * 1024 * 1024},
+            {'format_id': '251', 'ext': 'webm', 'vcodec': 'none', 'acodec': 'opus', 'filesize': 9 * 1024 * 1024},
+            {'format_id': '271', 'ext': 'webm', 'height': 1440, 'vcodec': 'vp9', 'acodec': 'none',
+             'filesize': 90 * 1024 * 1024},
+            {'format_id': '248', 'ext': 'webm', 'height': 1080, 'vcodec': 'vp9', 'acodec': 'none',
+             'filesize': 70 * 1024 * 1024},
+            {'format_id': '137', 'ext': 'mp4', 'height': 1080, 'vcodec': 'avc1', 'acodec': 'none',
+             'filesize': 50 * 1024 * 1024},
+            {'format_id': '18', 'ext': 'mp4', 'height': 360, 'vcodec': 'avc1', 'acodec': 'mp4a', 'tbr': 500},
+        ]}
+        keyboard = build_quality_keyboard("video", info)
+        buttons = [b for row in keyboard.inline_keyboard for b in row]
+        
+        assert [b.callback_data for b in buttons] == ["quality_best", "quality_1080p", "quality_360p"]
+        assert "~52MB" in buttons[1].text
+    
+    def test_audio_menu_offers_passthrough_and_mp3(self):
+        """Test the audio menu offers the original stream and MP3, and only MP3 transcodes"""
+        from bot import build_quality_keyboard, build_ydl_opts
+        
+        info = {'duration': 100, 'formats': [
+            {'format_id': '251', 'vcodec': 'none', 'acodec': 'opus', 'filesize': 3 * 1024 * 1024},
+        ]}
+        keyboard = build_quality_keyboard("audio", info)
+        buttons = [b for row in keyboard.inline_keyboard for b in row]
+        assert [b.callback_data for b in buttons] == ["quality_original", "quality_best"]
+        assert "~3MB" in buttons[0].text
+        
+        codecs = {
+            quality: build_ydl_opts("audio", quality, "%(title)s.%(ext)s")['postprocessors'][0]['preferredcodec']
+            for quality in ("original", "best")
+        }
+        assert codecs == {"original": "best", "best": "mp3"}
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_extract_once(self):
+        """Test one extraction serves concurrent callers and later ones hit Redis"""
+        from bot import get_metadata, prefetch_metadata
+        
+        info = {'id': 'aBcDeFgHiJk', 'title': 'Test', 'formats': []}
+        url = "https://youtu.be/aBcDeFgHiJk"
+        with patch('bot._extract_info', return_value=info) as mock_extract:
+            prefetch_metadata(url)
+            results = await asyncio.gather(get_metadata(url), get_metadata(url))
+            assert await get_metadata(url) == info
+        
+        assert results == [info, info]
+        mock_extract.assert_called_once()
+
+
+class TestPlaylistMode:
+    """Test playlist and channel downloads"""
+    
+    def test_playlist_urls(self):
+        """Test playlist and channel URLs are recognised, watch URLs are not"""
+        from bot import is_playlist_url
+        
+        assert is_playlist_url("https://www.youtube.com/playlist?list=PLabc123")
+        assert is_playlist_url("https://youtube.com/@channel/videos")
+        assert not is_playlist_url("https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PLabc123")
+    
+    @pytest.mark.asyncio
+    async def test_items_bounded_and_summarised(self):
+        """Test items run a few at a time and report into one message"""
+        from bot import deliver_playlist
+        
+        def expand(url, max_items, emit, stop):
+            for i in range(5):
+                emit({'id': f"video{i:06d}", 'title': f"Video {i}"})
+        
+        running = []
+        peak = [0]
+        async def fake_deliver(status, chat_id, user, url, *args):
+            running.append(url)
+            peak[0] = max(peak[0], len(running))
+            await status.edit_text("⏬ 50%")
+            await asyncio.sleep(0.01)
+            running.remove(url)
+            return not url.endswith("video000003")
+        
+        user = await get_or_create_user(123450002)
+        status_msg = AsyncMock()
+        with patch('bot._expand_playlist', expand), \
+             patch('bot.deliver', side_effect=fake_deliver), \
+             patch('bot.PLAYLIST_PARALLEL', 2):
+            ok = await deliver_playlist(status_msg, 1, user, "https://youtube.com/@c", "video", "720p", "telegram")
+        
+        assert not ok
+        assert peak[0] == 2
+        assert "4/5" in status_msg.edit_text.call_args[0][0]
+        assert "1 ব্যর্থ" in status_msg.edit_text.call_args[0][0]
+
+
+class TestRequestCoalescing:
+    """Test single-flight deduplication of identical downloads"""
+    
+    @pytest.mark.asyncio
+    async def test_identical_requests_share_one_download(self):
+        """Test later requests attach to the running download"""
+        from bot import SingleFlight
+        
+        flights = SingleFlight()
+        calls = []
+        release = asyncio.Event()
+        
+        async def start(status):
+            calls.append(status)
+            await status.edit_text("50%")
+            await release.wait()
+            return Path("/tmp/shared.mp4")
+        
+        first, second = AsyncMock(), AsyncMock()
+        with patch('bot.progress_hub') as hub:
+            t1 = asyncio.create_task(flights.run("vid:video:720p", first, start))
+            await asyncio.sleep(0)
+            t2 = asyncio.create_task(flights.run("vid:video:720p", second, start))
+            await asyncio.sleep(0)
+            
+            await calls[0].edit_text("75%")
+            release.set()
+            
+            assert await t1 == await t2 == Path("/tmp/shared.mp4")
+        assert len(calls) == 1
+        hub.post.assert_any_call(second, "75%")
+    
+    @pytest.mark.asyncio
+    async def test_shared_file_deleted_after_last_user(self):
+        """Test a shared file survives until every holder cleans up"""
+        from bot import retain_file, cleanup_file
+        
+        test_file = Path('/tmp/test_shared_cleanup.mp4')
+        test_file.touch()
+        retain_file(test_file)
+        retain_file(test_file)
+        
+        await cleanup_file(test_file)
+        assert test_file.exists()
+        
+        await cleanup_file(test_file)
+        assert not test_file.exists()
+
+
+class TestProgressHub:
+    """Test coalesced, rate-limited status edits"""
+    
+    @pytest.mark.asyncio
+    async def test_only_latest_text_is_sent(self):
+        """Test bursts collapse to one edit and unchanged text is skipped"""
+        from bot import ProgressHub
+        
+        hub = ProgressHub(rate=100, min_interval=0.05)
+        message = AsyncMock()
+        for percent in range(10):
+            hub.post(message, f"{percent}%")
+        await asyncio.sleep(0.02)
+        hub.post(message, "9%")
+        await asyncio.sleep(0.1)
+        
+        message.edit_text.assert_called_once_with("9%")
+    
+    @pytest.mark.asyncio
+    async def test_close_drops_pending_edits(self):
+        """Test nothing queued lands after the final edit"""
+        from bot import ProgressHub
+        
+        hub = ProgressHub(rate=100, min_interval=10)
+        message = AsyncMock()
+        hub.post(message, "10%")
+        await asyncio.sleep(0.02)
+        hub.post(message, "50%")
+        await hub.close(message)
+        hub.post(message, "60%")
+        await asyncio.sleep(0.02)
+        
+        message.edit_text.assert_called_once_with("10%")
+    
+    @pytest.mark.asyncio
+    async def test_fanout_edits_share_the_rate(self):
+        """Test a download watched by many requesters is still edited at the hub's rate"""
+        from bot import ProgressHub, StatusFanout
+        
+        hub = ProgressHub(rate=20, min_interval=0)
+        messages = [AsyncMock() for _ in range(50)]
+        with patch('bot.progress_hub', hub):
+            await StatusFanout(messages).edit_text("50%")
+            await asyncio.sleep(0.2)
+        
+        edits = sum(m.edit_text.await_count for m in messages)
+        assert 0 < edits <= 6
+    
+    @pytest.mark.asyncio
+    async def test_fanout_post_uses_no_slot_itself(self):
+        """Test posting a fanout queues its messages directly instead of going through the hub twice"""
+        from bot import ProgressHub, StatusFanout
+        
+        hub = ProgressHub(rate=10, min_interval=0)
+        first, second = AsyncMock(), AsyncMock()
+        with patch('bot.progress_hub', hub):
+            hub.post(StatusFanout([first, second]), "50%")
+            await asyncio.sleep(0.15)
+        
+        first.edit_text.assert_awaited_once_with("50%")
+        second.edit_text.assert_awaited_once_with("50%")
+
+
+class TestStreamingUpload:
+    """Test the streaming download-to-upload pipeline"""
+    
+    @pytest.mark.asyncio
+    async def test_stream_buffer_is_bounded(self):
+        """Test the writer waits for the reader once the buffer is full"""
+        from bot import StreamBuffer
+        
+        buffer = StreamBuffer(capacity=4)
+        await buffer.write(b"abcd")
+        writer = asyncio.create_task(buffer.write(b"ef"))
+        await asyncio.sleep(0)
+        assert not writer.done()
+        
+        assert await buffer.read(3) == b"abc"
+        await writer
+        await buffer.close()
+        
+        assert await buffer.read(10) == b"def"
+        assert await buffer.read(10) == b""
+    
+    @pytest.mark.asyncio
+    async def test_big_stream_marks_last_part(self):
+        """Test unknown-size uploads send -1 total parts until the last one"""
+        from bot import StreamBuffer, upload_stream_telegram, ClientPool, TG_PART_SIZE
+        
+        buffer = StreamBuffer(capacity=32 * 1024 * 1024)
+        await buffer.write(b"x" * (21 * TG_PART_SIZE))
+        await buffer.close()
+        
+        meta = {'title': 'Test', 'ext': 'mp4', 'duration': 1, 'width': 1, 'height': 1, 'size': 0}
+        mock_app = Mock()
+        mock_app.invoke = AsyncMock(return_value=Mock(updates=[]))
+        mock_app.resolve_peer = AsyncMock()
+        with patch('bot.telegram_pool', ClientPool([mock_app])):
+            await upload_stream_telegram(buffer, meta, 1, "caption", is_audio=False)
+        
+        totals = [c.args[0].file_total_parts for c in mock_app.invoke.call_args_list[:-1]]
+        assert totals == [-1] * 20 + [21]
+
+
+class TestClientPool:
+    """Test spreading Telegram uploads over Pyrogram sessions"""
+    
+    @pytest.mark.asyncio
+    async def test_least_loaded_session_and_flood_wait(self):
+        """Test uploads go to the idlest session and move off a flood-waited one"""
+        from bot import ClientPool
+        from pyrogram.errors import FloodWait
+        
+        first, second = Mock(), Mock()
+        pool = ClientPool([first, second])
+        
+        async with pool.lease() as busy:
+            async with pool.lease() as other:
+                assert {busy, other} == {first, second}
+        
+        calls = []
+        async def send(client):
+            calls.append(client)
+            if client is first:
+                raise FloodWait(value=60)
+            return "sent"
+        
+        assert await pool.call(send) == "sent"
+        assert calls == [first, second]
+        async with pool.lease() as client:
+            assert client is second
+
+
+class TestDriveUploader:
+    """Test the resumable Google Drive upload engine"""
+    
+    @staticmethod
+    async def fake_drive(accept: int):
+        """Resumable-upload endpoint that stores at most accept bytes per PUT"""
+        from aiohttp import web
+        from aiohttp.test_utils import TestServer
+        
+        stored = bytearray()
+        
+        async def start(request):
+            return web.Response(headers={"Location": str(request.url.with_path("/session"))})
+        
+        async def put(request):
+            start_end, total = request.headers["Content-Range"].split(" ")[1].split("/")
+            data = await request.read()
+            if start_end != "*":
+                first = int(start_end.split("-")[0])
+                assert first == len(stored)
+                stored.extend(data[:accept] if total == "*" else data)
+            if total != "*" and len(stored) == int(total):
+                return web.json_response({"id": "file1", "size": str(len(stored))})
+            headers = {"Range": f"bytes=0-{len(stored) - 1}"} if stored else {}
+            return web.Response(status=308, headers=headers)
+        
+        app = web.Application()
+        app.router.add_post("/upload", start)
+        app.router.add_put("/session", put)
+        server = TestServer(app)
+        await server.start_server()
+        return server, stored
+    
+    @pytest.mark.asyncio
+    async def test_stream_upload_resends_unacknowledged_bytes(self):
+        """Test unknown-size uploads finish and resend what Drive did not store"""
+        from bot import DriveUploader, StreamBuffer
+        
+        server, stored = await self.fake_drive(accept=100 * 1024)
+        uploader = DriveUploader(2, 0, 1, upload_url=str(server.make_url("/upload")))
+        payload = bytes(range(256)) * 4000
+        buffer = StreamBuffer(capacity=len(payload))
+        await buffer.write(payload)
+        await buffer.close()
+        
+        try:
+            result = await uploader.upload(AsyncMock(return_value="token"), "folder", "a.mp4", buffer)
+        finally:
+            await uploader.close()
+            await server.close()
+        
+        assert result["id"] == "file1"
+        assert bytes(stored) == payload
+    
+    @pytest.mark.asyncio
+    async def test_failed_chunk_resent_after_shrinking(self):
+        """Test a chunk halved after a failure never reads a negative size and resends the carried bytes"""
+        from bot import DriveUploader
+        
+        mib = 1024 * 1024
+        payload = bytes(range(256)) * (40 * mib // 256)
+        stored = bytearray()
+        puts = []
+        
+        class Source:
+            def __init__(self):
+                self.offset, self.reads = 0, []
+            
+            async def read(self, n):
+                self.reads.append(n)
+                assert n > 0
+                data = payload[self.offset:self.offset + n]
+                self.offset += len(data)
+                return data
+        
+        async def put(session_uri, token_provider, data, content_range):
+            puts.append(len(data))
+            if len(puts) == 2:
+                return 503, "unavailable"
+            stored.extend(data)
+            if content_range.endswith(f"/{len(payload)}"):
+                return 200, {"id": "file1"}
+            return 308, len(stored)
+        
+        uploader = DriveUploader(2, 1, 64, upload_url="unused")
+        uploader._start = AsyncMock(return_value="session")
+        uploader._put = put
+        uploader._status = AsyncMock(side_effect=lambda *args: (308, len(stored)))
+        source = Source()
+        with patch('bot.asyncio.sleep', new_callable=AsyncMock):
+            result = await uploader.upload(AsyncMock(return_value="token"), "folder", "a.mp4", source)
+        
+        assert result["id"] == "file1"
+        assert bytes(stored) == payload
+        assert puts[1] == puts[2] == 2 * mib
+        assert max(puts) <= 64 * mib and len(puts) > 3
+    
+    @pytest.mark.asyncio
+    async def test_resumes_persisted_session(self, tmp_path):
+        """Test a stored session URI continues from Drive's acknowledged offset"""
+        import aiofiles
+        from bot import DriveUploader, redis_client
+        
+        server, stored = await self.fake_drive(accept=10 ** 9)
+        uploader = DriveUploader(2, 0, 1, upload_url=str(server.make_url("/upload")))
+        payload = b"y" * 300000
+        stored.extend(payload[:1000])
+        test_file = tmp_path / "b.mp4"
+        test_file.write_bytes(payload)
+        await redis_client.set(f"{DriveUploader.SESSION_PREFIX}k", str(server.make_url("/session")))
+        
+        try:
+            async with aiofiles.open(test_file, "rb") as f:
+                result = await uploader.upload(
+                    AsyncMock(return_value="token"), "folder", "b.mp4", f,
+                    total_size=len(payload), resume_key="k"
+                )
+        finally:
+            await uploader.close()
+            await server.close()
+        
+        assert result["size"] == str(len(payload))
+        assert bytes(stored) == payload
+        assert not await redis_client.exists(f"{DriveUploader.SESSION_PREFIX}k")
+    
+    @pytest.mark.asyncio
+    async def test_folder_id_cached_and_refreshed_when_missing(self):
+        """Test the folder lookup runs once and again only after Drive reports it gone"""
+        from bot import upload_to_gdrive, DriveError, get_or_create_user
+        
+        user = await get_or_create_user(555000111)
+        user.gdrive_token = "token"
+        user.gdrive_folder_id = None  # an earlier run persisted one
+        source = Mock()
+        
+        with patch('bot.get_gdrive_token_provider', AsyncMock(return_value=AsyncMock())), \
+             patch('bot.drive_uploader') as mock_drive:
+            mock_drive.find_or_create_folder = AsyncMock(side_effect=["old", "new"])
+            mock_drive.upload = AsyncMock(return_value={'id': 'f1'})
+            mock_drive.share = AsyncMock()
+            
+            await upload_to_gdrive(Path("a.mp4"), user, AsyncMock(), source=source)
+            await upload_to_gdrive(Path("b.mp4"), user, AsyncMock(), source=source)
+            assert mock_drive.find_or_create_folder.call_count == 1
+            
+            mock_drive.upload = AsyncMock(side_effect=[DriveError("gone", 404), {'id': 'f2'}])
+            result = await upload_to_gdrive(Path("c.mp4"), user, AsyncMock(), source=source)
+        
+        assert result == {'id': 'f2'}
+        assert user.gdrive_folder_id == "new"
+        assert mock_drive.upload.call_args.args[1] == "new"
+
+
+class TestMetrics:
+    """Test the metrics subsystem"""
+    
+    @pytest.mark.asyncio
+    async def test_phase_and_cache_metrics(self):
+        """Test phases record latency and bytes, and caches record hits and misses"""
+        from bot import track_phase, metric_value, result_cache
+        
+        before = metric_value("ytdl_phase_bytes_total", {"phase": "test"})
+        with track_phase("test") as phase:
+            phase['bytes'] = 1000
+        assert metric_value("ytdl_phase_bytes_total", {"phase": "test"}) == before + 1000
+        assert metric_value("ytdl_phase_seconds_count", {"phase": "test"}) >= 1
+        
+        misses = metric_value("ytdl_cache_requests_total", {"cache": "result", "result": "miss"})
+        await result_cache.get("zzzzzzzzzzz", "video", "720p")
+        assert metric_value("ytdl_cache_requests_total", {"cache": "result", "result": "miss"}) == misses + 1
+    
+    @pytest.mark.asyncio
+    async def test_admin_reads_live_counters(self):
+        """Test /admin shows the delivery counter instead of placeholders"""
+        from bot import cmd_admin, DELIVERIES, metric_value
+        
+        user = await get_or_create_user(123450001)
+        user.is_admin = True
+        DELIVERIES.labels("telegram", "success").inc()
+        expected = int(sum(
+            metric_value("ytdl_deliveries_total", {"storage": s, "status": "success"})
+            for s in ("telegram", "gdrive")
+        ))
+        
+        mock_message = AsyncMock()
+        mock_message.from_user.id = 123450001
+        await cmd_admin(mock_message)
+        
+        assert f"Downloads (since start): {expected}" in mock_message.answer.call_args[0][0]
+
+
+class TestWebhook:
+    """Test the webhook update server"""
+    
+    @pytest.mark.asyncio
+    async def test_backpressure_past_max_in_flight(self):
+        """Test updates run in the background and the excess gets 503"""
+        from aiohttp import web
+        from aiohttp.test_utils import TestServer, TestClient
+        from bot import BoundedRequestHandler, dp, bot
+        
+        release = asyncio.Event()
+        async def blocked(**kwargs):
+            await release.wait()
+        
+        app = web.Application()
+        BoundedRequestHandler(dp, bot, max_in_flight=1).register(app, path="/webhook")
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        
+        try:
+            with patch.object(dp, 'feed_raw_update', AsyncMock(side_effect=blocked)):
+                first = await client.post("/webhook", json={"update_id": 1})
+                second = await client.post("/webhook", json={"update_id": 2})
+                release.set()
+                await asyncio.sleep(0.01)
+                third = await client.post("/webhook", json={"update_id": 3})
+        finally:
+            await client.close()
+        
+        assert (first.status, second.status, third.status) == (200, 503, 200)
+    
+    @pytest.mark.asyncio
+    async def test_long_running_handler_frees_its_slot(self):
+        """Test an update that went on to a long_running handler no longer blocks new ones"""
+        from aiohttp import web
+        from aiohttp.test_utils import TestServer, TestClient
+        from bot import BoundedRequestHandler, LongRunningMiddleware, dp, bot
+        
+        release = asyncio.Event()
+        async def long_handler(event, data):
+            await release.wait()
+        
+        async def download(**kwargs):
+            data = {"handler": Mock(flags={"long_running": True})}
+            await LongRunningMiddleware()(long_handler, None, data)
+        
+        app = web.Application()
+        handler = BoundedRequestHandler(dp, bot, max_in_flight=1)
+        handler.register(app, path="/webhook")
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        
+        try:
+            with patch.object(dp, 'feed_raw_update', AsyncMock(side_effect=download)):
+                first = await client.post("/webhook", json={"update_id": 1})
+                await asyncio.sleep(0.01)
+                second = await client.post("/webhook", json={"update_id": 2})
+                await asyncio.sleep(0.01)
+                assert handler.in_flight == 0
+                release.set()
+                await asyncio.sleep(0.01)
+        finally:
+            await client.close()
+        
+        assert (first.status, second.status) == (200, 200)
+
+
+class TestProfiling:
+    """Test the event-loop watchdog and slow-handler logging"""
+    
+    @pytest.mark.asyncio
+    async def test_watchdog_reports_blocking_call(self):
+        """Test a call that blocks the loop is logged once with its stack"""
+        import time
+        from bot import LoopWatchdog
+        
+        watchdog = LoopWatchdog(0.1)
+        with patch('bot.logger') as mock_logger:
+            watchdog.start(asyncio.get_running_loop())
+            try:
+                await asyncio.sleep(0.1)
+                time.sleep(0.4)  # the blocking call
+                await asyncio.sleep(0.1)
+            finally:
+                watchdog.stop()
+        
+        assert mock_logger.warning.call_count == 1
+        assert "test_watchdog_reports_blocking_call" in mock_logger.warning.call_args[0][0]
+    
+    @pytest.mark.asyncio
+    async def test_slow_handlers_logged_unless_long_running(self):
+        """Test a slow handler is logged with where it waited, a flagged one is not"""
+        from bot import SlowHandlerMiddleware
+        
+        async def slow_handler(event, data):
+            await asyncio.sleep(0.15)
+        
+        middleware = SlowHandlerMiddleware(0.1)
+        with patch('bot.logger') as mock_logger:
+            await middleware(slow_handler, Mock(), {"handler": Mock(callback=slow_handler, flags={})})
+            await middleware(slow_handler, Mock(), {
+                "handler": Mock(callback=slow_handler, flags={"long_running": True})
+            })
+        
+        assert mock_logger.warning.call_count == 1
+        message = mock_logger.warning.call_args[0][0]
+        assert "slow_handler: 0.1" in message
+        assert "in sleep" in message
+    
+    @pytest.mark.asyncio
+    async def test_profiler_finds_busy_function(self):
+        """Test the on-demand profiler attributes loop time to the busy coroutine"""
+        import time
+        from bot import SamplingProfiler
+        
+        async def busy_loop():
+            end = time.monotonic() + 0.3
+            while time.monotonic() < end:
+                sum(range(1000))
+                await asyncio.sleep(0)
+        
+        task = asyncio.create_task(busy_loop())
+        stacks = await SamplingProfiler(0.005).profile(0.4)
+        await task
+        
+        assert SamplingProfiler.summary(stacks)[0][0].endswith(":busy_loop")
+
+
 class TestCommandHandlers:
     """Test bot command handlers"""
     
@@ -262,9 +1177,221 @@ class TestCommandHandlers:
         assert "Statistics" in args[0] or "পরিসংখ্যান" in args[0]
 
 
+class TestStorageSelection:
+    """Test choosing the destination before the download"""
+    
+    @pytest.mark.asyncio
+    async def test_asks_for_storage_without_default(self):
+        """Test the storage keyboard is shown before downloading"""
+        from bot import callback_quality, DownloadStates
+        
+        await get_or_create_user(222221)
+        mock_callback = AsyncMock()
+        mock_callback.data = "quality_720p"
+        mock_callback.from_user.id = 222221
+        mock_state = AsyncMock()
+        
+        with patch('bot.deliver', new_callable=AsyncMock) as mock_deliver:
+            await callback_quality(mock_callback, mock_state)
+        
+        mock_deliver.assert_not_called()
+        mock_state.set_state.assert_called_with(DownloadStates.selecting_storage)
+        keyboard = mock_callback.message.edit_text.call_args.kwargs['reply_markup']
+        callbacks = [b.callback_data for row in keyboard.inline_keyboard for b in row]
+        assert "storage_gdrive_default" in callbacks
+    
+    @pytest.mark.asyncio
+    async def test_default_storage_starts_immediately(self):
+        """Test a saved default skips the storage question"""
+        from bot import callback_quality, update_user
+        
+        await get_or_create_user(222222)
+        await update_user(222222, default_storage="gdrive")
+        
+        mock_callback = AsyncMock()
+        mock_callback.data = "quality_720p"
+        mock_callback.from_user.id = 222222
+        mock_state = AsyncMock()
+        mock_state.get_data.return_value = {
+            "url": "https://youtu.be/dQw4w9WgXcQ", "format": "video"
+        }
+        
+        with patch('bot.deliver', new_callable=AsyncMock) as mock_deliver:
+            await callback_quality(mock_callback, mock_state)
+        
+        args = mock_deliver.call_args.args
+        assert args[-3:] == ("video", "720p", "gdrive")
+
+
+class TestJobRecords:
+    """Test persisted job lifecycle and resume after a restart"""
+    
+    async def _job(self, job_id):
+        from bot import async_session, Job
+        async with async_session() as session:
+            return await session.get(Job, job_id)
+    
+    @pytest.mark.asyncio
+    async def test_interrupted_job_stays_resumable(self):
+        """Test a finished delivery is done and one cut off by shutdown stays active"""
+        from bot import deliver, job_recorder, JobEvent, async_session
+        from sqlalchemy import select
+        
+        user = await get_or_create_user(333331)
+        status_msg = AsyncMock()
+        status_msg.message_id = 42
+        
+        async def download(url, format_type, quality, status, user):
+            path = Path("/tmp/job_record_test.mp4")
+            path.write_bytes(b"x" * 10)
+            return path
+        
+        job = job_recorder.start(user_id=user.telegram_id, url="https://youtu.be/aaaaaaaaaaa", format="video",
+                                 quality="720p", storage="telegram", chat_id=1, message_id=42)
+        with patch('bot.run_download', side_effect=download), \
+             patch('bot.upload_large_file_pyrogram', AsyncMock(return_value="file-id")), \
+             patch('bot.result_cache.get', AsyncMock(return_value={})):
+            assert await deliver(status_msg, 1, user, "https://youtu.be/aaaaaaaaaaa",
+                                 "video", "720p", "telegram", job=job)
+        await job_recorder.flush()
+        row = await self._job(job.id)
+        assert (row.status, row.file_size, row.message_id) == ("done", 10, 42)
+        async with async_session() as session:
+            states = (await session.scalars(
+                select(JobEvent.status).where(JobEvent.job_id == job.id).order_by(JobEvent.id)
+            )).all()
+        assert states[0] == "queued" and states[-1] == "done"
+        assert (await get_or_create_user(333331)).total_downloads == user.total_downloads + 1
+        
+        job = job_recorder.start(user_id=user.telegram_id, url="https://youtu.be/bbbbbbbbbbb", format="video",
+                                 quality="720p", storage="telegram", chat_id=1)
+        with patch('bot.run_download', AsyncMock(side_effect=asyncio.CancelledError)), \
+             patch('bot.result_cache.get', AsyncMock(return_value={})):
+            with pytest.raises(asyncio.CancelledError):
+                await deliver(status_msg, 1, user, "https://youtu.be/bbbbbbbbbbb",
+                              "video", "720p", "telegram", job=job)
+        await job_recorder.flush()
+        assert (await self._job(job.id)).status == "queued"
+    
+    @pytest.mark.asyncio
+    async def test_resume_reattaches_status_and_work_dir(self, tmp_path):
+        """Test unfinished jobs restart with their status message and .part directory"""
+        from bot import resume_jobs, job_recorder, ResumedStatus
+        
+        job = job_recorder.start(user_id=333332, url="https://youtu.be/ccccccccccc", format="audio",
+                                 quality="best", storage="gdrive", chat_id=5, message_id=77)
+        job_recorder.set_state(job, "downloading", work_dir=str(tmp_path))
+        await job_recorder.flush()
+        
+        with patch('bot.deliver', new_callable=AsyncMock) as mock_deliver, \
+             patch('bot.bot.edit_message_text', new_callable=AsyncMock):
+            keep = await resume_jobs()
+            await asyncio.sleep(0.05)
+        
+        assert tmp_path in keep
+        resumed = [c for c in mock_deliver.call_args_list if c.kwargs['job'].id == job.id]
+        assert resumed[0].kwargs['job'].resume_dir == tmp_path
+        status = resumed[0].args[0]
+        assert isinstance(status, ResumedStatus) and (status.chat_id, status.message_id) == (5, 77)
+        assert resumed[0].args[3:] == ("https://youtu.be/ccccccccccc", "audio", "best", "gdrive")
+    
+    def test_progress_checkpoints_throttled(self):
+        """Test progress is recorded at most once per interval while state changes always are"""
+        from bot import JobRecord, checkpoint_job, set_job_state, current_job, job_recorder
+        
+        record = JobRecord(job_id=1)
+        token = current_job.set(record)
+        try:
+            with patch.object(job_recorder, '_maybe_flush'):
+                checkpoint_job(progress=10)
+                checkpoint_job(progress=20)
+                assert record.pending['progress'] == 10
+                set_job_state("postprocessing")
+                assert record.pending['status'] == "postprocessing"
+        finally:
+            current_job.reset(token)
+            job_recorder._dirty.pop(id(record), None)
+            job_recorder._events = [e for e in job_recorder._events if e[0] is not record]
+    
+    @pytest.mark.asyncio
+    async def test_daily_rollup(self):
+        """Test rollup_stats counts a day's finished jobs into daily_stats"""
+        from bot import job_recorder, rollup_stats, get_daily_stats
+        from datetime import date
+        
+        await job_recorder.flush()
+        await rollup_stats(date.today())
+        before = (await get_daily_stats(1))[0]
+        for status, size in (("done", 2048), ("failed", None)):
+            job = job_recorder.start(user_id=333333, url="https://youtu.be/ddddddddddd", format="video",
+                                     quality="720p", storage="telegram")
+            job_recorder.set_state(job, status, file_size=size, completed_at=datetime.now())
+        await job_recorder.flush()
+        await rollup_stats(date.today())
+        
+        today = (await get_daily_stats(1))[0]
+        assert today.day == date.today()
+        assert today.downloads - before.downloads == 1
+        assert today.failed - before.failed == 1
+        assert today.bytes - before.bytes == 2048
+        assert today.total_users >= 1
+
+
+class TestDatabaseWriter:
+    """Test SQLite tuning and serialized writes"""
+    
+    @pytest.mark.asyncio
+    async def test_sqlite_pragmas(self):
+        """Test SQLite connections use WAL and wait for the write lock"""
+        from bot import engine
+        from sqlalchemy import text
+        
+        async with engine.connect() as conn:
+            assert (await conn.scalar(text("PRAGMA journal_mode"))) == "wal"
+            assert (await conn.scalar(text("PRAGMA busy_timeout"))) == 5000
+    
+    @pytest.mark.asyncio
+    async def test_writes_run_one_at_a_time(self):
+        """Test queued writes never overlap and a failing one doesn't stop the rest"""
+        from bot import DatabaseWriter
+        
+        writer = DatabaseWriter(serialize=True)
+        running, overlap = [], []
+        
+        async def work(session, n):
+            running.append(n)
+            overlap.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(n)
+            if n == 2:
+                raise ValueError("bad write")
+            return n
+        
+        results = await asyncio.gather(
+            *(writer.run(lambda session, n=n: work(session, n)) for n in range(5)),
+            return_exceptions=True
+        )
+        assert max(overlap) == 1
+        assert results[:2] == [0, 1] and isinstance(results[2], ValueError) and results[3:] == [3, 4]
+
+
 class TestDatabase:
     """Test database operations"""
     
+    @pytest.mark.asyncio
+    async def test_failed_statement_not_left_on_timing_stack(self):
+        """Test a failing query does not leave its start time behind for the next one"""
+        from bot import engine
+        from sqlalchemy import text
+        
+        async with engine.connect() as conn:
+            with pytest.raises(Exception):
+                await conn.execute(text("SELECT * FROM no_such_table"))
+            await conn.rollback()
+            await conn.execute(text("SELECT 1"))
+            raw = await conn.get_raw_connection()
+            assert not raw.info.get("query_start")
+    
     @pytest.mark.asyncio
     async def test_user_creation_in_db(self):
         """Test user is created in database"""
@@ -299,6 +1426,7 @@ class TestDatabase:
                 select(User).where(User.telegram_id == 444444)
             )
             db_user = result.scalar_one()
+            before = db_user.total_downloads
             db_user.total_downloads += 1
             await session.commit()
         
@@ -308,7 +1436,7 @@ class TestDatabase:
                 select(User).where(User.telegram_id == 444444)
             )
             db_user = result.scalar_one()
-            assert db_user.total_downloads == 1
+            assert db_user.total_downloads == before + 1
 
 
 class TestErrorHandling:
@@ -355,6 +1483,58 @@ class TestErrorHandling:
         mock_message.answer.assert_called_once()
 
 
+class TestTempStorage:
+    """Test temp disk reservations and per-job cleanup"""
+    
+    @pytest.mark.asyncio
+    async def test_reservation_waits_for_space(self, tmp_path):
+        """Test a job over the quota waits until another releases, and hopeless ones are refused"""
+        from bot import TempStorage, TempStorageFull
+        
+        storage = TempStorage(tmp_path, quota_mb=10, min_free_mb=0, timeout=5)
+        first = await storage.reserve(8 * 1024 * 1024)
+        (first / "video.mp4").write_bytes(b"x")
+        
+        second = asyncio.create_task(storage.reserve(4 * 1024 * 1024))
+        await asyncio.sleep(0.1)
+        assert not second.done()
+        
+        storage.release(first / "video.mp4")
+        assert not first.exists()
+        assert (await second).parent == tmp_path
+        assert storage.reserved == 4 * 1024 * 1024
+        
+        with pytest.raises(TempStorageFull):
+            await storage.reserve(20 * 1024 * 1024)
+    
+    @pytest.mark.asyncio
+    async def test_reservation_times_out(self, tmp_path):
+        """Test a job gives up when no space frees up in time"""
+        from bot import TempStorage, TempStorageFull
+        
+        storage = TempStorage(tmp_path, quota_mb=10, min_free_mb=0, timeout=0.2)
+        await storage.reserve(8 * 1024 * 1024)
+        with pytest.raises(TempStorageFull):
+            await storage.reserve(4 * 1024 * 1024)
+    
+    @pytest.mark.asyncio
+    async def test_unwritten_reservations_count_against_free_disk(self, tmp_path):
+        """Test without a quota, reserved-but-unwritten space is not handed out twice"""
+        from bot import TempStorage, TempStorageFull
+        from collections import namedtuple
+        
+        mb = 1024 * 1024
+        usage = namedtuple("usage", "total used free")(100 * mb, 0, 10 * mb)
+        storage = TempStorage(tmp_path, quota_mb=0, min_free_mb=0, timeout=0.2)
+        with patch('bot.shutil.disk_usage', return_value=usage):
+            first = await storage.reserve(6 * mb)
+            with pytest.raises(TempStorageFull):
+                await storage.reserve(6 * mb)
+            # What the first job already wrote is part of the disk's used space, not extra
+            (first / "video.part").write_bytes(b"x" * mb)
+            assert storage.available() == 5 * mb
+
+
 class TestFileHandling:
     """Test file handling"""
     
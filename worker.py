@@ -0,0 +1,16 @@
+"""
+Download worker - leases jobs from the Redis queue (QUEUE_BACKEND=redis)
+Run one or more of these next to the bot front end: python worker.py
+"""
+
+import asyncio
+
+from bot import run_worker, logger
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(run_worker())
+    except KeyboardInterrupt:
+        logger.info("Worker stopped by user")
+    except Exception as e:
+        logger.error(f"Worker crashed: {e}", exc_info=True)